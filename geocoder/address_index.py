@@ -0,0 +1,291 @@
+import heapq
+import json
+import math
+import mmap
+import os
+import sqlite3
+import time
+from array import array
+
+import numpy as np
+
+from .departments import list_shards
+from .query import LABEL_EXPRESSION, TYPE_VOIE_EXPRESSION, extract_query_keys, has_precomputed_columns
+
+# First bytes of an index file, followed by the length of its JSON header on 8 bytes and the header
+MAGIC = b'BANINDEX1\n'
+
+# Offset alignment of the arrays in the file
+ALIGNMENT = 64
+
+# Number of rows above which a block is filtered with numpy
+LARGE_BLOCK = 64
+
+# Rows of the index in the order of the candidates_index of prepare_database, so the candidates of an address
+# come in the same order as from the database
+INDEX_QUERY = """SELECT code_postal, numero, {type_voie}, nom_afnor, {label}, lat, lon FROM addresses
+    ORDER BY 1, 2, 3, 4, 5, 6, 7"""
+
+
+def sort_key(row):
+    """
+    Order of the rows of INDEX_QUERY in SQLite, where NULL comes first.
+    """
+    return tuple((value is not None, value if value is not None else 0) for value in row)
+
+
+def index_databases(database):
+    """
+    Return the database files of a database or of a directory of department databases.
+    """
+    shards = list_shards(database)
+    if shards == {}:
+        raise ValueError("No department database in {}".format(database))
+    return list(shards.values()) if shards else [database]
+
+
+def build_address_index(database, index_path, verbose=False):
+    """
+    Build the compact address index of a local BAN database and save it to a single file.
+
+    The addresses are sorted by postal code and house number, each postal code being a contiguous block of
+    rows. House numbers, coordinates and the ids of the interned street names and types are numpy arrays,
+    labels are stored one after the other in a single UTF-8 buffer. AddressIndex maps the file read-only.
+
+    Parameters:
+    - database (str): The file path of the SQLite database, or a directory of department databases.
+    - index_path (str): The file path of the index.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - count (int): The number of addresses indexed.
+    """
+    start = time.perf_counter()
+    databases = index_databases(database)
+    connections = [sqlite3.connect(path) for path in databases]
+    labels_path = index_path + '.labels.tmp'
+    postcodes, block_starts = array('i'), array('q')
+    numeros, type_ids, street_ids = array('i'), array('i'), array('i')
+    lats, lons = array('d'), array('d')
+    label_offsets = array('q', [0])
+    streets, types = {}, {}
+    try:
+        cursors = []
+        for conn in connections:
+            precomputed = has_precomputed_columns(conn)
+            cursors.append(conn.execute(INDEX_QUERY.format(
+                type_voie="type_voie" if precomputed else TYPE_VOIE_EXPRESSION,
+                label="label" if precomputed else LABEL_EXPRESSION.format(table=""))))
+        # A postal code may span two departments, the rows of all the databases are merged in a single order
+        with open(labels_path, 'wb') as labels_file:
+            for postal_code, numero, type_voie, nom_afnor, label, lat, lon in heapq.merge(*cursors, key=sort_key):
+                postal_code = str(postal_code) if postal_code is not None else ''
+                if not (len(postal_code) == 5 and postal_code.isdigit()):
+                    continue
+                if not postcodes or postcodes[-1] != int(postal_code):
+                    postcodes.append(int(postal_code))
+                    block_starts.append(len(numeros))
+                numeros.append(numero if numero is not None else -1)
+                type_ids.append(types.setdefault(type_voie or '', len(types)))
+                street_ids.append(streets.setdefault(nom_afnor or '', len(streets)))
+                lats.append(lat if lat is not None else math.nan)
+                lons.append(lon if lon is not None else math.nan)
+                encoded = label.encode('utf-8') if label else b''
+                labels_file.write(encoded)
+                label_offsets.append(label_offsets[-1] + len(encoded))
+    except BaseException:
+        if os.path.exists(labels_path):
+            os.remove(labels_path)
+        raise
+    finally:
+        for conn in connections:
+            conn.close()
+    block_starts.append(len(numeros))
+
+    arrays = {
+        'postcodes': np.frombuffer(postcodes, dtype=np.int32),
+        'block_starts': np.frombuffer(block_starts, dtype=np.int64),
+        'numeros': np.frombuffer(numeros, dtype=np.int32),
+        'type_ids': np.frombuffer(type_ids, dtype=np.int32),
+        'street_ids': np.frombuffer(street_ids, dtype=np.int32),
+        'lats': np.frombuffer(lats, dtype=np.float64),
+        'lons': np.frombuffer(lons, dtype=np.float64),
+        'label_offsets': np.frombuffer(label_offsets, dtype=np.int64),
+    }
+    for name, strings in (('streets', streets), ('types', types)):
+        encoded = [string.encode('utf-8') for string in strings]
+        arrays[name] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays[name[:-1] + '_offsets'] = np.concatenate(([0], np.cumsum([len(e) for e in encoded],
+                                                                         dtype=np.int64))).astype(np.int64)
+
+    # Offsets of the arrays, the labels buffer is copied last from its temporary file
+    header = {'count': len(numeros), 'databases': {path: os.stat(path).st_mtime_ns for path in databases},
+              'arrays': {}}
+    layout = [(name, values.dtype.str, values.shape[0]) for name, values in arrays.items()]
+    layout.append(('labels', '|u1', label_offsets[-1]))
+    header_size = len(MAGIC) + 8 + len(json.dumps(header)) + 64 * len(layout) + 4096
+    offset = header_size
+    for name, dtype, size in layout:
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        header['arrays'][name] = {'dtype': dtype, 'size': int(size), 'offset': offset}
+        offset += np.dtype(dtype).itemsize * int(size)
+    encoded_header = json.dumps(header).encode('utf-8')
+    if len(MAGIC) + 8 + len(encoded_header) > header_size:
+        os.remove(labels_path)
+        raise ValueError("Header of the address index too large")
+
+    temporary_path = index_path + '.tmp'
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(MAGIC + len(encoded_header).to_bytes(8, 'little') + encoded_header)
+            for name, _, _ in layout:
+                f.write(b'\0' * (header['arrays'][name]['offset'] - f.tell()))
+                if name == 'labels':
+                    with open(labels_path, 'rb') as labels_file:
+                        for chunk in iter(lambda: labels_file.read(1 << 20), b''):
+                            f.write(chunk)
+                else:
+                    f.write(arrays[name].tobytes())
+        os.replace(temporary_path, index_path)
+    finally:
+        os.remove(labels_path)
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    if verbose:
+        print(f"[+] {len(numeros)} addresses of {len(postcodes)} postal codes indexed in {index_path} "
+              f"({os.path.getsize(index_path) / 1e6:.1f} MB, {time.perf_counter() - start:.2f}s)")
+    return len(numeros)
+
+
+class AddressIndex:
+    """
+    Read-only view of an address index file built by build_address_index.
+
+    The file is memory-mapped and its arrays are numpy views of the mapping, so the processes mapping the same
+    file share its pages through the page cache instead of each holding a copy.
+
+    It answers the candidates queries keyed by a postal code, with the semantics of the candidates queries of a
+    database prepared by initdb: the block of the postal code, narrowed by house number with a binary search,
+    then by street type and street name, unless no row has the street name.
+
+    Parameters:
+    - path (str): The file path of the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError("{} is not an address index".format(path))
+        header_size = int.from_bytes(self.mmap[len(MAGIC):len(MAGIC) + 8], 'little')
+        self.header = json.loads(self.mmap[len(MAGIC) + 8:len(MAGIC) + 8 + header_size])
+        for name, spec in self.header['arrays'].items():
+            setattr(self, name, np.frombuffer(self.mmap, dtype=spec['dtype'], count=spec['size'],
+                                              offset=spec['offset']))
+        # A few hundred street types at most, decoded once, the street names are decoded on first use
+        self.type_names = {self.string('types', type_id): type_id for type_id in range(len(self.type_offsets) - 1)}
+        self.street_names = {}
+        # Rows of each postal code
+        bounds = self.block_starts.tolist()
+        self.blocks = {postal_code: (first, last)
+                       for postal_code, first, last in zip(self.postcodes.tolist(), bounds, bounds[1:])}
+        self.max_numero = int(np.iinfo(self.numeros.dtype).max)
+
+    def __len__(self):
+        return self.header['count']
+
+    def string(self, table, position):
+        """
+        Decode the string at a position of the labels, streets or types buffer.
+        """
+        start, end = getattr(self, table[:-1] + '_offsets')[position:position + 2].tolist()
+        base = self.header['arrays'][table]['offset']
+        return self.mmap[base + start:base + end].decode('utf-8')
+
+    def street_name(self, street_id):
+        """
+        Return the nom_afnor of a street id.
+        """
+        if street_id not in self.street_names:
+            self.street_names[street_id] = self.string('streets', street_id)
+        return self.street_names[street_id]
+
+    def stale_databases(self):
+        """
+        Return the databases changed since the index was built.
+        """
+        return [path for path, mtime in self.header['databases'].items()
+                if not os.path.exists(path) or os.stat(path).st_mtime_ns != mtime]
+
+    @staticmethod
+    def answers(parsed, fts_limit=0):
+        """
+        Return True if the candidates query of a parsed address is keyed by a postal code, False if it must run
+        on the database (no postal code, or a lookup in the full-text index).
+        """
+        return parsed.postal_code is not None and not (fts_limit and parsed.numero is None)
+
+    def lookup(self, parsed, fts_limit=0, fallback=True):
+        """
+        Return the candidates of a parsed address, or None if the index does not answer its query.
+
+        Returns:
+        - rows (list): The (address, lat, lon) of the candidates.
+        """
+        if not self.answers(parsed, fts_limit):
+            return None
+        return self.lookup_keys(*extract_query_keys(parsed), fallback=fallback)
+
+    def lookup_keys(self, starting_number, postal_code, street_type, street_word, fallback=True):
+        """
+        Return the candidates of the query keys of an address given by extract_query_keys, like lookup. Without
+        fallback, a misspelled street name gives no candidate.
+        """
+        if postal_code is None:
+            return None
+        block = self.blocks.get(int(postal_code))
+        if block is None:
+            return []
+        first, last = block
+        if starting_number is not None:
+            if int(starting_number) > self.max_numero:
+                return []
+            # Within a block the rows are sorted by house number
+            start, end = self.numeros[first:last].searchsorted((int(starting_number), int(starting_number) + 1))
+            first, last = first + int(start), first + int(end)
+        if first == last:
+            return []
+        # The candidates of an address are a few contiguous rows, plain lists are cheaper than numpy here, numpy
+        # filters the whole block of a postal code faster
+        rows = range(last - first)
+        if street_type is not None:
+            type_id = self.type_names.get(street_type)
+            if last - first > LARGE_BLOCK:
+                rows = np.flatnonzero(self.type_ids[first:last] == type_id).tolist()
+            else:
+                rows = [row for row, row_type in zip(rows, self.type_ids[first:last].tolist()) if row_type == type_id]
+            if street_word is not None and rows:
+                # Like the fallback of the candidates query, a misspelled street name keeps the rows of the type
+                street_ids = self.street_ids[first:last][rows].tolist()
+                rows = [row for row, street_id in zip(rows, street_ids) if street_word in self.street_name(street_id)
+                        ] or (rows if fallback else [])
+        if isinstance(rows, range):
+            offsets = self.label_offsets[first:last + 1].tolist()
+            starts, ends = offsets[:-1], offsets[1:]
+            lats, lons = self.lats[first:last].tolist(), self.lons[first:last].tolist()
+        else:
+            positions = np.array(rows, dtype=np.int64) + first
+            starts, ends = self.label_offsets[positions].tolist(), self.label_offsets[positions + 1].tolist()
+            lats, lons = self.lats[positions].tolist(), self.lons[positions].tolist()
+        base = self.header['arrays']['labels']['offset']
+        return [(self.mmap[base + start:base + end].decode('utf-8') or None,
+                 None if math.isnan(lat) else lat, None if math.isnan(lon) else lon)
+                for start, end, lat, lon in zip(starts, ends, lats, lons)]
+
+    def close(self):
+        for name in self.header['arrays']:
+            delattr(self, name)
+        self.mmap.close()
@@ -1,369 +1,611 @@
-import re
+import os
+import signal
 import sqlite3
+import time
+from collections import deque
 from multiprocessing import Pool
+from pathlib import Path
 
-from thefuzz import process
+from .address_index import AddressIndex
+from .cache import fold_address
+from .departments import list_shards, route_address
+from .metrics import NULL_METRICS, Metrics
+from .normalizer import normalize, normalize_many
+from .parser import parse, parse_many
+from .query import WHOLE_TABLE, build_candidates_query, explain_query, has_fts_index, has_precomputed_columns
+from .scorers import get_scorer
+from .tiers import TIERS, CandidateSource, Strategy, match_tiered
+from .utils import process_memory
+
+# Read-only connections and address indexes, opened on first use, and scorer and metrics set up once per worker
+# process by the pool initializer
+_worker_connections = {}
+_worker_indexes = {}
+_worker_scorer = None
+_worker_metrics = NULL_METRICS
+
+# Number of SQLite virtual machine instructions between two calls of the progress handler counting them
+SQL_STEPS_INTERVAL = 1000
+
+
+def open_database(database):
+    """
+    Open a read-only connection to the local BAN database.
+    """
+    return sqlite3.connect("{}?mode=ro".format(Path(database).resolve().as_uri()), uri=True, cached_statements=256)
+
+
+def count_sql_steps(conn, metrics):
+    """
+    Count the instructions run by SQLite on a connection in the sql_steps counter of the metrics, a measure of
+    the rows scanned by the queries, when the metrics are enabled.
+    """
+    if metrics.enabled:
+        conn.set_progress_handler(lambda: metrics.count("sql_steps", SQL_STEPS_INTERVAL), SQL_STEPS_INTERVAL)
+    return conn
+
+
+def worker_connection(database):
+    """
+    Return the connection of the worker to a BAN database, opening it on first use.
+    """
+    if database not in _worker_connections:
+        _worker_connections[database] = count_sql_steps(open_database(database), _worker_metrics)
+    return _worker_connections[database]
+
+
+def worker_index(path):
+    """
+    Return the address index mapped by the worker, mapping it on first use.
+    """
+    if path not in _worker_indexes:
+        _worker_indexes[path] = AddressIndex(path)
+    return _worker_indexes[path]
+
+
+def init_worker(scorer, stats=False):
+    """
+    Pool initializer: each worker opens its own connections to the BAN databases, so candidate
+    addresses are read in the worker and never pickled through the pool.
+    """
+    global _worker_scorer, _worker_metrics
+    _worker_metrics = Metrics() if stats else NULL_METRICS
+    # Ctrl-C reaches the whole process group, the main process stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each process scores on a single thread, the pool already provides the parallelism
+    _worker_scorer = get_scorer(scorer)
+    if hasattr(_worker_scorer, "workers"):
+        _worker_scorer.workers = 1
 
 
 class AddressesMatcher:
-    def __init__(self, database, num_processes, verbose=False):
+    def __init__(self, database, num_processes, verbose=False, batch=False, chunk_size=64, scorer="rapidfuzz",
+                 cache=None, fts=True, fts_limit=100, index=None, metrics=None, max_tier=TIERS[-1], min_score=0,
+                 accept_score=None, dedup_size=1000000):
+        self.started = time.perf_counter()
         self.database = database
         self.verbose = verbose
         self.num_processes = num_processes
+        self.batch = batch
+        self.chunk_size = chunk_size
+        self.scorer = get_scorer(scorer)
+        self.cache = cache
+        # Number of distinct standardized addresses whose match is kept for their next duplicates, 0 to match
+        # every address
+        self.dedup_size = dedup_size
+        # Tiers of the match strategy tried, up to max_tier, and scores of its fuzzy tiers, see tiers.Strategy
+        self.strategy = Strategy(TIERS.index(max_tier) + 1, min_score, accept_score)
+        # Per-stage timers and counters, the workers send theirs with their results when enabled
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        # Shapes of candidates query whose plan was already printed in verbose mode
+        self.explained = set()
+        # A directory of department databases, each address is matched in the shard of its postal code
+        self.shards = list_shards(database)
+        if self.shards == {}:
+            raise ValueError("No department database in {}".format(database))
+        databases = list(self.shards.values()) if self.shards else [database]
+        # Look up the addresses missing a house number or postal code in the full-text index, when initdb built it,
+        # and read the labels and blocking keys materialized by prepare_database
+        self.fts_limit = fts_limit if fts else 0
+        self.precomputed = True
+        for path in databases:
+            conn = open_database(path)
+            try:
+                if self.fts_limit and not has_fts_index(conn):
+                    self.fts_limit = 0
+                    if verbose:
+                        print("[!] No full-text index in {}, run initdb again to build it".format(path))
+                if self.precomputed and not has_precomputed_columns(conn):
+                    self.precomputed = False
+                    if verbose:
+                        print("[!] No precomputed labels in {}, run initdb again to build them".format(path))
+            finally:
+                conn.close()
+        # The addresses keyed by a postal code are looked up in the address index file, mapped by every process
+        self.index_path = index
+        self.index = AddressIndex(index) if index else None
+        if self.index is not None and verbose:
+            print("[+] Address index {} mapped: {} addresses".format(index, len(self.index)))
+            for path in self.index.stale_databases():
+                print("[!] {} changed since the address index was built, run buildindex again".format(path))
+        # Cached matches are only valid for these database files, in this version, with this scorer and lookup
+        self.cache_namespace = "local {} {} {} {} {} {} {} {} {}".format(
+            Path(database).resolve(), " ".join(str(os.stat(path).st_mtime_ns) for path in databases), scorer,
+            self.fts_limit, self.precomputed, os.stat(index).st_mtime_ns if index else None, max_tier, min_score,
+            accept_score)
 
     @staticmethod
     def match_address(args):
         """
-        Match an address using thefuzz library to find the best match from a list of addresses.
+        Match a parsed address tier by tier with the worker's scorer, from one shard of the candidate addresses.
+
+        Candidates are fetched through the worker's own database connection, so only the parsed address and
+        the shard key (a database and a rowid range) cross the process boundary. Returns a tuple
+        (address, score, lat, lon, tier), or None if the shard holds no candidate.
+        """
+        parsed, query, database, rowid_range, fts_limit, precomputed, strategy = args
+        source = CandidateSource([worker_connection(database)], None, fts_limit, precomputed, rowid_range,
+                                 _worker_metrics)
+        return match_tiered([parsed], query, source, _worker_scorer, strategy, _worker_metrics)[0]
+
+    @staticmethod
+    def match_address_measured(args):
+        """
+        Run match_address and return its result with the metrics of the worker since its last task.
+        """
+        return AddressesMatcher.match_address(args), _worker_metrics.pop()
+
+    @staticmethod
+    def best_of(results):
+        """
+        Return the match of the lowest tier, the best scored among them, of the matches of the shards of an
+        address, the best scored rejected match if no shard matched it, or None.
         """
-        input_address, addresses = args
-        return process.extractOne(input_address, addresses)
+        results = [result for result in results if result is not None]
+        return min(results, key=lambda x: (TIERS.index(x[4]) if x[4] else len(TIERS), -x[1])) if results else None
 
     @staticmethod
     def standardize_address(address):
         """
-        Replace common abbreviations in the address string.
-        """
-        replacements = {
-            # Norme XP Z 10-011
-            "ALL": "ALLÉE",
-            "AV": "AVENUE",
-            "BD": "BOULEVARD",
-            "CTRE": "CENTRE",
-            "CCAL": "CENTRE COMMERCIAL",
-            "CHEM": "CHEMIN",
-            "IMM": "IMMEUBLE",
-            "IMM": "IMMEUBLES",
-            "IMP": "IMPASSE",
-            "LD": "LIEU-DIT",
-            "LOT": "LOTISSEMENT",
-            "PAS": "PASSAGE",
-            "PL": "PLACE",
-            "RES": "RÉSIDENCE",
-            "RPT": "ROND-POINT",
-            "RTE": "ROUTE",
-            "SENT": "SENTIER",
-            "SQ": "SQUARE",
-            "VLGE": "VILLAGE",
-            "ZA": "ZONE D’ACTIVITÉ",
-            "ZAC": "ZONE D’AMÉNAGEMENT CONCERTÉ",
-            "ZAD": "ZONE D’AMÉNAGEMENT DIFFÉRÉ",
-            "ZI": "ZONE INDUSTRIELLE",
-
-            # Norme XP Z 10-011
-            "ADJ": "ADJUDANT",
-            "AERD": "AÉRODROME",
-            "AERG": "AÉROGARE",
-            "AERN": "AÉORONAUTIQUE",
-            "AERP": "AÉROPORT",
-            "AGCE": "AGENCE",
-            "AGRIC": "AGRICOLE",
-            "ANC": "ANCIEN",
-            "ANC": "ANCIENNEMENT",
-            "APP": "APPARTEMENT",
-            "APP": "APPARTEMENTS",
-            "ARMT": "ARMEMENT",
-            "ARR": "ARRONDISSEMENT",
-            "ASP": "ASPIRANT",
-            "ASSOC": "ASSOCIATION",
-            "ASSUR": "ASSURANCE",
-            "AT": "ATELIER",
-            "BRQ": "BARAQUEMENT",
-            "BAS": "BAS",
-            "BAS": "BASSE",
-            "BAS": "BASSES",
-            "BTN": "BATAILLON",
-            "BTN": "BATAILLONS",
-            "BAT": "BÂTIMENT",
-            "BAT": "BÂTIMENTS",
-            "B": "BIS",
-            "BP": "BOITE POSTALE",
-            "CAB": "CABINET",
-            "CANT": "CANTON",
-            "CDL": "CARDINAL",
-            "CP": "CASE POSTALE",
-            "CHBR": "CHAMBRE",
-            "CTD": "CITADELLE",
-            "COLL": "COLLÈGE",
-            "CNL": "COLONEL",
-            "COLO": "COLONIE",
-            "CTE": "COMITÉ",
-            "CDT": "COMMANDANT",
-            "CIAL": "COMMERCIAL",
-            "COM": "COMMUNE",
-            "COM": "COMMUNEAL",
-            "COM": "COMMUNEAUX",
-            "CIE": "COMPAGNIE",
-            "COMP": "COMPAGNON",
-            "COMP": "COMPAGNONS",
-            "COOP": "COOPÉRATIVE",
-            "CS": "COURSE SPÉCIALE",
-            "CRX": "CROIX",
-            "DELEG": "DÉLÉGATION",
-            "DEP": "DÉPARTEMENTAL",
-            "DEP": "DÉPARTEMENTALAUX",
-            "DIR": "DIRECTEUR",
-            "DIR": "DIRECTEURCTION",
-            "DIV": "DIVISION",
-            "DR": "DOCTEUR",
-            "ECO": "ECONOMIE",
-            "ECO": "ECONOMIEQUE",
-            "ECRIV": "ECRIVAIN",
-            "ENST": "ENSEIGNEMENT",
-            "ENS": "ENSEMBLE",
-            "ENT": "ENTRÉE",
-            "ENT": "ENTRÉES",
-            "ENTR": "ENTREPRISE",
-            "EP": "EPOUX",
-            "EP": "EPOUSE",
-            "ETS": "ETABLISSEMENT",
-            "ETG": "ETAGE",
-            "EM": "ETAT MAJOR",
-            "EVQ": "EVÊQUE",
-            "FAC": "FACULTÉ",
-            "FOR": "FORÊT",
-            "FOR": "FORESTIER",
-            "FR": "FRANÇAIS",
-            "FR": "FRANÇAISE",
-            "FUS": "FUSILIER",
-            "GEND": "GENDARMERIE",
-            "GAL": "GÉNÉRAL",
-            "GOUV": "GOUVERNEMENTAL",
-            "GOU": "GOUVERNEUR",
-            "GD": "GRAND",
-            "GDE": "GRANDE",
-            "GDES": "GRANDES",
-            "GDS": "GRANDS",
-            "HT": "HAUT",
-            "HTE": "HAUTE",
-            "HTES": "HAUTES",
-            "HTS": "HAUTS",
-            "HOP": "HÔPITAL",
-            "HOP": "HÔPITAUX",
-            "HOSP": "HOSPICE",
-            "HOSP": "HOSPITALIER",
-            "HOT": "HÔTEL",
-            "INFANT": "INFANTERIE",
-            "INF": "INFÉRIEUR",
-            "INF": "INFÉRIEURE",
-            "ING": "INGÉNIEUR",
-            "INSP": "INSPECTEUR",
-            "INST": "INSTITUT",
-            "INTERN": "INTERNATIONAL",
-            "INTERN": "INTERNATIONALE",
-            "LABO": "LABORATOIRE",
-            "LT": "LIEUTENANT",
-            "LTDV": "LIEUTENANT DE VAISSEAU",
-            "MME": "MADAME",
-            "MLLE": "MADEMOISELLE",
-            "MAG": "MAGASIN",
-            "MAIS": "MAISON",
-            "ME": "MAÎTRE",
-            "MAL": "MARÉCHAL",
-            "MAR": "MARITIME",
-            "MED": "MÉDECIN",
-            "MED": "MÉDICAL",
-            "MMES": "MESDAMES",
-            "MLLES": "MESDEMOISELLES",
-            "MM": "MESSIEURS",
-            "MIL": "MILITAIRE",
-            "MIN": "MINISTÈRE",
-            "MGR": "MONSEIGNEUR",
-            "M": "MONSIEUR",
-            "MUN": "MUNICIPAL",
-            "MUT": "MUTUEL",
-            "NAL": "NATIONAL",
-            "ND": "NOTRE DAME",
-            "NOUV": "NOUVEAU",
-            "NOUV": "NOUVELLE",
-            "OBS": "OBSERVATOIRE",
-            "PAST": "PASTEUR",
-            "PT": "PETIT",
-            "PTE": "PETITE",
-            "PTES": "PETITES",
-            "PTS": "PETITS",
-            "POL": "POLICE",
-            "PREF": "PRÉFET",
-            "PREF": "PRÉFÉCTURE",
-            "PDT": "PRÉSIDENT",
-            "PR": "PROFESSEUR",
-            "PROF": "PROFESSIONEL",
-            "PROF": "PROFESSIONELE",
-            "PROL": "PROLONGÉ",
-            "PROL": "PROLONGÉE",
-            "PROP": "PROPRIÉTÉ",
-            "Q": "QUATER",
-            "C": "QUINQUIES",
-            "RECT": "RECTEUR",
-            "RGT": "RÉGIMENT",
-            "REG": "RÉGION",
-            "REG": "RÉGIONAL",
-            "REP": "RÉPUBLIQUE",
-            "REST": "RESTAURANT",
-            "ST": "SAINT",
-            "STE": "SAINTE",
-            "STES": "SAINTES",
-            "STS": "SAINTS",
-            "SANA": "SANATORIUM",
-            "SGT": "SERGENT",
-            "SCE": "SERVICE",
-            "SOC": "SOCIÉTÉ",
-            "SC": "SOUS COUVERT",
-            "SPREF": "SOUS-PRÉFET",
-            "SUP": "SUPÉRIEUR",
-            "SUP": "SUPÉRIEURE",
-            "SYND": "SYNDICAT",
-            "TECH": "TECHNICIEN",
-            "TECH": "TECHNIQUE",
-            "T": "TER",
-            "TSA": "TRI SERVICE ARRIVÉE",
-            "TUN": "TUNNEL",
-            "UNVT": "UNIVERSITAIRE",
-            "UNIV": "UNIVERSITÉ",
-            "VELOD": "VÉLODROME",
-            "VVE": "VEUVE",
-            "VIEL": "VIEILLE",
-            "VIEL": "VIEILLES",
-            "VX": "VIEUX",
-
-            # Added
-            "R": "RUE",
-        }
-
-        # Remove ","
-        address = address.replace(",", "").strip()
-        address = address.replace(";", "").strip()
-        address = address.replace(":", "").strip()
-
-        parts = address.split()
-        if len(parts) > 1:
-            n = 0
-            while n != len(parts):
-                if parts[n].upper() in replacements:
-                    for val in replacements:
-                        if parts[n].upper() == val:
-                            parts[n] = replacements[val].capitalize()
-                n = n + 1
-            standardized_address = ' '.join(parts)
-        else:
-            standardized_address = address
-        return standardized_address
+        Replace common abbreviations in the address string, see normalizer.normalize.
+        """
+        return normalize(address)
 
-    def geocode_addresses(self, input_file):
+    def explain(self, query, database):
         """
-        Geocode a list of addresses using multiple processes.
+        In verbose mode, print the query plan of each new shape of candidates query once.
         """
-        if self.verbose:
-            print("[+] Geocoding addresses...")
+        if not self.verbose or query.sql in self.explained:
+            return
+        self.explained.add(query.sql)
+        conn = open_database(database)
+        try:
+            print("[+] Query plan of candidates query:\n{}".format("\n".join(explain_query(conn, query))))
+        finally:
+            conn.close()
 
-        # Initialize the pool of worker processes once
-        pool = Pool(processes=self.num_processes)
+    def rowid_shards(self):
+        """
+        Split the rowids of the addresses table into one contiguous range per process.
+        """
+        conn = open_database(self.database)
+        try:
+            first_rowid, last_rowid = conn.execute("SELECT min(rowid), max(rowid) FROM addresses").fetchone()
+        finally:
+            conn.close()
+        if first_rowid is None:
+            return [(0, -1)]
+        size = (last_rowid - first_rowid) // self.num_processes + 1
+        return [(start, min(start + size - 1, last_rowid)) for start in range(first_rowid, last_rowid + 1, size)]
 
-        # Create a dictionary to store the best match for each input address
-        best_matches = {}
-        geocoded = {}
+    @classmethod
+    def geocode_address(cls, args):
+        """
+        Standardize, query and match a whole input address inside a worker process (batch mode), an address
+        already standardized is matched as is.
 
-        # Open database for requests
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
+        Returns a tuple (standardized_address, best_match) where best_match is (address, score, lat, lon, tier)
+        or None.
+        """
+        address_to_geocode, standardized, database, shards, fts_limit, precomputed, index, strategy = args
+        if standardized:
+            standardized_address = address_to_geocode
+        else:
+            start = _worker_metrics.clock()
+            standardized_address = cls.standardize_address(address_to_geocode)
+            _worker_metrics.add_time("standardize", start)
+        start = _worker_metrics.clock()
+        parsed = parse(standardized_address)
+        _worker_metrics.add_time("parse", start)
+        query = build_candidates_query(parsed, fts_limit, precomputed)
+        source = CandidateSource([worker_connection(path) for path in route_address(parsed.postal_code, database,
+                                                                                    shards)],
+                                 worker_index(index) if index else None, fts_limit, precomputed,
+                                 metrics=_worker_metrics)
+        return standardized_address, match_tiered([parsed], query, source, _worker_scorer, strategy,
+                                                  _worker_metrics)[0]
 
-        keywords = ['Allée', 'Avenue', 'Boulevard', 'Centre', 'Centre commercial', 'Chemin', 'Immeuble',
-                    'Immeubles', 'Impasse', 'Lieu-dit', 'Lieu dit', 'Lotissement', 'Passage', 'Place', 'Résidence',
-                    'Rond-point', 'Route', 'Sentier', 'Square', 'Village', 'Zone d’activité',
-                    'Zone d’aménagement concerté', 'Zone d’aménagement différé', 'Zone industrielle']
+    @classmethod
+    def geocode_address_measured(cls, args):
+        """
+        Run geocode_address and return its result with the metrics of the worker since its last task.
+        """
+        return cls.geocode_address(args), _worker_metrics.pop()
 
-        with open(input_file, "r") as addresses_to_geocode:
+    def iter_pool_results(self, results):
+        """
+        Yield the results of the pool, timing the wait for each one and merging the metrics sent by the workers
+        when enabled.
+        """
+        if not self.metrics.enabled:
+            yield from results
+            return
+        while True:
+            start = self.metrics.clock()
+            try:
+                result, snapshot = next(results)
+            except StopIteration:
+                return
+            self.metrics.add_time("pool_wait", start)
+            self.metrics.merge(snapshot)
+            yield result
 
-            # Process each address to geocode
-            for address_to_geocode in addresses_to_geocode:
+    @staticmethod
+    def read_rows(input_file):
+        """
+        Yield (row, address) for the non-empty, stripped lines of the input file, row being the line number
+        starting at 1.
+        """
+        with open(input_file, "r") as addresses_to_geocode:
+            for row, address_to_geocode in enumerate(addresses_to_geocode, 1):
                 address_to_geocode = address_to_geocode.strip()
                 if len(address_to_geocode) != 0:
-                    # Standardize the address before processing
-                    standardized_address = self.standardize_address(address_to_geocode)
-
-                    # Extract the starting number from the input address using regular expression
-                    starting_number_match = re.match(r'^\d+', standardized_address)
-                    starting_number = starting_number_match.group(0) if starting_number_match else None
-
-                    # Attempt to extract a 5-digit postal code from the input address
-                    postal_code_match = re.search(r'\b\d{5}\b', standardized_address)
-                    postal_code = postal_code_match.group(0) if postal_code_match else None
-
-                    # Determine if the first or second word is one of the keywords
-                    address_parts = standardized_address.split(maxsplit=2)  # Split into parts
-                    potential_keywords = [address_parts[0]]  # Assume first part is a keyword
-                    if starting_number and len(address_parts) > 1:
-                        # If the first part is a number, consider the second part as a keyword
-                        potential_keywords = [address_parts[1]]
-
-                    # Create a nom_afnor WHERE clause to match any entry starting with the keyword
-                    nom_afnor_clause = '1=1'  # Default to true if no keyword is matched
-                    for keyword in keywords:
-                        if keyword.upper() in standardized_address.upper():
-                            # Use the UPPER function to perform case-insensitive match
-                            nom_afnor_clause = f"nom_afnor LIKE '%{keyword.upper()}%"
-                            pattern_word = re.compile(r'\b(\w+)\b \d+')
-                            m = re.search(pattern_word, standardized_address)
-                            if m is not None:
-                                nom_afnor_clause = f"{nom_afnor_clause}{m.group(1).upper()}%'"
-                            else:
-                                nom_afnor_clause = f"{nom_afnor_clause}'"
-                            break  # Stop after the first match
-
-                    # If a starting number is found, include it in the SQL WHERE clause
-                    number_clause = f"numero = {starting_number}" if starting_number else "1=1"
-
-                    # If a postal code is found, include it in the SQL WHERE clause
-                    postal_code_clause = f"code_postal = {postal_code}" if postal_code else "1=1"
-
-                    # Combine the two clauses with an AND operator
-                    where_clause = f"{number_clause} AND {postal_code_clause} AND {nom_afnor_clause}"
-
-                    # Address query with consideration for "rep" values and the "where_clause"
-                    sqlquery = f"""SELECT CASE WHEN rep IS NOT NULL AND trim(rep) != '' THEN numero || ' ' || rep || ' ' 
-                    || nom_voie ELSE numero || ' ' || nom_voie END || ' ' || code_postal || ' ' || nom_commune AS address, 
-                    lat, lon FROM addresses WHERE {where_clause}"""
-                    cursor.execute(sqlquery)
-
-                    # Fetch the results including address, lat, and lon
-                    address_results = cursor.fetchall()
-                    addresses = [row[0] for row in address_results]
-                    address_lat_lon_map = {row[0]: (row[1], row[2]) for row in address_results}
-
-                    # Split the address list into chunks for each process
-                    chunks = [addresses[i::self.num_processes] for i in range(self.num_processes)]
-                    results = pool.map(self.match_address, [(standardized_address, chunk) for chunk in chunks])
-                    # Filter out None results
-                    results = [result for result in results if result is not None]
-
-                    # Find the best overall match from the results
-                    best_match = max(results, key=lambda x: x[1]) if results else None
-                    best_matches[standardized_address] = best_match
-
-                    # After finding the best match, get the lat and lon from the dictionary
-                    if best_match:
-                        matched_address, match_score = best_match
-                        lat, lon = address_lat_lon_map.get(matched_address, (None, None))
-                        if lat is not None and lon is not None:
-                            geocoded[matched_address] = "{}, {}".format(lat, lon)
-                            if self.verbose:
-                                print(
-                                    f'[+] Best match for "{standardized_address}"\t--->\t{matched_address} [{lat}, {lon}] with a score of {match_score}')
-                        else:
-                            if self.verbose:
-                                print(f'Coordinates for matched address "{matched_address}" not found.')
-                            pass
+                    yield row, address_to_geocode
+
+    @classmethod
+    def read_addresses(cls, input_file):
+        """
+        Yield the non-empty, stripped lines of the input file.
+        """
+        for _, address_to_geocode in cls.read_rows(input_file):
+            yield address_to_geocode
+
+    def iter_geocode_in_process(self, addresses, standardized=False):
+        """
+        Geocode the addresses in the current process and yield (standardized_address, best_match) in input order,
+        the addresses are standardized first unless they already are.
+
+        Addresses are read by chunks of chunk_size and grouped by candidate query, so each candidate block
+        is fetched once and scored against all its queries in a single call of the scorer.
+        """
+        connections = {}
+        try:
+            chunk = []
+            for address_to_geocode in addresses:
+                chunk.append(address_to_geocode)
+                if len(chunk) == self.chunk_size:
+                    yield from self.match_chunk(connections, chunk if standardized else self.standardize_chunk(chunk))
+                    chunk = []
+            if chunk:
+                yield from self.match_chunk(connections, chunk if standardized else self.standardize_chunk(chunk))
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    def standardize_chunk(self, addresses):
+        """
+        Standardize a chunk of addresses in a single call.
+        """
+        start = self.metrics.clock()
+        standardized_addresses = normalize_many(addresses)
+        self.metrics.add_time("standardize", start, calls=len(addresses))
+        return standardized_addresses
+
+    def match_chunk(self, connections, standardized_addresses):
+        """
+        Match a chunk of standardized addresses, scoring each candidate block against all the addresses sharing it.
+
+        The candidate block of a query gathers its candidates in every database the addresses are routed to,
+        connections holds the connection of each database opened so far.
+        """
+        start = self.metrics.clock()
+        parsed_addresses = parse_many(standardized_addresses)
+        self.metrics.add_time("parse", start, calls=len(parsed_addresses))
+        groups = {}
+        for position, parsed in enumerate(parsed_addresses):
+            query = build_candidates_query(parsed, self.fts_limit, self.precomputed)
+            databases = tuple(route_address(parsed.postal_code, self.database, self.shards))
+            groups.setdefault((query, databases), []).append(position)
+
+        best_matches = [None] * len(standardized_addresses)
+        for (query, databases), positions in groups.items():
+            # The addresses of a group share their query keys, hence their candidates in the address index
+            if self.index is None or not self.index.answers(parsed_addresses[positions[0]], self.fts_limit):
+                self.explain(query, databases[0])
+            for database in databases:
+                if database not in connections:
+                    connections[database] = count_sql_steps(open_database(database), self.metrics)
+            source = CandidateSource([connections[database] for database in databases], self.index, self.fts_limit,
+                                     self.precomputed, metrics=self.metrics)
+            matches = match_tiered([parsed_addresses[position] for position in positions], query, source,
+                                   self.scorer, self.strategy, self.metrics)
+            for position, best_match in zip(positions, matches):
+                best_matches[position] = best_match
+        return zip(standardized_addresses, best_matches)
+
+    def iter_matches(self, addresses, pool, standardized=False):
+        """
+        Geocode the addresses and yield (standardized_address, best_match) in input order, the addresses are
+        standardized first unless standardized is set.
+
+        In batch mode whole addresses are streamed to the workers in chunks of chunk_size, otherwise the
+        candidates of each address are split across the workers and matched before reading the next line.
+        Without a pool, the addresses are matched in the current process by the multi-threaded scorer.
+        """
+        if pool is None:
+            yield from self.iter_geocode_in_process(addresses, standardized)
+            return
+
+        if self.batch:
+            # Submit a bounded window of lines at a time so the pool never buffers the whole file,
+            # imap keeps the input order while the workers stream through their chunks
+            window_size = self.chunk_size * self.num_processes * 4
+            geocode = self.geocode_address_measured if self.metrics.enabled else self.geocode_address
+            window = []
+            for address_to_geocode in addresses:
+                window.append((address_to_geocode, standardized, self.database, self.shards, self.fts_limit,
+                               self.precomputed, self.index_path, self.strategy))
+                if len(window) == window_size:
+                    yield from self.iter_pool_results(pool.imap(geocode, window, chunksize=self.chunk_size))
+                    window = []
+            if window:
+                yield from self.iter_pool_results(pool.imap(geocode, window, chunksize=self.chunk_size))
+            return
+
+        # Split a single table into one rowid range per process, the indexes carry the rowid so each
+        # worker only visits its own part of the candidate rows
+        rowid_shards = None if self.shards else self.rowid_shards()
+        match = self.match_address_measured if self.metrics.enabled else self.match_address
+
+        for address_to_geocode in addresses:
+            # Standardize the address before processing
+            if standardized:
+                standardized_address = address_to_geocode
+            else:
+                start = self.metrics.clock()
+                standardized_address = self.standardize_address(address_to_geocode)
+                self.metrics.add_time("standardize", start)
+            start = self.metrics.clock()
+            parsed = parse(standardized_address)
+            self.metrics.add_time("parse", start)
+            query = build_candidates_query(parsed, self.fts_limit, self.precomputed)
+            # A lookup in the address index is cheaper than a round trip to the pool
+            if self.index is not None and self.index.answers(parsed, self.fts_limit):
+                source = CandidateSource([], self.index, self.fts_limit, self.precomputed, metrics=self.metrics)
+                yield standardized_address, match_tiered([parsed], query, source, self.scorer, self.strategy,
+                                                         self.metrics)[0]
+                continue
+            databases = route_address(parsed.postal_code, self.database, self.shards)
+            self.explain(query, databases[0])
+
+            # Each process matches the candidates of its own shard: a department database, or a rowid range
+            # of a single database. A selective query is cheaper to run once on the whole table than to split
+            # across the processes.
+            if rowid_shards is None or query.selective:
+                tasks = [(parsed, query, database, WHOLE_TABLE, self.fts_limit, self.precomputed, self.strategy)
+                         for database in databases]
+            else:
+                tasks = [(parsed, query, self.database, shard, self.fts_limit, self.precomputed, self.strategy)
+                         for shard in rowid_shards]
+            start = self.metrics.clock()
+            results = pool.map(match, tasks)
+            self.metrics.add_time("pool_wait", start)
+            if self.metrics.enabled:
+                for _, snapshot in results:
+                    self.metrics.merge(snapshot)
+                results = [result for result, _ in results]
+            # Find the best overall match from the results
+            yield standardized_address, self.best_of(results)
+
+    def iter_unique_matches(self, addresses, pool):
+        """
+        Geocode the addresses and yield (standardized_address, best_match) in input order, each distinct
+        standardized address being matched once.
+
+        The addresses are standardized by windows, the distinct addresses of a window missing from the matches
+        kept so far are matched together, and the match of each address of the window is fanned out to its
+        duplicates. Addresses are told apart like the keys of the result cache, regardless of case and spacing.
+        The matches of the last dedup_size distinct addresses are kept for the next windows.
+        """
+        if not self.dedup_size:
+            yield from self.iter_matches(addresses, pool)
+            return
+
+        window_size = max(1000, self.chunk_size * self.num_processes * 4)
+        # Folded standardized address -> best_match, least recently used first
+        matches = {}
+        window = []
+        for address_to_geocode in addresses:
+            window.append(address_to_geocode)
+            if len(window) == window_size:
+                yield from self.match_unique_window(window, matches, pool)
+                window = []
+        if window:
+            yield from self.match_unique_window(window, matches, pool)
+
+    def match_unique_window(self, window, matches, pool):
+        """
+        Yield the match of each address of the window, matching only the distinct addresses missing from matches.
+        """
+        standardized_addresses = self.standardize_chunk(window)
+        keys = [fold_address(standardized_address) for standardized_address in standardized_addresses]
+        # Folded address -> the first standardized address of the window folded to it
+        unique = {}
+        for key, standardized_address in zip(keys, standardized_addresses):
+            if key not in matches and key not in unique:
+                unique[key] = standardized_address
+        self.metrics.count("duplicates", len(window) - len(unique))
+        for key, (_, best_match) in zip(unique, self.iter_matches(iter(unique.values()), pool, standardized=True)):
+            matches[key] = best_match
+        for key, standardized_address in zip(keys, standardized_addresses):
+            # Move the match to the end, as the most recently used
+            best_match = matches[key] = matches.pop(key)
+            yield standardized_address, best_match
+        while len(matches) > self.dedup_size:
+            del matches[next(iter(matches))]
+
+    def iter_cached_matches(self, addresses, pool):
+        """
+        Yield (standardized_address, best_match) for the addresses in input order, only the addresses missing
+        from the cache are matched, the new matches are stored in the cache.
+        """
+        if self.cache is None:
+            yield from self.iter_unique_matches(addresses, pool)
+            return
+
+        # Look the addresses up by windows, the misses of a window are matched together
+        window_size = max(1000, self.chunk_size * self.num_processes * 4)
+        window = []
+        for address_to_geocode in addresses:
+            cached = self.cache.get(self.cache_namespace, address_to_geocode)
+            self.metrics.count("cache_hits" if cached is not None else "cache_misses")
+            window.append((address_to_geocode, cached))
+            if len(window) == window_size:
+                yield from self.match_window(window, pool)
+                window = []
+        if window:
+            yield from self.match_window(window, pool)
+
+    def match_window(self, window, pool):
+        """
+        Yield the cached match of each (address, cached) of the window, or its newly computed and cached match.
+        """
+        matches = self.iter_unique_matches((address for address, cached in window if cached is None), pool)
+        for address_to_geocode, cached in window:
+            if cached is not None:
+                yield cached
+            else:
+                standardized_address, best_match = next(matches)
+                self.cache.set(self.cache_namespace, address_to_geocode, (standardized_address, best_match))
+                yield standardized_address, best_match
+        matches.close()
+
+    def start_pool(self):
+        """
+        Start the pool of num_processes worker processes, each one with its own scorer and database connections.
+        """
+        return Pool(processes=self.num_processes, initializer=init_worker,
+                    initargs=(self.scorer.name, self.metrics.enabled))
+
+    def iter_geocoded(self, input_file):
+        """
+        Geocode the addresses of the input file using multiple processes and yield, in input order,
+        a tuple (row, standardized_address, matched_address, score, lat, lon, tier) for each address, row being
+        its line number in the input file and tier the tier of the match strategy which matched it, see
+        tiers.TIERS. An unmatched address has no matched address, coordinates nor tier, with the score of its best
+        rejected candidate if it has one.
+
+        Each worker opens the BAN database once at pool initialization, so only the addresses
+        (and the shard keys) are sent to the pool. With a single process no pool is started.
+        """
+        if self.verbose:
+            print("[+] Geocoding addresses...")
+        start = time.perf_counter()
+        count = 0
+        # Number of addresses matched by each tier
+        tiers = dict.fromkeys(TIERS, 0)
+
+        # Initialize the pool of worker processes once, each one with its own database connection,
+        # a single process matches in place and lets the scorer use its own threads
+        pool = self.start_pool() if self.num_processes > 1 else None
+
+        # Rows of the addresses read and not yielded yet, the matches come back in input order
+        rows = deque()
+
+        def read_addresses():
+            for row, address_to_geocode in self.read_rows(input_file):
+                rows.append(row)
+                yield address_to_geocode
+
+        try:
+            for standardized_address, best_match in self.iter_cached_matches(read_addresses(), pool):
+                row = rows.popleft()
+                count += 1
+                if count == 1 and self.verbose:
+                    print(f"[+] First result {time.perf_counter() - self.started:.2f}s after startup")
+                self.metrics.count("addresses")
+                if best_match and best_match[4]:
+                    matched_address, match_score, lat, lon, tier = best_match
+                    tiers[tier] += 1
+                    self.metrics.count("matched")
+                    self.metrics.count("tier_" + tier)
+                    self.metrics.observe_score(match_score)
+                    if lat is not None and lon is not None:
+                        if self.verbose:
+                            print(f'[+] Best match for "{standardized_address}"\t--->\t{matched_address} '
+                                  f'[{lat}, {lon}] with a score of {match_score} ({tier})')
                     else:
                         if self.verbose:
-                            print(f'No match found for "{standardized_address}".')
-                        pass
+                            print(f'Coordinates for matched address "{matched_address}" not found.')
+                    yield row, standardized_address, matched_address, match_score, lat, lon, tier
+                elif best_match:
+                    self.metrics.count("rejected")
+                    if self.verbose:
+                        print(f'No match found for "{standardized_address}", its best candidate "{best_match[0]}" '
+                              f'has a score of {best_match[1]}.')
+                    yield row, standardized_address, None, best_match[1], None, None, None
                 else:
-                    pass
+                    if self.verbose:
+                        print(f'No match found for "{standardized_address}".')
+                    yield row, standardized_address, None, None, None, None, None
+        except BaseException:
+            # Stop the workers right away on error or when the consumer stops early
+            if pool is not None:
+                pool.terminate()
+            raise
+
+        if self.verbose:
+            self.report_memory(pool)
 
-            # Close the pool of worker processes after processing all addresses
+        # Close the pool of worker processes after processing all addresses
+        if pool is not None:
             pool.close()
             pool.join()
 
-            # Now it's safe to close the database connection
-            conn.close()
-            return geocoded
+        if self.verbose:
+            elapsed = time.perf_counter() - start
+            print(f"[+] {count} addresses geocoded in {elapsed:.2f}s "
+                  f"({count / elapsed if elapsed else 0:.1f} addresses/s)")
+            if count:
+                rates = [f"{tier} {hits / count:.1%}" for tier, hits in tiers.items()]
+                rates.append(f"unmatched {(count - sum(tiers.values())) / count:.1%}")
+                print("[+] Hit rate of the tiers: " + ", ".join(rates))
+
+    @staticmethod
+    def report_memory(pool):
+        """
+        Print the resident memory of the current process and of the workers of the pool, with the part of it
+        mapped from files (the address index and the databases pages), which the processes share.
+        """
+        processes = [("Main process", os.getpid())]
+        # Pool has no public list of its workers
+        processes += [("Worker", worker.pid) for worker in getattr(pool, "_pool", [])]
+        for name, pid in processes:
+            memory = process_memory(pid)
+            if memory is not None:
+                print(f"[+] {name} {pid}: RSS {memory['rss'] / 1e6:.1f} MB, "
+                      f"{memory['file'] / 1e6:.1f} MB mapped from files")
+
+    def geocode_addresses(self, input_file):
+        """
+        Geocode a list of addresses using multiple processes.
+
+        Returns a dictionary mapping the row of each address, its line number in the input file, to its matched
+        address, its "lat, lon" coordinates and its score. An unmatched address has no matched address nor
+        coordinates, with the score of its best rejected candidate if it has one.
+        """
+        geocoded = {}
+        for row, _, matched_address, score, lat, lon, _ in self.iter_geocoded(input_file):
+            coordinates = "{}, {}".format(lat, lon) if lat is not None and lon is not None else None
+            geocoded[row] = matched_address, coordinates, score
+        return geocoded
@@ -0,0 +1,546 @@
+import csv
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .addresses_matcher import AddressesMatcher, open_database
+from .database import build_fts_index, import_csv_to_sqlite, prepare_database
+from .exporter import export_batches, iter_batches
+from .normalizer import ABBREVIATIONS as NORMALIZER_ABBREVIATIONS, fold, normalize, normalize_many
+from .parser import parse
+from .query import CANDIDATES_QUERY, LABEL_EXPRESSION, build_candidates_query, fetch_candidates
+from .scorers import SCORERS, get_scorer
+from .tiers import TIERS
+from .utils import process_memory, reset_peak_memory
+
+# Street types written the way they usually come in input files
+ABBREVIATIONS = {
+    "Avenue": "av",
+    "Boulevard": "bd",
+    "Impasse": "imp",
+    "Place": "pl",
+    "Route": "rte",
+    "Chemin": "chem",
+}
+
+# Modules a single geo lookup should not import, reported by the startup benchmark when they are
+HEAVY_MODULES = ['pandas', 'numpy', 'rapidfuzz', 'thefuzz', 'multiprocessing']
+
+# Response of the geocoding API stub used by the startup benchmark
+STUB_RESPONSE = {
+    "type": "FeatureCollection",
+    "features": [{
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [2.316931, 48.87063]},
+        "properties": {"label": "55 Rue du Faubourg Saint-Honoré 75008 Paris", "score": 0.97, "housenumber": "55",
+                       "postcode": "75008", "citycode": "75108", "city": "Paris", "type": "housenumber"},
+    }],
+}
+
+# Columns of a BAN datasheet, in order
+BAN_COLUMNS = ['id', 'id_fantoir', 'numero', 'rep', 'nom_voie', 'code_postal', 'code_insee', 'nom_commune',
+               'code_insee_ancienne_commune', 'nom_ancienne_commune', 'x', 'y', 'lon', 'lat', 'type_position', 'alias',
+               'nom_ld', 'libelle_acheminement', 'nom_afnor', 'source_position', 'source_nom_voie',
+               'certification_commune', 'cad_parcelles']
+
+# Vocabulary of the synthetic BAN: departments with a rough center, city names and street names
+SYNTHETIC_DEPARTMENTS = [('01', 46.1, 5.3), ('13', 43.5, 5.1), ('21', 47.3, 4.8), ('2A', 41.9, 8.9),
+                         ('31', 43.4, 1.3), ('33', 44.8, -0.6), ('44', 47.3, -1.7), ('59', 50.5, 3.2),
+                         ('69', 45.8, 4.7), ('75', 48.86, 2.35)]
+SYNTHETIC_CITY_PREFIXES = ['', '', '', 'Saint-', 'Sainte-', 'Le ', 'La ', 'Les ']
+SYNTHETIC_CITY_ROOTS = ['Martin', 'Germain', 'Laurent', 'Julien', 'Châtillon', 'Pouilly', 'Savigny', 'Montigny',
+                        'Villeneuve', 'Beaumont', 'Fontaine', 'Bourg', 'Mesnil', 'Vaux', 'Chassagne', 'Marcilly']
+SYNTHETIC_CITY_SUFFIXES = ['', '', '-sur-Seine', '-le-Sec', '-en-Auxois', '-les-Bains', '-sur-Mer', '-la-Forêt']
+SYNTHETIC_STREET_TYPES = ['Rue', 'Rue', 'Rue', 'Avenue', 'Boulevard', 'Place', 'Impasse', 'Chemin', 'Allée',
+                          'Route', 'Passage', 'Square']
+SYNTHETIC_STREET_NAMES = ['Victor Hugo', 'Jean Jaurès', 'Pasteur', 'de la Gare', 'du Moulin', 'des Écoles',
+                          "de l'Église", 'Gambetta', 'de la République', 'du Général de Gaulle', 'des Lilas',
+                          'des Tilleuls', 'du Château', 'de la Fontaine', 'Voltaire', 'Jules Ferry', 'de la Paix',
+                          'du Stade', 'des Acacias', 'Saint-Exupéry', 'Claude Petiet', 'de Velars', 'Thiers',
+                          'de la Mare', 'du Faubourg Saint-Honoré', 'des Vignes', 'du Lavoir', 'Carnot']
+
+# Entry point of the command line, next to the geocoder directory
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ban_geocoder.py')
+
+
+def add_noise(address, rng):
+    """
+    Return a noisy variant of a BAN address: abbreviated street type, dropped postal code, a typo, lower case.
+    """
+    for word, abbreviation in ABBREVIATIONS.items():
+        if word in address and rng.random() < 0.5:
+            address = address.replace(word, abbreviation)
+    parts = address.split()
+    if len(parts) > 3 and rng.random() < 0.2:
+        parts = [part for part in parts if not (part.isdigit() and len(part) == 5)]
+    if rng.random() < 0.3:
+        position = rng.randrange(len(parts))
+        word = parts[position]
+        if len(word) > 3:
+            i = rng.randrange(len(word) - 1)
+            parts[position] = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    address = ' '.join(parts)
+    return address.lower() if rng.random() < 0.5 else address
+
+
+def benchmark_scorers(database, department=None, sample_size=200, seed=0, verbose=False):
+    """
+    Compare the fuzzy scoring backends on the same candidate blocks of a local BAN database.
+
+    Parameters:
+    - database (str): The file path of the SQLite database containing the BAN data.
+    - department (str): Restrict the sample to the addresses of a department (e.g. '21'), None for all.
+    - sample_size (int): The number of BAN addresses turned into noisy queries.
+    - seed (int): Seed of the random generator, the same seed gives the same queries.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - results (dict): Per scorer, the number of queries, the total number of candidates scored, the time
+                      spent, the throughput and the agreement with thefuzz best matches.
+    """
+    rng = random.Random(seed)
+    conn = open_database(database)
+    try:
+        department_clause = "substr(printf('%05d', code_postal), 1, 2) = ?" if department else "1=1"
+        rows = conn.execute(f"""SELECT rowid FROM addresses WHERE {department_clause}""",
+                            (department,) if department else ()).fetchall()
+        rowids = rng.sample([row[0] for row in rows], min(sample_size, len(rows)))
+        first_rowid, last_rowid = conn.execute("SELECT min(rowid), max(rowid) FROM addresses").fetchone()
+
+        # Fetch every candidate block once, so only the scoring is timed
+        blocks = []
+        for rowid in rowids:
+            label = conn.execute(CANDIDATES_QUERY.format(label=LABEL_EXPRESSION.format(table=""),
+                                                         where_clause="rowid = ?", rowid="rowid"),
+                                 (rowid, first_rowid, last_rowid)).fetchone()[0]
+            query = AddressesMatcher.standardize_address(add_noise(label, rng))
+            candidates = [row[0] for row in fetch_candidates(conn, build_candidates_query(parse(query)),
+                                                             first_rowid, last_rowid)]
+            blocks.append((query, label, candidates))
+    finally:
+        conn.close()
+
+    if verbose:
+        print(f"[+] {len(blocks)} queries, {sum(len(block[2]) for block in blocks)} candidates to score")
+
+    results = {}
+    reference = None
+    for name in SCORERS:
+        scorer = get_scorer(name)
+        start = time.perf_counter()
+        best_matches = [scorer.extract_one(query, candidates) for query, _, candidates in blocks]
+        elapsed = time.perf_counter() - start
+        matched = [best_match[0] if best_match else None for best_match in best_matches]
+        if reference is None:
+            reference = matched
+        results[name] = {
+            "queries": len(blocks),
+            "candidates": sum(len(block[2]) for block in blocks),
+            "seconds": round(elapsed, 4),
+            "queries_per_second": round(len(blocks) / elapsed, 1) if elapsed else None,
+            "accuracy": round(sum(m == block[1] for m, block in zip(matched, blocks)) / len(blocks), 4)
+            if blocks else None,
+            "agreement_with_thefuzz": round(sum(a == b for a, b in zip(matched, reference)) / len(blocks), 4)
+            if blocks else None,
+        }
+        if verbose:
+            print(f"[+] {name}: {results[name]['queries_per_second']} queries/s")
+    return results
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answer every GET with STUB_RESPONSE, so the startup of the geo command is measured without the network.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps(STUB_RESPONSE).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_importtime(stderr):
+    """
+    Parse the report of python -X importtime, leaving out the modules imported by the interpreter startup (site).
+
+    Returns:
+    - imports (dict): The cumulative import time in microseconds of each module, and of 'total', the sum of the
+      top-level imports.
+    """
+    imports = {}
+    pending = {}
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        pending[name.strip()] = int(cumulative)
+        # A top-level import is not indented, and comes after the modules it imported
+        if not name[1:].startswith(' '):
+            if name.strip() != 'site':
+                imports.update(pending)
+                total += int(cumulative)
+            pending = {}
+    imports['total'] = total
+    return imports
+
+
+def benchmark_startup(runs=10, budget=200, verbose=False):
+    """
+    Measure the startup of the command line with python -X importtime: --help, and a geo lookup against a local
+    stub of the geocoding API.
+
+    Parameters:
+    - runs (int): The number of runs of each command, the median is reported.
+    - budget (float): The maximum median import time in milliseconds of each command.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - results (dict): Per command, the median wall time and import time in milliseconds, the heavy modules
+                      imported, the slowest imports and whether the import time is within the budget.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    commands = {
+        "help": ['--help'],
+        "geo": ['geo', '-a', '55 rue Faubourg Saint-Honoré', '--api-url', f'http://127.0.0.1:{server.server_port}'],
+    }
+    results = {}
+    try:
+        for name, args in commands.items():
+            walls, totals = [], []
+            imports = {}
+            for _ in range(runs):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT] + args, capture_output=True,
+                                         text=True)
+                walls.append(time.perf_counter() - start)
+                if process.returncode != 0:
+                    raise RuntimeError(f"{' '.join(args)} failed: {process.stderr.strip().splitlines()[-1:]}")
+                imports = parse_importtime(process.stderr)
+                totals.append(imports.pop('total'))
+            import_ms = statistics.median(totals) / 1000
+            results[name] = {
+                "runs": runs,
+                "wall_ms": round(statistics.median(walls) * 1000, 1),
+                "import_ms": round(import_ms, 1),
+                "heavy_modules": [module for module in HEAVY_MODULES if module in imports],
+                "slowest_imports": {module: round(cumulative / 1000, 1) for module, cumulative in
+                                    sorted(imports.items(), key=lambda item: -item[1])[:5]},
+                "within_budget": import_ms <= budget,
+            }
+            if verbose:
+                print(f"[+] {name}: {results[name]['wall_ms']} ms, imports {results[name]['import_ms']} ms")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def write_synthetic_ban(path, size, seed=0):
+    """
+    Write a deterministic BAN-shaped CSV datasheet of synthetic addresses: cities of a few departments, each with
+    streets numbered from 1, some numbers with a "bis" or "ter", coordinates around the department center.
+
+    Parameters:
+    - path (str): The file path of the CSV.
+    - size (int): The number of addresses.
+    - seed (int): Seed of the random generator, the same seed and size give the same file.
+
+    Returns:
+    - count (int): The number of addresses written.
+    """
+    rng = random.Random(seed)
+    count = 0
+    cities = set()
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(BAN_COLUMNS)
+        while count < size:
+            department, center_lat, center_lon = rng.choice(SYNTHETIC_DEPARTMENTS)
+            city = (rng.choice(SYNTHETIC_CITY_PREFIXES) + rng.choice(SYNTHETIC_CITY_ROOTS) +
+                    rng.choice(SYNTHETIC_CITY_SUFFIXES))
+            postal_code = '{}{:03d}'.format(department.replace('A', '0').replace('B', '0'), rng.randrange(1000))
+            if (city, postal_code) in cities:
+                continue
+            cities.add((city, postal_code))
+            insee = '{}{:03d}'.format(department, len(cities) % 1000)
+            city_lat, city_lon = center_lat + rng.uniform(-0.5, 0.5), center_lon + rng.uniform(-0.5, 0.5)
+            streets = {rng.choice(SYNTHETIC_STREET_TYPES) + ' ' + rng.choice(SYNTHETIC_STREET_NAMES)
+                       for _ in range(rng.randint(3, 30))}
+            for street_number, street in enumerate(sorted(streets), start=1):
+                for numero in range(1, rng.randint(2, 80)):
+                    if count == size:
+                        break
+                    rep = rng.choice(['bis', 'ter']) if rng.random() < 0.05 else ''
+                    count += 1
+                    writer.writerow([f"{insee}_{street_number:04d}_{numero:05d}{'_' + rep if rep else ''}", '',
+                                     numero, rep, street, postal_code, insee, city, '', '', '', '',
+                                     round(city_lon + rng.uniform(-0.02, 0.02), 6),
+                                     round(city_lat + rng.uniform(-0.02, 0.02), 6), 'entrée', '', '',
+                                     fold(city), fold(street), 'commune', 'commune', 1, ''])
+    return count
+
+
+def build_synthetic_database(directory, size, seed=0, verbose=False):
+    """
+    Build a synthetic BAN database with the import, index and full-text index steps of initdb, or reuse the one
+    of the same size and seed already built in the directory.
+
+    Returns:
+    - database (str): The file path of the database.
+    - timings (dict): The seconds spent in each step, empty if the database was reused.
+    """
+    database = os.path.join(directory, f"synthetic-{size}-{seed}.db")
+    if os.path.exists(database):
+        return database, {}
+    csv_path = os.path.join(directory, f"synthetic-{size}-{seed}.csv")
+    temporary = database + '.tmp.db'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    timings = {}
+    start = time.perf_counter()
+    write_synthetic_ban(csv_path, size, seed)
+    timings['generate_s'] = time.perf_counter() - start
+    try:
+        start = time.perf_counter()
+        import_csv_to_sqlite(csv_path, temporary, "addresses", separator=';', verbose=verbose, chunksize=10000)
+        timings['import_s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        prepare_database(temporary, verbose=verbose)
+        timings['prepare_s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        build_fts_index(temporary, verbose=verbose)
+        timings['fts_s'] = time.perf_counter() - start
+        os.replace(temporary, database)
+    finally:
+        os.remove(csv_path)
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return database, {step: round(seconds, 3) for step, seconds in timings.items()}
+
+
+def percentiles(values):
+    """
+    Return the p50, p95 and p99 of a list of values.
+    """
+    if len(values) < 2:
+        return {"p50": values[0] if values else None, "p95": values[0] if values else None,
+                "p99": values[0] if values else None}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def benchmark_local(size=100000, queries=2000, processes=(1, 2, 4), batch=True, chunk_size=64, scorer="rapidfuzz",
+                    seed=0, work_dir=None, verbose=False):
+    """
+    Benchmark the local matcher on a synthetic BAN database and noisy addresses of it, for several numbers of
+    processes.
+
+    The database is built with the steps of initdb, the input file holds noisy variants of sampled addresses
+    (abbreviated street types, missing postal codes, typos, lower case) whose source address is the expected
+    match. The latency of an address runs from the read of its line to its result, queueing included.
+
+    Parameters:
+    - size (int): The number of addresses of the synthetic database.
+    - queries (int): The number of noisy addresses to match.
+    - processes (list): The numbers of processes benchmarked.
+    - batch (bool): Distribute whole addresses to the processes instead of splitting each address candidates.
+    - chunk_size (int): The number of addresses sent to a process at once in batch mode.
+    - scorer (str): The fuzzy scoring backend, 'rapidfuzz' or 'thefuzz'.
+    - seed (int): Seed of the random generator, the same seed gives the same database and addresses.
+    - work_dir (str): The directory keeping the synthetic database between runs, None for a temporary one.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - results (dict): The environment, the fixture with its build timings, and per number of processes the
+                      throughput, the latency percentiles in milliseconds, the peak resident memory in MB and
+                      the accuracy, and the share of the addresses matched by each tier of the match strategy.
+    """
+    directory = work_dir or tempfile.mkdtemp(prefix='ban-bench-')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        database, timings = build_synthetic_database(directory, size, seed, verbose=verbose)
+        if verbose:
+            print(f"[+] Synthetic database {database}" + (" reused" if not timings else f" built: {timings}"))
+
+        # Noisy variants of sampled addresses, the expected match is the address they come from
+        rng = random.Random(seed)
+        conn = open_database(database)
+        try:
+            labels = [row[0] for row in conn.execute("SELECT label FROM addresses ORDER BY rowid")]
+        finally:
+            conn.close()
+        expected = rng.sample(labels, min(queries, len(labels)))
+        input_file = os.path.join(directory, f"synthetic-{size}-{seed}-{len(expected)}.txt")
+        with open(input_file, 'w', encoding='utf-8') as f:
+            f.writelines(add_noise(label, rng) + '\n' for label in expected)
+
+        runs = []
+        records = []
+        for count in processes:
+            matcher = AddressesMatcher(database=database, num_processes=count, batch=batch, chunk_size=chunk_size,
+                                       scorer=scorer)
+            reset_peak_memory(os.getpid())
+            pool = matcher.start_pool() if count > 1 else None
+            read_times = []
+
+            def read_addresses():
+                for address in matcher.read_addresses(input_file):
+                    read_times.append(time.perf_counter())
+                    yield address
+
+            latencies = []
+            matches = []
+            try:
+                start = time.perf_counter()
+                for position, (_, best_match) in enumerate(matcher.iter_matches(read_addresses(), pool)):
+                    latencies.append(time.perf_counter() - read_times[position])
+                    matches.append(best_match)
+                elapsed = time.perf_counter() - start
+                workers = [process_memory(worker.pid) for worker in getattr(pool, "_pool", [])]
+                main = process_memory(os.getpid())
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+            if not records:
+                records = [{'Address': best_match[0], 'Latitude': best_match[2], 'Longitude': best_match[3]}
+                           for best_match in matches if best_match is not None and best_match[4]]
+            run = {
+                "processes": count,
+                "addresses": len(matches),
+                "seconds": round(elapsed, 3),
+                "addresses_per_second": round(len(matches) / elapsed, 1) if elapsed else None,
+                "latency_ms": {name: round(value * 1000, 3) for name, value in percentiles(latencies).items()
+                               if value is not None},
+                "peak_rss_mb": {
+                    "main": round(main['peak'] / 1e6, 1) if main else None,
+                    "workers": round(sum(worker['peak'] for worker in workers if worker) / 1e6, 1),
+                },
+                "matched": round(sum(best_match is not None and best_match[4] is not None
+                                     for best_match in matches) / len(matches), 4)
+                if matches else None,
+                "accuracy": round(sum(best_match is not None and best_match[4] is not None and best_match[0] == label
+                                      for best_match, label in zip(matches, expected)) / len(matches), 4)
+                if matches else None,
+                "tiers": {tier: round(sum(best_match is not None and best_match[4] == tier
+                                          for best_match in matches) / len(matches), 4) for tier in TIERS}
+                if matches else None,
+            }
+            runs.append(run)
+            if verbose:
+                print(f"[+] {count} processes: {run['addresses_per_second']} addresses/s, "
+                      f"p99 {run['latency_ms'].get('p99')} ms, accuracy {run['accuracy']}")
+
+        # Export of the results of the first run, as the local command does
+        output_csv = os.path.join(directory, "results.csv")
+        start = time.perf_counter()
+        export_batches(iter_batches(iter(records), 1000), output_csv=output_csv, output_db=None, table="data",
+                       mode="replace", header=True, index=False, verbose=False)
+        export_seconds = round(time.perf_counter() - start, 3)
+        os.remove(output_csv)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "environment": {"python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version, "cpus": os.cpu_count()},
+        "fixture": {"size": size, "queries": len(expected), "seed": seed, "batch": batch, "chunk_size": chunk_size,
+                    "scorer": scorer, "build": timings, "export_s": export_seconds},
+        "runs": runs,
+    }
+
+
+def legacy_standardize(address):
+    """
+    The standardization of the addresses before the normalizer module, the reference of the normalize benchmark:
+    the table of the abbreviations is built at each call and each word is compared to all of them.
+    """
+    replacements = dict(NORMALIZER_ABBREVIATIONS)
+    address = address.replace(",", "").strip()
+    address = address.replace(";", "").strip()
+    address = address.replace(":", "").strip()
+    parts = address.split()
+    if len(parts) <= 1:
+        return address
+    for n in range(len(parts)):
+        if parts[n].upper() in replacements:
+            for val in replacements:
+                if parts[n].upper() == val:
+                    parts[n] = replacements[val].capitalize()
+    return ' '.join(parts)
+
+
+def synthetic_addresses(count, seed=0):
+    """
+    Return noisy addresses built from the vocabulary of the synthetic BAN, without a database.
+    """
+    rng = random.Random(seed)
+    addresses = []
+    for _ in range(count):
+        department = rng.choice(SYNTHETIC_DEPARTMENTS)[0].replace('A', '0').replace('B', '0')
+        label = "{} {} {} {}{:03d} {}{}{}".format(
+            rng.randint(1, 120), rng.choice(SYNTHETIC_STREET_TYPES), rng.choice(SYNTHETIC_STREET_NAMES), department,
+            rng.randrange(1000), rng.choice(SYNTHETIC_CITY_PREFIXES), rng.choice(SYNTHETIC_CITY_ROOTS),
+            rng.choice(SYNTHETIC_CITY_SUFFIXES))
+        addresses.append(add_noise(label, rng))
+    return addresses
+
+
+def benchmark_normalize(sample_size=10000, seed=0, verbose=False):
+    """
+    Measure the cost per address of the normalization of the input addresses: the legacy standardization,
+    normalize, normalize_many and fold.
+
+    Parameters:
+    - sample_size (int): The number of noisy addresses normalized.
+    - seed (int): Seed of the random generator, the same seed gives the same addresses.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - results (dict): Per function, the time per address in microseconds, the throughput and the agreement of
+                      its results with the legacy standardization.
+    """
+    addresses = synthetic_addresses(sample_size, seed)
+    functions = {
+        "legacy": lambda batch: [legacy_standardize(address) for address in batch],
+        "normalize": lambda batch: [normalize(address) for address in batch],
+        "normalize_many": normalize_many,
+        "fold": lambda batch: [fold(address) for address in batch],
+    }
+    results = {}
+    reference = None
+    for name, function in functions.items():
+        start = time.perf_counter()
+        normalized = function(addresses)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = normalized
+        results[name] = {
+            "addresses": len(addresses),
+            "us_per_address": round(elapsed / len(addresses) * 1e6, 3) if addresses else None,
+            "addresses_per_second": round(len(addresses) / elapsed, 1) if elapsed else None,
+            # fold is a different transformation, compared for its cost only
+            "agreement_with_legacy": round(sum(a == b for a, b in zip(normalized, reference)) / len(addresses), 4)
+            if addresses and name != "fold" else None,
+        }
+        if verbose:
+            print(f"[+] {name}: {results[name]['us_per_address']} us/address")
+    return results
@@ -0,0 +1,117 @@
+import json
+import sqlite3
+import time
+
+from .normalizer import normalize
+
+# Number of writes between two commits (and size checks) of the cache
+COMMIT_INTERVAL = 1000
+
+
+def fold_address(standardized_address):
+    """
+    Fold the case and spacing of a standardized address, the addresses differing only by them give the same key.
+    """
+    return ' '.join(standardized_address.split()).casefold()
+
+
+class ResultCache:
+    """
+    On-disk cache of geocoding results keyed by the standardized address, shared by the geo, file and local
+    commands. Entries expire after a TTL and the least recently used ones are evicted above a size cap.
+
+    Parameters:
+    - path (str): The file path of the SQLite cache database.
+    - ttl (float): The lifetime of an entry in seconds.
+    - max_entries (int): The maximum number of entries kept in the cache.
+    - verbose (bool): Flag to enable verbose output.
+    """
+
+    def __init__(self, path='ban_cache.db', ttl=30 * 86400, max_entries=1000000, verbose=False):
+        if not path.endswith(".db"):
+            path = "{}.db".format(path)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS "cache" ("key" TEXT PRIMARY KEY, "value" TEXT NOT NULL,
+                "created" REAL NOT NULL, "accessed" REAL NOT NULL) WITHOUT ROWID""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS "cache_accessed_index" ON "cache" ("accessed")""")
+
+    @staticmethod
+    def make_key(namespace, address):
+        """
+        Build the cache key of an address, trivial formatting differences (case, spacing, abbreviations)
+        give the same key.
+        """
+        return "{}\x1f{}".format(namespace, fold_address(normalize(address)))
+
+    def get(self, namespace, address):
+        """
+        Return the cached value of an address, or None if it is missing or expired.
+        """
+        key = self.make_key(namespace, address)
+        now = time.time()
+        row = self.conn.execute("""SELECT "value", "created" FROM "cache" WHERE "key" = ?""", (key,)).fetchone()
+        if row is None or row[1] < now - self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("""UPDATE "cache" SET "accessed" = ? WHERE "key" = ?""", (now, key))
+        self._written()
+        return json.loads(row[0])
+
+    def set(self, namespace, address, value):
+        """
+        Store the value (any JSON serializable object) of an address.
+        """
+        now = time.time()
+        self.conn.execute("""INSERT OR REPLACE INTO "cache" ("key", "value", "created", "accessed")
+                VALUES (?, ?, ?, ?)""", (self.make_key(namespace, address), json.dumps(value), now, now))
+        self._written()
+
+    def _written(self):
+        self._writes += 1
+        if self._writes % COMMIT_INTERVAL == 0:
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Remove the expired entries and the least recently used ones above max_entries.
+        """
+        self.conn.execute("""DELETE FROM "cache" WHERE "created" < ?""", (time.time() - self.ttl,))
+        excess = self.conn.execute("""SELECT count(*) FROM "cache" """).fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.conn.execute("""DELETE FROM "cache" WHERE "key" IN (SELECT "key" FROM "cache"
+                    ORDER BY "accessed" LIMIT ?)""", (excess,))
+
+    def stats(self):
+        """
+        Return the cache hit statistics as a string.
+        """
+        total = self.hits + self.misses
+        ratio = 100 * self.hits / total if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.1f}% hit rate)"
+
+    def close(self):
+        """
+        Evict, commit and close the cache, printing the hit statistics when verbose.
+        """
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+        if self.verbose:
+            print(f"[+] Cache {self.path}: {self.stats()}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,10 +1,19 @@
+import json
+import os
+import sqlite3
+
 import click
-import pandas as pd
 
-from .database import import_csv_to_sqlite, prepare_database
-from .exporter import export_to_csv, export_to_sqlite
-from .geocoder import perform_geocoding, local_geocoding
-from .utils import uncompress_gz_to_csv, download_csv
+from .cache import ResultCache
+from .client import API_URL, BanClient
+from .departments import expand_departments, shard_path
+from .geocoder import (search_records, iter_geocoding, iter_bulk_geocoding, iter_local_geocoding,
+                       iter_reverse_geocoding, FEATURE_COLUMNS, LOCAL_COLUMNS, REVERSE_COLUMNS)
+from .tiers import TIERS
+from .utils import BAN_URL, records_to_string
+
+# The modules importing pandas, numpy, the fuzzy scorers or multiprocessing are imported by the commands using
+# them, so --help and a single geo lookup start without them (see bench startup)
 
 
 @click.group
@@ -15,9 +24,19 @@ def cli():
     pass
 
 
+def open_cache(cache, cache_file, cache_ttl, cache_size, verbose):
+    """
+    Open the result cache if enabled, None otherwise.
+    """
+    if not cache:
+        return None
+    return ResultCache(path=cache_file, ttl=cache_ttl * 86400, max_entries=cache_size, verbose=verbose)
+
+
 @click.command(name="geo")
 @click.option('--address', '-a', help='Address to geocode', type=str, required=True)
 @click.option('--limit', '-l', default=0, help='Number of results for each geocoding.', show_default=True, type=int)
+@click.option('--api-url', default=API_URL, show_default=True, help='Root URL of the geocoding API.')
 @click.option('--output-csv', '-csv', type=click.Path(writable=True),
               help='Path to CSV file where results will be saved.')
 @click.option('--include-header', '-hdr', is_flag=True, default=False, show_default=True,
@@ -30,31 +49,56 @@ def cli():
               help='Name of the table to insert data into in the SQLite database.')
 @click.option('--mode', '-m', type=click.Choice(['fail', 'replace', 'append'], case_sensitive=False), default="append",
               show_default=True, help='How to behave if the file already exists.')
+@click.option('--cache/--no-cache', default=False, show_default=True,
+              help='Reuse the results of addresses already geocoded.')
+@click.option('--cache-file', type=click.Path(writable=True), default='ban_cache.db', show_default=True,
+              help='File path to the SQLite cache.')
+@click.option('--cache-ttl', default=30, show_default=True, help='Lifetime of the cached results in days.')
+@click.option('--cache-size', default=1000000, show_default=True,
+              help='Maximum number of cached results, the least recently used are evicted.')
+@click.option('--json', 'json_output', is_flag=True, default=False, show_default=True,
+              help='Print the results as JSON lines instead of a table.')
 @click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
-def geocoding(address, limit, output_csv, output_db, table_name, include_header, mode, include_index, verbose):
+def geocoding(address, limit, api_url, output_csv, output_db, table_name, include_header, mode, include_index, cache,
+              cache_file, cache_ttl, cache_size, json_output, verbose):
     """
         Geocoding a single address.
     """
-    geocoded = perform_geocoding(address, limit, verbose)
-    if verbose:
-        print("-------------------------------------------------------------")
-        print(geocoded[["geometry_coordinates", "properties_label"]].to_string(index=False))
-        print("-------------------------------------------------------------")
-    if geocoded is not None:
-        if output_csv is not None:
-            if mode == "fail":
-                csvmode = "x"
-            elif mode == "replace":
-                csvmode = "w"
-            else:
-                csvmode = "a"
-            export_to_csv(geocoded, file=output_csv, mode=csvmode, header=include_header, index=include_index,
-                          verbose=verbose)
-        if output_db is not None:
-            export_to_sqlite(geocoded, database=output_db, table=table_name, mode=mode, index=include_index,
-                             verbose=verbose)
-        if not verbose and not output_db and not output_csv:
-            print(geocoded[["geometry_coordinates", "properties_label"]].to_string(index=False))
+    result_cache = open_cache(cache, cache_file, cache_ttl, cache_size, verbose)
+    try:
+        with BanClient(base_url=api_url, verbose=verbose) as client:
+            records = search_records(address, limit, verbose, client=client, cache=result_cache)
+    finally:
+        if result_cache is not None:
+            result_cache.close()
+    if records is not None:
+        display_columns = ["geometry_coordinates", "properties_label"]
+        if verbose:
+            print("-------------------------------------------------------------")
+            print(records_to_string(records, display_columns))
+            print("-------------------------------------------------------------")
+        if output_csv is not None or output_db is not None:
+            import pandas as pd
+            from .exporter import export_to_csv, export_to_sqlite
+
+            geocoded = pd.DataFrame.from_records(records)
+            if output_csv is not None:
+                if mode == "fail":
+                    csvmode = "x"
+                elif mode == "replace":
+                    csvmode = "w"
+                else:
+                    csvmode = "a"
+                export_to_csv(geocoded, file=output_csv, mode=csvmode, header=include_header, index=include_index,
+                              verbose=verbose)
+            if output_db is not None:
+                export_to_sqlite(geocoded, database=output_db, table=table_name, mode=mode, index=include_index,
+                                 verbose=verbose)
+        if json_output:
+            for record in records:
+                click.echo(json.dumps(record, ensure_ascii=False))
+        elif not verbose and not output_db and not output_csv:
+            print(records_to_string(records, display_columns))
     else:
         click.echo(f'No results found for {address}')
 
@@ -62,6 +106,17 @@ def geocoding(address, limit, output_csv, output_db, table_name, include_header,
 @click.command(name="file")
 @click.option('--input-file', '-i', help='Addresses file to geocode', required=True, type=click.Path(exists=True))
 @click.option('--limit', '-l', default=0, help='Number of results for each geocoding.', show_default=True, type=int)
+@click.option('--flush-size', '-fs', type=click.IntRange(1), default=1000, show_default=True,
+              help='Number of results written to the outputs at once.')
+@click.option('--concurrency', '-c', type=click.IntRange(1), default=1, show_default=True,
+              help='Number of requests in flight.')
+@click.option('--timeout', default=10.0, show_default=True, help='Timeout of each request in seconds.')
+@click.option('--retries', default=3, show_default=True, help='Number of retries of a failed request.')
+@click.option('--api-url', default=API_URL, show_default=True, help='Root URL of the geocoding API.')
+@click.option('--bulk', '-b', is_flag=True, default=False, show_default=True,
+              help='Upload the addresses by CSV chunks to the bulk endpoint (best result only).')
+@click.option('--bulk-size', '-bs', type=click.IntRange(1), default=5000, show_default=True,
+              help='Number of addresses per CSV chunk in bulk mode.')
 @click.option('--output-csv', '-csv', type=click.Path(writable=True),
               help='Path to CSV file where results will be saved.')
 @click.option('--include-header', '-hdr', is_flag=True, default=False, show_default=True,
@@ -74,76 +129,182 @@ def geocoding(address, limit, output_csv, output_db, table_name, include_header,
               help='Name of the table to insert data into in the SQLite database.')
 @click.option('--mode', '-m', type=click.Choice(['fail', 'replace', 'append'], case_sensitive=False), default="append",
               show_default=True, help='How to behave if the file already exists.')
+@click.option('--cache/--no-cache', default=False, show_default=True,
+              help='Reuse the results of addresses already geocoded.')
+@click.option('--cache-file', type=click.Path(writable=True), default='ban_cache.db', show_default=True,
+              help='File path to the SQLite cache.')
+@click.option('--cache-ttl', default=30, show_default=True, help='Lifetime of the cached results in days.')
+@click.option('--cache-size', default=1000000, show_default=True,
+              help='Maximum number of cached results, the least recently used are evicted.')
 @click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
-def geocoding_from_file(input_file, limit, output_csv, output_db, table_name, include_header, mode, include_index,
-                        verbose):
+def geocoding_from_file(input_file, limit, flush_size, concurrency, timeout, retries, api_url, bulk, bulk_size,
+                        output_csv, output_db, table_name, include_header, mode, include_index, cache, cache_file,
+                        cache_ttl, cache_size, verbose):
     """
     Geocoding addresses from file.
     """
+    from .exporter import export_batches, iter_batches
+
     if verbose:
         print("[+] Reading file {}".format(input_file))
-    with open(input_file, "r") as f:
-        geocoded = pd.DataFrame()
-        for line in f:
-            geocoded = geocoded._append(perform_geocoding(line, limit, verbose))
-    if verbose:
-        print("-------------------------------------------------------------")
-        print(geocoded[["geometry_coordinates", "properties_label"]].to_string(index=False))
-        print("-------------------------------------------------------------")
-    if output_csv is not None:
-        if mode == "fail":
-            csvmode = "x"
-        elif mode == "replace":
-            csvmode = "w"
-        else:
-            csvmode = "a"
-        export_to_csv(geocoded, file=output_csv, mode=csvmode, header=include_header, index=include_index,
-                      verbose=verbose)
-    if output_db is not None:
-        export_to_sqlite(geocoded, database=output_db, table=table_name, mode=mode, index=include_index,
-                         verbose=verbose)
-    if not verbose and not output_db and not output_csv:
-        print(geocoded[["geometry_coordinates", "properties_label"]].to_string(index=False))
-    return geocoded
+    result_cache = None
+    if bulk:
+        # The bulk endpoint geocodes whole chunks, results are not cached
+        records = iter_bulk_geocoding(input_file, verbose, bulk_size=bulk_size, concurrency=concurrency,
+                                      api_url=api_url, timeout=timeout, retries=retries)
+    else:
+        result_cache = open_cache(cache, cache_file, cache_ttl, cache_size, verbose)
+        records = iter_geocoding(input_file, limit, verbose, concurrency=concurrency, api_url=api_url,
+                                 timeout=timeout, retries=retries, cache=result_cache)
+    try:
+        return export_batches(iter_batches(records, flush_size),
+                              output_csv=output_csv, output_db=output_db, table=table_name, mode=mode,
+                              header=include_header, index=include_index, verbose=verbose, schema=FEATURE_COLUMNS,
+                              display=verbose or (not output_db and not output_csv),
+                              display_columns=["geometry_coordinates", "properties_label"])
+    finally:
+        if result_cache is not None:
+            result_cache.close()
+
+
+def departments_option(ctx, param, value):
+    """
+    Click callback expanding the list of departments of the --ban-datasheet option.
+    """
+    try:
+        return expand_departments(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 @click.command(name="initdb")
-@click.option('--ban-datasheet', '-csv', type=str, help='Department number related of BAN (Base Adresse Nationale) CSV datasheet.',
+@click.option('--ban-datasheet', '-csv', type=str, callback=departments_option,
+              help='Department numbers related of BAN (Base Adresse Nationale) CSV datasheets, e.g. 21, 21,75,2A, '
+                   '01-05 or france.',
               default="france",
               show_default=True)
 @click.option('--ban-db', '-db', type=click.Path(writable=True), default='ban.db', show_default=True,
-              help='File path to the SQLite database.')
+              help='File path to the SQLite database, or directory of one database per department when several '
+                   'departments are given.')
+@click.option('--ban-url', default=BAN_URL, show_default=True, help='URL of the directory of the BAN datasheets.')
+@click.option('--keep-gz/--no-keep-gz', default=False, show_default=True,
+              help='Keep the downloaded .csv.gz file, an interrupted download resumes from it.')
+@click.option('--jobs', '-j', default=4, show_default=True, help='Number of departments built at once.')
 @click.option('--separator', '-sep', default=";", show_default=True, help='CSV field separator.')
 @click.option('--chunksize', '-chk', default=10000, show_default=True, help='Number of rows per chunk to process.')
+@click.option('--fts/--no-fts', default=True, show_default=True,
+              help='Build the full-text index used to match addresses missing a house number or postal code.')
+@click.option('--spatial/--no-spatial', default=True, show_default=True,
+              help='Build the spatial index used by reverse geocoding.')
 @click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
-def initdb(ban_datasheet, ban_db, separator, chunksize, verbose):
+def initdb(ban_datasheet, ban_db, ban_url, keep_gz, jobs, separator, chunksize, fts, spatial, verbose):
     """
     Creating local database with BAN datasheet to geocoding offline.
     """
-    ban_url = f'https://adresse.data.gouv.fr/data/ban/adresses/latest/csv/adresses-{ban_datasheet}.csv.gz'
-    ban_gz = ban_url.split("/")[-1]
-    ban_csv = ban_gz.replace(".csv.gz", ".csv")
+    from .database import build_ban_database, build_department_shards
+
+    options = dict(ban_url=ban_url, keep_gz=keep_gz, separator=separator, chunksize=chunksize, fts=fts,
+                   spatial=spatial, verbose=verbose)
+    if len(ban_datasheet) == 1 and not os.path.isdir(ban_db):
+        if not build_ban_database(department=ban_datasheet[0], ban_db=ban_db, **options):
+            raise click.ClickException("database not built: {}".format(ban_db))
+        return
+
+    # One database per department, rebuilt without touching the others
+    failed = build_department_shards(ban_datasheet, directory=ban_db, jobs=jobs, **options)
+    if failed:
+        raise click.ClickException("departments not built: {}".format(", ".join(failed)))
+
+
+@click.command(name="updatedb")
+@click.option('--ban-datasheet', '-csv', type=str, callback=departments_option,
+              help='Department numbers related of BAN (Base Adresse Nationale) CSV datasheets, e.g. 21, 21,75,2A, '
+                   '01-05 or france.',
+              default="france",
+              show_default=True)
+@click.option('--ban-db', '-db', type=click.Path(exists=True), default='ban.db', show_default=True,
+              help='File path to the SQLite database, or directory of one database per department.')
+@click.option('--csv-file', '-f', type=click.Path(exists=True),
+              help='Local BAN CSV extract to apply instead of downloading the datasheet of a single department.')
+@click.option('--ban-url', default=BAN_URL, show_default=True, help='URL of the directory of the BAN datasheets.')
+@click.option('--keep-gz/--no-keep-gz', default=False, show_default=True,
+              help='Keep the downloaded .csv.gz file, an interrupted download resumes from it.')
+@click.option('--separator', '-sep', default=";", show_default=True, help='CSV field separator.')
+@click.option('--chunksize', '-chk', default=10000, show_default=True, help='Number of rows per chunk to process.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def updatedb(ban_datasheet, ban_db, csv_file, ban_url, keep_gz, separator, chunksize, verbose):
+    """
+    Updating local database with the latest BAN datasheet.
+    """
+    from .database import update_ban_database
 
-    # Download the CSV.GZ file from the provided URL
-    download_csv(url=ban_url, output_path=ban_gz,
-                 verbose=verbose)  # This function should return the path to the downloaded file
+    if csv_file and len(ban_datasheet) > 1:
+        raise click.BadParameter("a local extract updates a single department", param_hint="'--csv-file'")
+    options = dict(ban_url=ban_url, keep_gz=keep_gz, separator=separator, chunksize=chunksize, verbose=verbose,
+                   csv_file=csv_file)
+    failed = []
+    for department in ban_datasheet:
+        database = shard_path(ban_db, department) if os.path.isdir(ban_db) else ban_db
+        changes = update_ban_database(department=department, ban_db=database, **options)
+        if changes is None:
+            failed.append(department)
+        else:
+            print(f"[+] {department}: {changes['inserted']} inserted, {changes['updated']} updated, "
+                  f"{changes['deleted']} deleted")
+    if failed:
+        raise click.ClickException("departments not updated: {}".format(", ".join(failed)))
 
-    # Uncompress the GZ file to CSV
-    uncompress_gz_to_csv(gz_file_path=ban_gz, csv_file_path=ban_csv,
-                         verbose=verbose)  # This function should return the path to the uncompressed CSV
 
-    # Import the CSV into the SQLite database
-    import_csv_to_sqlite(csv_file_path=ban_csv, sqlite_db_path=ban_db, table_name="addresses",
-                         separator=separator, chunksize=chunksize, verbose=verbose)
+@click.command(name="buildindex")
+@click.option('--local-database', '-ban', required=True, type=click.Path(exists=True),
+              help='Local BAN database, or directory of department databases built by initdb.')
+@click.option('--index-file', '-o', type=click.Path(writable=True), default='ban.idx', show_default=True,
+              help='File path to the address index.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def buildindex(local_database, index_file, verbose):
+    """
+    Building a compact address index for local geocoding.
+    """
+    from .address_index import build_address_index
 
-    prepare_database(database=ban_db, verbose=verbose)
+    try:
+        build_address_index(local_database, index_file, verbose=verbose)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    except sqlite3.Error as e:
+        raise click.ClickException("{}: {}".format(local_database, e))
 
 
 @click.command(name="local")
 @click.option('--input-file', '-i', help='Addresses file to geocode', required=True, type=click.Path(exists=True))
-@click.option('--local-database', '-ban', required=True, help='Local BAN database for geocoding.')
+@click.option('--local-database', '-ban', required=True,
+              help='Local BAN database, or directory of department databases built by initdb, for geocoding.')
 @click.option('--processes', '-p', default=12, show_default=True, help='Adjust the number of processes based on your '
                                                                        'machine for calculations.')
+@click.option('--batch', '-b', is_flag=True, default=False, show_default=True,
+              help='Distribute whole addresses to the processes instead of splitting each address candidates.')
+@click.option('--chunk-size', '-cs', type=click.IntRange(1), default=64, show_default=True,
+              help='Number of addresses sent to a process at once in batch mode.')
+@click.option('--scorer', '-s', type=click.Choice(['rapidfuzz', 'thefuzz'], case_sensitive=False), default="rapidfuzz",
+              show_default=True, help='Fuzzy scoring backend.')
+@click.option('--fts/--no-fts', default=True, show_default=True,
+              help='Use the full-text index of the database for addresses missing a house number or postal code.')
+@click.option('--fts-limit', default=100, show_default=True,
+              help='Number of candidates fetched from the full-text index before fuzzy matching.')
+@click.option('--index', type=click.Path(exists=True),
+              help='Address index built by buildindex, shared by the processes for the addresses with a postal code.')
+@click.option('--max-tier', type=click.Choice(TIERS, case_sensitive=False), default=TIERS[-1], show_default=True,
+              help='Last tier of the match strategy tried: exact, interpolated house number, fuzzy match of the '
+                   'narrowed candidates, then of the wider ones.')
+@click.option('--min-score', type=click.IntRange(0, 100), default=0, show_default=True,
+              help='Minimum score of a fuzzy match, an address below it is unmatched and keeps its best score.')
+@click.option('--accept-score', type=click.IntRange(0, 100),
+              help='Score at which the candidates of an address stop being scored, e.g. 100 or 95.')
+@click.option('--dedup-size', default=1000000, show_default=True,
+              help='Number of distinct addresses whose match is reused for their duplicates in the input, 0 to '
+                   'match every line.')
+@click.option('--flush-size', '-fs', type=click.IntRange(1), default=1000, show_default=True,
+              help='Number of results written to the outputs at once.')
 @click.option('--output-csv', '-csv', type=click.Path(writable=True),
               help='Path to CSV file where results will be saved.')
 @click.option('--include-header', '-hdr', is_flag=True, default=False, show_default=True,
@@ -156,30 +317,260 @@ def initdb(ban_datasheet, ban_db, separator, chunksize, verbose):
               help='Name of the table to insert data into in the SQLite database.')
 @click.option('--mode', '-m', type=click.Choice(['fail', 'replace', 'append'], case_sensitive=False), default="append",
               show_default=True, help='How to behave if the file already exists.')
+@click.option('--cache/--no-cache', default=False, show_default=True,
+              help='Reuse the results of addresses already geocoded.')
+@click.option('--cache-file', type=click.Path(writable=True), default='ban_cache.db', show_default=True,
+              help='File path to the SQLite cache.')
+@click.option('--cache-ttl', default=30, show_default=True, help='Lifetime of the cached results in days.')
+@click.option('--cache-size', default=1000000, show_default=True,
+              help='Maximum number of cached results, the least recently used are evicted.')
+@click.option('--stats', is_flag=True, default=False, show_default=True,
+              help='Time each stage of the matching and print a summary, also enabled by --verbose.')
+@click.option('--stats-file', type=click.Path(writable=True),
+              help='Path to file where the stage timers and counters will be saved.')
+@click.option('--stats-format', type=click.Choice(['json', 'prometheus'], case_sensitive=False), default="json",
+              show_default=True, help='Format of the stats file, a JSON line appended per run or a Prometheus text '
+                                      'file.')
 @click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
-def local_geocoding_from_file(input_file, local_database, processes, output_csv, output_db, table_name, include_header,
-                              mode, include_index, verbose):
+def local_geocoding_from_file(input_file, local_database, processes, batch, chunk_size, scorer, fts, fts_limit,
+                              index, max_tier, min_score, accept_score, dedup_size, flush_size, output_csv,
+                              output_db, table_name, include_header, mode, include_index, cache, cache_file,
+                              cache_ttl, cache_size, stats, stats_file, stats_format, verbose):
     """
     Local geocoding using BAN database.
     """
-    geocoded = local_geocoding(input_file=input_file, database=local_database, processes=processes, verbose=verbose)
-    if output_csv is not None:
-        if mode == "fail":
-            csvmode = "x"
-        elif mode == "replace":
-            csvmode = "w"
-        else:
-            csvmode = "a"
-        export_to_csv(geocoded, file=output_csv, mode=csvmode, header=include_header, index=include_index,
-                      verbose=verbose)
-    if output_db is not None:
-        export_to_sqlite(geocoded, database=output_db, table=table_name, mode=mode, index=include_index,
-                         verbose=verbose)
-    if not verbose and not output_db and not output_csv:
-        print(geocoded[["geometry_coordinates", "properties_label"]].to_string(index=False))
+    from .exporter import export_batches, iter_batches
+    from .metrics import Metrics
+
+    metrics = Metrics() if stats or stats_file or verbose else None
+    result_cache = open_cache(cache, cache_file, cache_ttl, cache_size, verbose)
+    records = iter_local_geocoding(input_file=input_file, database=local_database, processes=processes,
+                                   verbose=verbose, batch=batch, chunk_size=chunk_size, scorer=scorer,
+                                   cache=result_cache, fts=fts, fts_limit=fts_limit, index=index, metrics=metrics,
+                                   max_tier=max_tier.lower(), min_score=min_score, accept_score=accept_score,
+                                   dedup_size=dedup_size)
+    try:
+        export_batches(iter_batches(records, flush_size), output_csv=output_csv, output_db=output_db,
+                       table=table_name, mode=mode, header=include_header, index=include_index, verbose=verbose,
+                       schema=LOCAL_COLUMNS, display=not output_db and not output_csv, metrics=metrics)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    except sqlite3.Error as e:
+        raise click.ClickException("{}: {}".format(local_database, e))
+    finally:
+        if result_cache is not None:
+            result_cache.close()
+    if metrics is not None:
+        if stats or verbose:
+            print("\n".join(metrics.summary()))
+        if stats_file is not None:
+            metrics.save(stats_file, format=stats_format)
+            if verbose:
+                print('[+] Stats saved to "{}".'.format(stats_file))
+
+
+@click.command(name="reverse")
+@click.option('--latitude', '-lat', type=float, help='Latitude of a single point.')
+@click.option('--longitude', '-lon', type=float, help='Longitude of a single point.')
+@click.option('--input-file', '-i', type=click.Path(exists=True),
+              help='Points file to reverse geocode, one "latitude,longitude" per line.')
+@click.option('--local-database', '-ban', required=True,
+              help='Local BAN database, or directory of department databases built by initdb.')
+@click.option('--radius', '-r', default=200.0, show_default=True,
+              help='Maximum distance in meters between a point and its addresses.')
+@click.option('--limit', '-l', default=1, show_default=True, help='Number of addresses of each point, nearest first.')
+@click.option('--chunk-size', '-cs', type=click.IntRange(1), default=10000, show_default=True,
+              help='Number of points looked up at once.')
+@click.option('--flush-size', '-fs', type=click.IntRange(1), default=1000, show_default=True,
+              help='Number of results written to the outputs at once.')
+@click.option('--output-csv', '-csv', type=click.Path(writable=True),
+              help='Path to CSV file where results will be saved.')
+@click.option('--include-header', '-hdr', is_flag=True, default=False, show_default=True,
+              help='Include header row in the CSV output.')
+@click.option('--include-index', '-idx', is_flag=True, default=False, show_default=True,
+              help='Include DataFrame index in the CSV / SQL output.')
+@click.option('--output-db', '-db', type=click.Path(writable=True),
+              help='Path to SQLite database file where results will be saved.')
+@click.option('--table-name', '-t', type=str, default="data", show_default=True,
+              help='Name of the table to insert data into in the SQLite database.')
+@click.option('--mode', '-m', type=click.Choice(['fail', 'replace', 'append'], case_sensitive=False), default="append",
+              show_default=True, help='How to behave if the file already exists.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def reverse_geocoding(latitude, longitude, input_file, local_database, radius, limit, chunk_size, flush_size,
+                      output_csv, output_db, table_name, include_header, mode, include_index, verbose):
+    """
+    Reverse geocoding points using BAN database.
+    """
+    from .exporter import export_batches, iter_batches
+
+    if input_file is not None:
+        points = input_file
+    elif latitude is not None and longitude is not None:
+        points = [(latitude, longitude)]
+    else:
+        raise click.UsageError("give either --input-file or both --latitude and --longitude")
+    try:
+        records = iter_reverse_geocoding(points, database=local_database, radius=radius, limit=limit,
+                                         chunk_size=chunk_size, verbose=verbose)
+        export_batches(iter_batches(records, flush_size), output_csv=output_csv, output_db=output_db,
+                       table=table_name, mode=mode, header=include_header, index=include_index, verbose=verbose,
+                       schema=REVERSE_COLUMNS, display=not output_db and not output_csv)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    except sqlite3.Error as e:
+        raise click.ClickException("{}: {}".format(local_database, e))
+
+
+@click.command(name="serve")
+@click.option('--local-database', '-ban', required=True,
+              help='Local BAN database, or directory of department databases built by initdb, for geocoding.')
+@click.option('--host', default='127.0.0.1', show_default=True, help='Address the server listens on.')
+@click.option('--port', default=7878, show_default=True, help='Port the server listens on.')
+@click.option('--processes', '-p', default=4, show_default=True, help='Number of worker processes kept warm.')
+@click.option('--chunk-size', '-cs', type=click.IntRange(1), default=16, show_default=True,
+              help='Number of addresses sent to a process at once.')
+@click.option('--batch-size', '-bs', type=click.IntRange(1), default=256, show_default=True,
+              help='Maximum number of addresses of concurrent requests matched together.')
+@click.option('--batch-wait', default=5.0, show_default=True,
+              help='Maximum time in milliseconds an address waits for others before being matched.')
+@click.option('--scorer', '-s', type=click.Choice(['rapidfuzz', 'thefuzz'], case_sensitive=False), default="rapidfuzz",
+              show_default=True, help='Fuzzy scoring backend.')
+@click.option('--fts/--no-fts', default=True, show_default=True,
+              help='Use the full-text index of the database for addresses missing a house number or postal code.')
+@click.option('--fts-limit', default=100, show_default=True,
+              help='Number of candidates fetched from the full-text index before fuzzy matching.')
+@click.option('--index', type=click.Path(exists=True),
+              help='Address index built by buildindex, shared by the processes for the addresses with a postal code.')
+@click.option('--max-tier', type=click.Choice(TIERS, case_sensitive=False), default=TIERS[-1], show_default=True,
+              help='Last tier of the match strategy tried: exact, interpolated house number, fuzzy match of the '
+                   'narrowed candidates, then of the wider ones.')
+@click.option('--min-score', type=click.IntRange(0, 100), default=0, show_default=True,
+              help='Minimum score of a fuzzy match, an address below it is unmatched and keeps its best score.')
+@click.option('--accept-score', type=click.IntRange(0, 100),
+              help='Score at which the candidates of an address stop being scored, e.g. 100 or 95.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def serve_geocoding(local_database, host, port, processes, chunk_size, batch_size, batch_wait, scorer, fts, fts_limit,
+                    index, max_tier, min_score, accept_score, verbose):
+    """
+    Serving local geocoding over HTTP, like the BAN API.
+    """
+    from .server import serve
+
+    serve(local_database, host=host, port=port, processes=processes, chunk_size=chunk_size, scorer=scorer, fts=fts,
+          fts_limit=fts_limit, index=index, max_tier=max_tier.lower(), min_score=min_score, accept_score=accept_score,
+          batch_size=batch_size, max_wait=batch_wait / 1000, verbose=verbose)
+
+
+@click.group(name="bench")
+def bench():
+    """
+    Benchmarking the geocoding hot paths.
+    """
+    pass
+
+
+@bench.command(name="scorers")
+@click.option('--local-database', '-ban', required=True, type=click.Path(exists=True),
+              help='Local BAN database used for the benchmark.')
+@click.option('--department', '-dep', type=str, help='Department number of the sampled BAN addresses.')
+@click.option('--sample-size', '-n', default=200, show_default=True, help='Number of noisy addresses to match.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the random generator.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def bench_scorers(local_database, department, sample_size, seed, verbose):
+    """
+    Comparing thefuzz and rapidfuzz scorers on the same BAN candidates.
+    """
+    from .benchmark import benchmark_scorers
+
+    results = benchmark_scorers(database=local_database, department=department, sample_size=sample_size, seed=seed,
+                                verbose=verbose)
+    print(json.dumps(results, indent=2))
+
+
+def processes_option(ctx, param, value):
+    """
+    Click callback parsing the comma separated numbers of processes of the --processes option.
+    """
+    try:
+        counts = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise click.BadParameter("expected numbers of processes separated by commas, e.g. 1,2,4")
+    if not counts or min(counts) < 1:
+        raise click.BadParameter("expected numbers of processes separated by commas, e.g. 1,2,4")
+    return counts
+
+
+@bench.command(name="local")
+@click.option('--size', '-n', default=100000, show_default=True,
+              help='Number of addresses of the synthetic BAN database.')
+@click.option('--queries', '-q', default=2000, show_default=True, help='Number of noisy addresses to match.')
+@click.option('--processes', '-p', default="1,2,4", show_default=True, callback=processes_option,
+              help='Numbers of processes benchmarked, separated by commas.')
+@click.option('--batch', '-b', is_flag=True, default=False, show_default=True,
+              help='Distribute whole addresses to the processes instead of splitting each address candidates.')
+@click.option('--chunk-size', '-cs', type=click.IntRange(1), default=64, show_default=True,
+              help='Number of addresses sent to a process at once in batch mode.')
+@click.option('--scorer', '-s', type=click.Choice(['rapidfuzz', 'thefuzz'], case_sensitive=False), default="rapidfuzz",
+              show_default=True, help='Fuzzy scoring backend.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the random generator.')
+@click.option('--work-dir', '-w', type=click.Path(file_okay=False, writable=True),
+              help='Directory keeping the synthetic database between runs, a temporary one otherwise.')
+@click.option('--output-json', '-o', type=click.Path(writable=True),
+              help='Path to JSON file where results will be saved.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def bench_local(size, queries, processes, batch, chunk_size, scorer, seed, work_dir, output_json, verbose):
+    """
+    Benchmarking local geocoding on a synthetic BAN database.
+    """
+    from .benchmark import benchmark_local
+
+    results = benchmark_local(size=size, queries=queries, processes=processes, batch=batch, chunk_size=chunk_size,
+                              scorer=scorer, seed=seed, work_dir=work_dir, verbose=verbose)
+    print(json.dumps(results, indent=2))
+    if output_json is not None:
+        with open(output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+        if verbose:
+            print('[+] Results saved to "{}".'.format(output_json))
+
+
+@bench.command(name="normalize")
+@click.option('--sample-size', '-n', default=10000, show_default=True, help='Number of noisy addresses to normalize.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the random generator.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def bench_normalize(sample_size, seed, verbose):
+    """
+    Measuring the cost per address of the normalization of the input addresses.
+    """
+    from .benchmark import benchmark_normalize
+
+    print(json.dumps(benchmark_normalize(sample_size=sample_size, seed=seed, verbose=verbose), indent=2))
+
+
+@bench.command(name="startup")
+@click.option('--runs', '-n', default=10, show_default=True, help='Number of runs of each command.')
+@click.option('--budget', default=200.0, show_default=True,
+              help='Maximum median import time in milliseconds of each command.')
+@click.option('--verbose', '-v', is_flag=True, help="More information displayed.")
+def bench_startup(runs, budget, verbose):
+    """
+    Measuring the import time of --help and of a geo lookup.
+    """
+    from .benchmark import benchmark_startup
+
+    results = benchmark_startup(runs=runs, budget=budget, verbose=verbose)
+    print(json.dumps(results, indent=2))
+    over = [name for name, result in results.items() if not result['within_budget']]
+    if over:
+        raise click.ClickException("import time over the budget of {} ms: {}".format(budget, ", ".join(over)))
 
 
 cli.add_command(geocoding)
 cli.add_command(geocoding_from_file)
 cli.add_command(initdb)
+cli.add_command(updatedb)
+cli.add_command(buildindex)
 cli.add_command(local_geocoding_from_file)
+cli.add_command(reverse_geocoding)
+cli.add_command(serve_geocoding)
+cli.add_command(bench)
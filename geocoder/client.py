@@ -0,0 +1,188 @@
+import csv
+import io
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+API_URL = 'https://api-adresse.data.gouv.fr'
+
+# HTTP status codes worth retrying: rate limited or temporarily unavailable
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class BanClient:
+    """
+    HTTP client for the BAN geocoding API sharing a pool of keep-alive connections between
+    a bounded number of concurrent requests, with timeouts, retries and rate-limit handling.
+
+    Parameters:
+    - base_url (str): The root URL of the API, e.g. a local stub or a compatible service.
+    - concurrency (int): The maximum number of requests in flight.
+    - timeout (float): The connect and read timeout of each request, in seconds.
+    - retries (int): The number of retries of a request failing with a network error or a retryable status.
+    - backoff (float): The base delay between retries in seconds, doubled at each attempt.
+    - verbose (bool): Flag to enable verbose output.
+    """
+
+    def __init__(self, base_url=API_URL, concurrency=1, timeout=10, retries=3, backoff=0.5, verbose=False):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.verbose = verbose
+        # requests is imported by the first client, the commands not using the API start without it
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # When the API answers 429, every thread waits until this time before sending again
+        self._resume_at = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _wait_rate_limit(self):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause(self, delay):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    @staticmethod
+    def _retry_after(response):
+        """
+        Return the delay in seconds requested by the Retry-After header, or None.
+        """
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request to the API, retrying with exponential backoff on network errors and
+        retryable statuses, and honoring Retry-After when rate limited.
+
+        Returns:
+        - response (Response): The last response received, or None if every attempt failed on a network error.
+        """
+        import requests
+
+        url = self.base_url + path
+        for attempt in range(self.retries + 1):
+            self._wait_rate_limit()
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    print(f"[!] Request to {url} failed : {e}")
+                    return None
+                if self.verbose:
+                    print(f"[!] Request to {url} failed, retrying in {delay:.1f}s : {e}")
+                time.sleep(delay)
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                return response
+            if response.status_code == 429:
+                # Rate limited: pause every thread, not only this one
+                self._pause(self._retry_after(response) or delay)
+                if self.verbose:
+                    print(f"[!] Rate limited by {self.base_url}, pausing requests")
+            else:
+                if self.verbose:
+                    print(f"[!] HTTP {response.status_code} from {url}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+        return None
+
+    def search(self, address):
+        """
+        Geocode an address with the /search/ endpoint.
+
+        Returns:
+        - json_data (dict): The GeoJSON FeatureCollection returned by the API, or None on failure.
+        """
+        response = self.request('GET', '/search/?q=' + urllib.parse.quote(address))
+        if response is None or response.status_code != 200:
+            if response is not None and self.verbose:
+                print(f"[!] No result for {address.strip()}, HTTP Status Code: {response.status_code}")
+            return None
+        try:
+            return response.json()
+        except ValueError as e:
+            # An HTML error page from a proxy, or a truncated body
+            print(f"[!] Invalid JSON response for {address.strip()} : {e}")
+            return None
+
+    def search_csv(self, data):
+        """
+        Geocode a CSV of addresses with the /search/csv/ bulk endpoint.
+
+        Parameters:
+        - data (bytes): The CSV to upload, with an 'address' column.
+
+        Returns:
+        - rows (list): The rows of the CSV returned by the API as dicts, or None on failure.
+        """
+        response = self.request('POST', '/search/csv/', files={'data': ('addresses.csv', data, 'text/csv')},
+                                data={'columns': 'address'})
+        if response is None or response.status_code != 200:
+            if response is not None:
+                print(f"[!] Bulk geocoding failed, HTTP Status Code: {response.status_code}")
+            return None
+        response.encoding = 'utf-8'
+        # Parsed as a whole, a quoted field may hold a newline
+        return list(csv.DictReader(io.StringIO(response.text, newline='')))
+
+    def map(self, func, items):
+        """
+        Apply func to each item concurrently, at most concurrency calls in flight.
+
+        The items are consumed lazily and the results are yielded in input order.
+
+        Yields:
+        - (item, result) (tuple): Each item with the result of func.
+        """
+        if self.concurrency == 1:
+            for item in items:
+                yield item, func(item)
+            return
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Keep a bounded window of submitted requests so the input is never fully buffered
+            pending = deque()
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= self.concurrency * 2:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+
+    def search_many(self, addresses):
+        """
+        Geocode addresses concurrently with search, results are yielded in input order.
+
+        Yields:
+        - (address, json_data) (tuple): Each address with the result of search.
+        """
+        return self.map(self.search, addresses)
@@ -1,48 +1,217 @@
-import pandas as pd
+import csv
+import hashlib
+import os
 import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import Pool
+from queue import Queue
+
+from .departments import shard_path
+from .normalizer import street_type_key
+from .query import LABEL_EXPRESSION, PRECOMPUTED_COLUMNS, phonetic_key
+from .utils import open_ban_csv
+
+# Types of the BAN columns, the other columns of the CSV are stored as TEXT. Postal and INSEE codes
+# stay TEXT to keep their leading zeros.
+BAN_SCHEMA = {
+    "numero": "INTEGER",
+    "x": "REAL",
+    "y": "REAL",
+    "lon": "REAL",
+    "lat": "REAL",
+    "certification_commune": "INTEGER",
+}
+
+# Number of row batches parsed ahead of the writer
+QUEUE_SIZE = 2
+
+
+def iter_csv_batches(csv_file_path, separator, chunksize):
+    """
+    Read a CSV file with the csv module and yield its header, then its rows by lists of chunksize rows.
+
+    The CSV is either a file path or a text stream, such as the one of utils.open_ban_csv. Short or long
+    rows are padded or truncated to the header so each row binds every column.
+    """
+    if isinstance(csv_file_path, (str, os.PathLike)):
+        csv_file = open(csv_file_path, 'r', encoding='utf-8', newline='')
+    else:
+        csv_file = nullcontext(csv_file_path)
+    with csv_file as csv_file:
+        reader = csv.reader(csv_file, delimiter=separator)
+        header = next(reader, None)
+        if header is None:
+            return
+        yield header
+        width = len(header)
+        padding = [''] * width
+        while True:
+            batch = list(islice(reader, chunksize))
+            if not batch:
+                return
+            if any(len(row) != width for row in batch):
+                batch = [row if len(row) == width else (row + padding)[:width] for row in batch]
+            yield batch
+
+
+def create_table(conn, table_name, columns, temporary=False):
+    """
+    Create a table of BAN rows with the BAN_SCHEMA types if it does not exist.
+    """
+    definitions = ", ".join('"{}" {}'.format(column, BAN_SCHEMA.get(column, "TEXT")) for column in columns)
+    conn.execute('CREATE {}TABLE IF NOT EXISTS "{}" ({})'.format("TEMP " if temporary else "", table_name,
+                                                                  definitions))
+
+
+def insert_rows(conn, table_name, columns, batches, verbose):
+    """
+    Insert batches of rows with executemany. Values are bound as text: empty strings become NULL and the
+    column affinity converts the numbers, all inside SQLite.
+
+    Returns:
+    - count (int): The number of rows inserted.
+    """
+    insert = 'INSERT INTO "{}" ({}) VALUES ({})'.format(table_name,
+                                                       ", ".join('"{}"'.format(column) for column in columns),
+                                                       ", ".join("NULLIF(?, '')" for _ in columns))
+    count = 0
+    start = time.perf_counter()
+    for batch in batches:
+        conn.executemany(insert, batch)
+        count += len(batch)
+        if verbose:
+            elapsed = time.perf_counter() - start
+            print(f"[+] {count} rows added to the database ({count / elapsed if elapsed else 0:.0f} rows/s)")
+    return count
+
+
+def import_rows_to_sqlite(columns, batches, sqlite_db_path, table_name, verbose):
+    """
+    Bulk load batches of rows into a typed SQLite table.
+
+    The table is created with the BAN_SCHEMA types if it does not exist, and the rows are inserted with
+    executemany in a single transaction, journaled in memory and syncing off. The rows inserted before an
+    error are rolled back.
+
+    Parameters:
+    - columns (list): The column names of the rows.
+    - batches (iterable): Lists of rows, each row a sequence of strings in the order of columns.
+    - sqlite_db_path (str): The file path of the SQLite database.
+    - table_name (str): The name of the table to insert the data into.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - count (int): The number of rows imported.
+    """
+    if not sqlite_db_path.endswith(".db"):
+        sqlite_db_path = "{}.db".format(sqlite_db_path)
+    conn = sqlite3.connect(sqlite_db_path, isolation_level=None)
+    count = 0
+    start = time.perf_counter()
+    try:
+        # The database is rebuilt from the BAN after a crash, so durability is traded for load speed, the
+        # journal in memory still rolls back an error, and the pages appended to a new table are not journaled
+        conn.execute("PRAGMA journal_mode=MEMORY")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA cache_size=-65536")
+        create_table(conn, table_name, columns)
+        conn.execute("BEGIN")
+        count = insert_rows(conn, table_name, columns, batches, verbose)
+        conn.execute("COMMIT")
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f"[+] {count} rows imported in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} rows/s)")
+    return count
+
+
+def iter_in_background(iterable, size=QUEUE_SIZE):
+    """
+    Consume an iterable in a background thread and yield its items, at most size items ahead.
+
+    An exception raised by the iterable is raised again in the consumer.
+    """
+    queue = Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                queue.put(item)
+        except BaseException as e:
+            queue.put(e)
+            return
+        queue.put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Unblock the producer if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            while not queue.empty():
+                queue.get_nowait()
+            thread.join(0.1)
 
 
 def import_csv_to_sqlite(csv_file_path, sqlite_db_path, table_name, separator, verbose, chunksize):
     """
     Import a large CSV file into a SQLite database in chunks.
 
+    The CSV is read and parsed in a background thread while the rows of the previous chunks are inserted,
+    so a streamed download is decompressed and parsed as the rows are written.
+
     Parameters:
-    - csv_file_path (str): The file path of the CSV file to import.
+    - csv_file_path (str or file): The file path of the CSV file to import, or a text stream of the CSV.
     - sqlite_db_path (str): The file path of the SQLite database.
     - table_name (str): The name of the table to insert the data into.
     - separator (str): The delimiter to use for separating entries in the CSV file.
     - chunksize (int): The number of rows per chunk to process at a time. A larger chunksize can
                        be faster for writing data, but it may also consume more memory.
 
+    Returns:
+    - count (int): The number of rows imported, None if the import failed.
+
     Notes:
-    - This function assumes that the SQLite database and table already exist.
-    - The function appends each chunk of data to the specified table. If the table does not exist,
-      pandas will create it based on the DataFrame's schema.
-    - It is recommended to ensure that the table schema in SQLite matches the CSV file structure.
-    - In case of large CSV files, the 'chunksize' parameter can be adjusted to avoid memory issues.
+    - If the table does not exist, it is created from the CSV header with the BAN_SCHEMA types.
+    - The rows are appended to the specified table, whose columns must match the CSV header.
     """
-    if not sqlite_db_path.endswith(".db"):
-        sqlite_db_path = "{}.db".format(sqlite_db_path)
-    # Create a connection to the SQLite database
-    conn = sqlite3.connect(sqlite_db_path)
     if verbose:
-        print(f"[+] Importing {csv_file_path} into SQLite database {sqlite_db_path}")
+        print(f"[+] Importing {getattr(csv_file_path, 'name', csv_file_path)} into SQLite database {sqlite_db_path}")
+    batches = iter_in_background(iter_csv_batches(csv_file_path, separator, chunksize))
+    count = None
     try:
-        # Read the CSV file and import data in chunks
-        for chunk in pd.read_csv(csv_file_path, chunksize=chunksize, sep=separator):
-            chunk.to_sql(name=table_name, con=conn, if_exists='append', index=False)
-            conn.commit()  # Commit after each chunk
-            if verbose:
-                print(f"[+] {len(chunk)} rows added to the database")
+        columns = next(batches, None)
+        if columns is None:
+            print(f"[!] {getattr(csv_file_path, 'name', csv_file_path)} is empty")
+            return None
+        count = import_rows_to_sqlite(columns, batches, sqlite_db_path, table_name, verbose)
     except Exception as e:
-        conn.rollback()  # Rollback on error
-        if verbose:
-            print(f"[!] An error occurred during import: {e}")
+        print(f"[!] An error occurred during import: {e}")
     finally:
-        conn.close()  # Close the connection
+        batches.close()
 
     if verbose:
         print(f"[+] CSV data import process completed.")
+    return count
 
 
 def prepare_database(database, verbose):
@@ -56,6 +225,8 @@ def prepare_database(database, verbose):
             print("[+] Optimize database...")
         conn = sqlite3.connect(database)
         cursor = conn.cursor()
+        # A larger page cache for the sorts of the index builds
+        cursor.execute("PRAGMA cache_size=-65536")
         cursor.execute("""CREATE INDEX IF NOT EXISTS "address_index" ON "addresses" ( "numero", "rep", 
                 "nom_voie", "code_postal", "nom_commune" )""")
         cursor.execute("""CREATE INDEX IF NOT EXISTS "numero_index" ON "addresses" ("numero")""")
@@ -63,6 +234,19 @@ def prepare_database(database, verbose):
         cursor.execute("""CREATE INDEX IF NOT EXISTS "nom_voie_index" ON "addresses" ("nom_voie")""")
         cursor.execute("""CREATE INDEX IF NOT EXISTS "code_postal_index" ON "addresses" ("code_postal")""")
         cursor.execute("""CREATE INDEX IF NOT EXISTS "nom_commune_index" ON "addresses" ("nom_commune")""")
+        # Street type prefix on nom_afnor, for databases without the columns below
+        cursor.execute("""CREATE INDEX IF NOT EXISTS "nom_afnor_index" ON "addresses" ("nom_afnor")""")
+        # Label and blocking keys of the candidate queries, the postal code and house number lookup reads
+        # everything it needs from its covering index
+        fill_precomputed_columns(conn)
+        cursor.execute("""DROP INDEX IF EXISTS "code_postal_numero_index" """)
+        cursor.execute("""CREATE INDEX IF NOT EXISTS "candidates_index" ON "addresses" ("code_postal", "numero",
+                "type_voie", "nom_afnor", "label", "lat", "lon")""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS "type_voie_index" ON "addresses" ("type_voie", "numero")""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS "commune_phonetic_index" ON "addresses" ("commune_phonetic",
+                "type_voie", "numero")""")
+        # Statistics let the query planner pick the most selective index
+        cursor.execute("ANALYZE")
         conn.commit()
     except Exception as e:
         conn.rollback()
@@ -71,3 +255,324 @@ def prepare_database(database, verbose):
         if verbose:
             print(f"[+] Indexes in {database} was created succesfully !")
         conn.close()
+
+
+def fill_precomputed_columns(conn):
+    """
+    Add the label and blocking key columns to the addresses table if needed, and fill them for the rows
+    which have none: the comparison string of the address, the street type (first word of nom_afnor) and
+    the phonetic key of the city. The keys are computed by the functions the matcher applies to the input
+    addresses, so both sides are folded identically.
+
+    Returns:
+    - count (int): The number of rows filled.
+    """
+    existing = {row[1] for row in conn.execute('PRAGMA table_info("addresses")')}
+    for column in PRECOMPUTED_COLUMNS:
+        if column not in existing:
+            conn.execute('ALTER TABLE "addresses" ADD COLUMN "{}" TEXT'.format(column))
+    conn.create_function("ban_phonetic", 1, lambda text: phonetic_key(text) if text else None, deterministic=True)
+    conn.create_function("ban_street_type", 1, street_type_key, deterministic=True)
+    return conn.execute("""UPDATE "addresses" SET "label" = {}, "type_voie" = ban_street_type("nom_afnor"),
+            "commune_phonetic" = ban_phonetic("nom_commune")
+            WHERE "label" IS NULL""".format(LABEL_EXPRESSION.format(table=""))).rowcount
+
+
+def build_fts_index(database, verbose):
+    """
+    Build the full-text index of the addresses used to fetch the candidates of the addresses missing a house number
+    or a postal code.
+
+    The index is an FTS5 table over the house number, street, postal code and city columns, with the addresses
+    table as external content so the text is not stored twice. Accents are removed by the tokenizer, so the
+    folded words of an input address match the BAN names. Triggers keep it in sync with the addresses table.
+    """
+    if not database.endswith(".db"):
+        database = "{}.db".format(database)
+    if verbose:
+        print("[+] Building full-text index...")
+    conn = sqlite3.connect(database)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""DROP TABLE IF EXISTS "addresses_fts" """)
+        cursor.execute("""CREATE VIRTUAL TABLE "addresses_fts" USING fts5("numero", "nom_voie", "code_postal",
+                "nom_commune", content='addresses', content_rowid='rowid',
+                tokenize='unicode61 remove_diacritics 2')""")
+        cursor.execute("""INSERT INTO "addresses_fts" ("addresses_fts") VALUES ('rebuild')""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS "addresses_fts_insert" AFTER INSERT ON "addresses" BEGIN
+                INSERT INTO "addresses_fts" (rowid, "numero", "nom_voie", "code_postal", "nom_commune")
+                VALUES (new.rowid, new."numero", new."nom_voie", new."code_postal", new."nom_commune"); END""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS "addresses_fts_delete" AFTER DELETE ON "addresses" BEGIN
+                INSERT INTO "addresses_fts" ("addresses_fts", rowid, "numero", "nom_voie", "code_postal",
+                "nom_commune") VALUES ('delete', old.rowid, old."numero", old."nom_voie", old."code_postal",
+                old."nom_commune"); END""")
+        # Updates of the other columns, e.g. the precomputed ones, leave the index alone
+        cursor.execute("""DROP TRIGGER IF EXISTS "addresses_fts_update" """)
+        cursor.execute("""CREATE TRIGGER "addresses_fts_update" AFTER UPDATE OF "numero", "nom_voie", "code_postal",
+                "nom_commune" ON "addresses" BEGIN
+                INSERT INTO "addresses_fts" ("addresses_fts", rowid, "numero", "nom_voie", "code_postal",
+                "nom_commune") VALUES ('delete', old.rowid, old."numero", old."nom_voie", old."code_postal",
+                old."nom_commune");
+                INSERT INTO "addresses_fts" (rowid, "numero", "nom_voie", "code_postal", "nom_commune")
+                VALUES (new.rowid, new."numero", new."nom_voie", new."code_postal", new."nom_commune"); END""")
+        cursor.execute("""INSERT INTO "addresses_fts" ("addresses_fts") VALUES ('optimize')""")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    if verbose:
+        print(f"[+] Full-text index in {database} was created succesfully !")
+
+
+def build_spatial_index(database, verbose):
+    """
+    Build the spatial index of the addresses used by reverse geocoding.
+
+    The index is an R*Tree of the coordinates of the addresses, each address being a box of zero size, which
+    also holds the exact coordinates since the boxes are stored as 32-bit floats. Triggers keep it in sync
+    with the addresses table.
+    """
+    if not database.endswith(".db"):
+        database = "{}.db".format(database)
+    if verbose:
+        print("[+] Building spatial index...")
+    conn = sqlite3.connect(database)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""DROP TABLE IF EXISTS "addresses_rtree" """)
+        cursor.execute("""CREATE VIRTUAL TABLE "addresses_rtree" USING rtree("id", "min_lat", "max_lat", "min_lon",
+                "max_lon", +"lat", +"lon")""")
+        cursor.execute("""INSERT INTO "addresses_rtree" SELECT rowid, "lat", "lat", "lon", "lon", "lat", "lon"
+                FROM "addresses" WHERE "lat" IS NOT NULL AND "lon" IS NOT NULL""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS "addresses_rtree_insert" AFTER INSERT ON "addresses"
+                WHEN new."lat" IS NOT NULL AND new."lon" IS NOT NULL BEGIN
+                INSERT INTO "addresses_rtree" VALUES (new.rowid, new."lat", new."lat", new."lon", new."lon",
+                new."lat", new."lon"); END""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS "addresses_rtree_delete" AFTER DELETE ON "addresses" BEGIN
+                DELETE FROM "addresses_rtree" WHERE "id" = old.rowid; END""")
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS "addresses_rtree_update" AFTER UPDATE OF "lat", "lon"
+                ON "addresses" BEGIN
+                DELETE FROM "addresses_rtree" WHERE "id" = old.rowid;
+                INSERT INTO "addresses_rtree" SELECT new.rowid, new."lat", new."lat", new."lon", new."lon",
+                new."lat", new."lon" WHERE new."lat" IS NOT NULL AND new."lon" IS NOT NULL; END""")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    if verbose:
+        print(f"[+] Spatial index in {database} was created succesfully !")
+
+
+def build_ban_database(ban_url, department, ban_db, keep_gz, separator, chunksize, fts, verbose, spatial=True):
+    """
+    Download the BAN datasheet of a department and import it into a SQLite database with its indexes.
+
+    The datasheet is downloaded, uncompressed and imported in a single pass, without writing the CSV to disk.
+    The database is built next to ban_db, as <name>.tmp.db, then swapped in place of it, so a failed build
+    keeps the previous database and readers never see a partial one.
+
+    Parameters:
+    - ban_url (str): The URL of the directory of the BAN datasheets.
+    - department (str): The department code of the datasheet, or "france".
+    - ban_db (str): The file path of the SQLite database.
+    - keep_gz (bool): Keep the downloaded .csv.gz in the current directory.
+    - separator (str): The delimiter of the CSV fields.
+    - chunksize (int): The number of rows inserted at once.
+    - fts (bool): Build the full-text index of the addresses.
+    - verbose (bool): Flag to enable verbose output.
+    - spatial (bool): Build the spatial index of the addresses, for reverse geocoding.
+
+    Returns:
+    - count (int): The number of rows imported, None if the import failed.
+    """
+    if not ban_db.endswith(".db"):
+        ban_db = "{}.db".format(ban_db)
+    temporary_db = "{}.tmp.db".format(ban_db[:-len(".db")])
+    if os.path.exists(temporary_db):
+        os.remove(temporary_db)
+    url = f'{ban_url.rstrip("/")}/adresses-{department}.csv.gz'
+    ban_gz = url.split("/")[-1]
+    count = None
+    try:
+        with open_ban_csv(url=url, output_path=ban_gz if keep_gz else None, verbose=verbose) as ban_csv:
+            count = import_csv_to_sqlite(csv_file_path=ban_csv, sqlite_db_path=temporary_db, table_name="addresses",
+                                         separator=separator, chunksize=chunksize, verbose=verbose)
+        if count:
+            prepare_database(database=temporary_db, verbose=verbose)
+            if fts:
+                build_fts_index(database=temporary_db, verbose=verbose)
+            if spatial:
+                build_spatial_index(database=temporary_db, verbose=verbose)
+            os.replace(temporary_db, ban_db)
+    finally:
+        if os.path.exists(temporary_db):
+            os.remove(temporary_db)
+    return count
+
+
+def build_shard(args):
+    """
+    Pool task: build the shard of a department, a failed build keeps the previous shard, see
+    build_ban_database.
+
+    Returns a tuple (department, count) where count is None if the build failed.
+    """
+    department, directory, options = args
+    try:
+        count = build_ban_database(department=department, ban_db=shard_path(directory, department), **options)
+    except Exception as e:
+        print(f"[!] Department {department} failed : {e}")
+        count = None
+    return department, count
+
+
+def build_department_shards(departments, directory, jobs, **options):
+    """
+    Build one database per department in a directory, several departments at once.
+
+    Parameters:
+    - departments (list): The department codes.
+    - directory (str): The directory of the shards, created if needed.
+    - jobs (int): The number of departments built at once.
+    - options: The other parameters of build_ban_database.
+
+    Returns:
+    - failed (list): The departments whose shard could not be built.
+    """
+    os.makedirs(directory, exist_ok=True)
+    verbose = options.get('verbose')
+    start = time.perf_counter()
+    failed = []
+    tasks = [(department, directory, options) for department in departments]
+    with Pool(processes=max(1, min(jobs, len(tasks)))) as pool:
+        for department, count in pool.imap_unordered(build_shard, tasks):
+            if not count:
+                failed.append(department)
+            elif verbose:
+                print(f"[+] Department {department}: {count} rows in {shard_path(directory, department)}")
+    if verbose:
+        print(f"[+] {len(departments) - len(failed)} departments built in {time.perf_counter() - start:.2f}s")
+    return failed
+
+
+def row_hash(*values):
+    """
+    Hash the values of a BAN row into a signed 64-bit integer, registered as the ban_row_hash SQL function.
+    """
+    content = "\x1f".join("" if value is None else str(value) for value in values)
+    return int.from_bytes(hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def update_database(csv_file_path, database, separator, chunksize, verbose):
+    """
+    Apply a new BAN extract to an existing database: only the added, changed and removed addresses are written.
+
+    The extract is loaded into a temporary table and compared with the addresses table by BAN id, using a
+    hash of each row kept in the row_hash column. Inserts, updates and deletes are applied in a single
+    transaction, SQLite maintains the indexes and the triggers of the full-text index keep it in sync, the
+    label and blocking keys of the new and changed rows are filled.
+    Rows duplicated by an earlier import appended twice are removed, and the first update of a database
+    imported before row hashes existed computes the hash of every row.
+
+    Parameters:
+    - csv_file_path (str or file): The file path of the BAN CSV extract, or a text stream of it.
+    - database (str): The file path of the SQLite database to update.
+    - separator (str): The delimiter of the CSV fields.
+    - chunksize (int): The number of rows loaded at once.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - changes (dict): The number of rows inserted, updated and deleted, None if the update failed.
+    """
+    if not database.endswith(".db"):
+        database = "{}.db".format(database)
+    if not os.path.exists(database):
+        print(f"[!] {database} does not exist, run initdb to create it")
+        return None
+    start = time.perf_counter()
+    batches = iter_in_background(iter_csv_batches(csv_file_path, separator, chunksize))
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.create_function("ban_row_hash", -1, row_hash, deterministic=True)
+    try:
+        columns = next(batches, None)
+        if columns is None:
+            print(f"[!] {getattr(csv_file_path, 'name', csv_file_path)} is empty")
+            return None
+        existing = [row[1] for row in conn.execute('PRAGMA table_info("addresses")')]
+        missing = [column for column in columns if column not in existing]
+        if "id" not in columns or missing:
+            print(f"[!] The columns of the extract do not match the addresses table: {', '.join(missing) or 'id'}")
+            return None
+        quoted = ", ".join('"{}"'.format(column) for column in columns)
+        hashed = "ban_row_hash({})".format(quoted)
+
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("BEGIN")
+        if "row_hash" not in existing:
+            conn.execute('ALTER TABLE "addresses" ADD COLUMN "row_hash" INTEGER')
+        conn.execute('CREATE INDEX IF NOT EXISTS "id_index" ON "addresses" ("id")')
+        conn.execute(f'UPDATE "addresses" SET "row_hash" = {hashed} WHERE "row_hash" IS NULL')
+        duplicates = conn.execute('DELETE FROM "addresses" WHERE rowid NOT IN (SELECT min(rowid) FROM "addresses" '
+                                  'GROUP BY "id")').rowcount
+
+        create_table(conn, "addresses_update", columns, temporary=True)
+        conn.execute('DELETE FROM temp."addresses_update"')
+        count = insert_rows(conn, "addresses_update", columns, batches, verbose)
+        if verbose:
+            print(f"[+] {count} rows loaded, comparing with {database}...")
+        conn.execute('ALTER TABLE temp."addresses_update" ADD COLUMN "row_hash" INTEGER')
+        conn.execute(f'UPDATE temp."addresses_update" SET "row_hash" = {hashed}')
+        conn.execute('CREATE INDEX temp."addresses_update_id_index" ON "addresses_update" ("id", "row_hash")')
+
+        deleted = conn.execute('DELETE FROM "addresses" WHERE "id" NOT IN (SELECT "id" FROM temp."addresses_update")'
+                               ).rowcount
+        # Updated rows keep their rowid, so the full-text index is updated in place by its trigger
+        # The label and blocking keys of the updated rows are computed again below
+        reset = "".join(f', "{column}" = NULL' for column in PRECOMPUTED_COLUMNS if column in existing)
+        updated = conn.execute(f'''UPDATE "addresses" SET ({quoted}, "row_hash") = (SELECT {quoted}, "row_hash"
+                FROM temp."addresses_update" AS u WHERE u."id" = "addresses"."id"){reset}
+                WHERE NOT EXISTS (SELECT 1 FROM temp."addresses_update" AS u WHERE u."id" = "addresses"."id"
+                AND u."row_hash" = "addresses"."row_hash")''').rowcount
+        inserted = conn.execute(f'''INSERT INTO "addresses" ({quoted}, "row_hash") SELECT {quoted}, "row_hash"
+                FROM temp."addresses_update" AS u WHERE NOT EXISTS (SELECT 1 FROM "addresses" AS a
+                WHERE a."id" = u."id")''').rowcount
+        conn.execute('DROP TABLE temp."addresses_update"')
+        if "label" in existing:
+            fill_precomputed_columns(conn)
+        conn.execute("COMMIT")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"[!] An error occurred during update: {e}")
+        return None
+    finally:
+        batches.close()
+        conn.close()
+
+    changes = {"inserted": inserted, "updated": updated, "deleted": deleted + duplicates}
+    if verbose:
+        print(f"[+] {database} updated in {time.perf_counter() - start:.2f}s: {inserted} inserted, {updated} updated, "
+              f"{deleted + duplicates} deleted")
+    return changes
+
+
+def update_ban_database(ban_url, department, ban_db, keep_gz, separator, chunksize, verbose, csv_file=None):
+    """
+    Download the BAN datasheet of a department, or read a local extract, and apply it to an existing database.
+
+    Parameters are the same as build_ban_database, csv_file is the path of a local extract to apply instead
+    of downloading the datasheet.
+
+    Returns:
+    - changes (dict): The number of rows inserted, updated and deleted, None if the update failed.
+    """
+    if csv_file:
+        return update_database(csv_file, ban_db, separator=separator, chunksize=chunksize, verbose=verbose)
+    url = f'{ban_url.rstrip("/")}/adresses-{department}.csv.gz'
+    ban_gz = url.split("/")[-1]
+    with open_ban_csv(url=url, output_path=ban_gz if keep_gz else None, verbose=verbose) as ban_csv:
+        return update_database(ban_csv, ban_db, separator=separator, chunksize=chunksize, verbose=verbose)
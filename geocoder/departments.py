@@ -0,0 +1,84 @@
+from pathlib import Path
+
+
+def expand_departments(departments):
+    """
+    Expand a list of departments, e.g. "21,75,2A" or "01-05,971-974", into the names of their BAN datasheets.
+
+    Ranges are made of codes of the same width, and 20 stands for both Corsican departments 2A and 2B.
+
+    Parameters:
+    - departments (str): Comma separated department codes and ranges, or "france".
+
+    Returns:
+    - departments (list): The department codes without duplicates, in the given order.
+    """
+    expanded = []
+    for part in departments.split(','):
+        part = part.strip().upper()
+        if not part:
+            continue
+        if part == 'FRANCE':
+            expanded.append('france')
+            continue
+        first, _, last = part.partition('-')
+        if last:
+            if not (first.isdigit() and last.isdigit()) or len(first) != len(last) or int(first) > int(last):
+                raise ValueError(f"Invalid range of departments: {part}")
+            codes = [str(number).zfill(len(first)) for number in range(int(first), int(last) + 1)]
+        else:
+            codes = [part]
+        for code in codes:
+            expanded.extend(['2A', '2B'] if code == '20' else [code])
+    if 'france' in expanded and len(expanded) > 1:
+        raise ValueError("france already holds every department")
+    return list(dict.fromkeys(expanded))
+
+
+def department_of_postal_code(postal_code):
+    """
+    Return the department of a 5-digit postal code: 2A or 2B in Corsica, 3 digits overseas.
+    """
+    if postal_code.startswith('20'):
+        return '2A' if int(postal_code) < 20200 else '2B'
+    if postal_code.startswith('97') or postal_code.startswith('98'):
+        return postal_code[:3]
+    return postal_code[:2]
+
+
+def shard_path(directory, department):
+    """
+    Return the file path of the database of a department in a directory of shards.
+    """
+    return str(Path(directory) / "{}.db".format(department))
+
+
+def list_shards(database):
+    """
+    Return the department databases of a directory of shards, or None if database is a single database file.
+
+    Returns:
+    - shards (dict): The file path of each department database by department code.
+    """
+    path = Path(database)
+    if not path.is_dir():
+        return None
+    # Shards being rebuilt are named <department>.tmp.db
+    return {shard.stem.upper(): str(shard) for shard in sorted(path.glob('*.db')) if '.' not in shard.stem}
+
+
+def route_address(postal_code, database, shards):
+    """
+    Return the databases holding the candidates of an address, given its postal code or None.
+
+    With shards, an address is routed to the department of its postal code. An address without postal code,
+    or whose department is not loaded, is looked up in every shard, like in a single database of the same
+    departments.
+    """
+    if not shards:
+        return [database]
+    if postal_code:
+        department = department_of_postal_code(postal_code)
+        if department in shards:
+            return [shards[department]]
+    return list(shards.values())
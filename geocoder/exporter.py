@@ -49,4 +49,81 @@ def export_to_sqlite(data, database, table, mode, index, verbose):
         print("[!] Error : {}".format(e))
         exit(1)
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+
+def iter_batches(records, batch_size):
+    """
+    Group an iterable of records (dicts) into DataFrames of at most batch_size rows.
+
+    Parameters:
+    - records (iterable): The records to group, consumed lazily.
+    - batch_size (int): The maximum number of rows of each DataFrame.
+
+    Yields:
+    - batch (DataFrame): A DataFrame indexed by the position of its rows in the whole stream.
+    """
+    batch = []
+    offset = 0
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield pd.DataFrame.from_records(batch, index=range(offset, offset + len(batch)))
+            offset += len(batch)
+            batch = []
+    if batch:
+        yield pd.DataFrame.from_records(batch, index=range(offset, offset + len(batch)))
+
+
+def export_batches(batches, output_csv, output_db, table, mode, header, index, verbose, schema=None, display=False,
+                   display_columns=None, metrics=None):
+    """
+    Export DataFrames to CSV and / or SQLite as they are produced, so memory stays bounded by the batch size
+    and the rows already written survive an interruption.
+
+    Parameters:
+    - batches (iterable): The DataFrames to export, consumed lazily.
+    - output_csv (str): The file path of the CSV output, or None.
+    - output_db (str): The file path of the SQLite output, or None.
+    - table (str): The name of the table to insert data into in the SQLite database.
+    - mode (str): How to behave if the file already exists ('fail', 'replace', 'append'), only the
+                  first batch uses it, the next ones are appended.
+    - header (bool): Flag to include the header row in the CSV output, written with the first batch only.
+    - index (bool): Flag to include the DataFrame index in the CSV / SQL output.
+    - verbose (bool): Flag to enable verbose output, which prints additional information.
+    - schema (list): Columns always exported, in this order, before the other columns of the first batch.
+    - display (bool): Flag to print each batch to the console.
+    - display_columns (list): Columns printed for each batch, None for all.
+    - metrics (Metrics): The metrics timing the export stage, None to not time it.
+
+    Returns:
+    - count (int): The number of rows exported.
+    """
+    if mode == "fail":
+        csvmode = "x"
+    elif mode == "replace":
+        csvmode = "w"
+    else:
+        csvmode = "a"
+    count = 0
+    columns = None
+    for batch in batches:
+        start = metrics.clock() if metrics is not None else None
+        if columns is None:
+            # The first batch fixes the schema of the outputs
+            columns = list(dict.fromkeys((schema or []) + list(batch.columns)))
+        batch = batch.reindex(columns=columns)
+        first = count == 0
+        count += len(batch)
+        if display:
+            shown = batch if display_columns is None else batch.reindex(columns=display_columns)
+            print(shown.to_string(index=False, header=first))
+        if output_csv is not None:
+            export_to_csv(batch, file=output_csv, mode=csvmode if first else "a", header=header and first,
+                          index=index, verbose=verbose)
+        if output_db is not None:
+            export_to_sqlite(batch, database=output_db, table=table, mode=mode if first else "append", index=index,
+                             verbose=verbose)
+        if metrics is not None:
+            metrics.add_time("export", start)
+    return count
@@ -1,13 +1,107 @@
-import json
-import urllib.parse
+import csv
+import io
 
-import pandas as pd
-import requests
+from .client import API_URL, BanClient
 
-from .addresses_matcher import AddressesMatcher
+# pandas, the matcher and the reverse geocoder are imported by the functions using them, so a single lookup
+# with the API does not pay for their import
 
+# Columns of the geocoded results of the API, always exported in this order when streaming
+FEATURE_COLUMNS = ['type', 'geometry_type', 'geometry_coordinates', 'properties_label', 'properties_score',
+                   'properties_housenumber', 'properties_id', 'properties_name', 'properties_postcode',
+                   'properties_citycode', 'properties_x', 'properties_y', 'properties_city', 'properties_context',
+                   'properties_type', 'properties_importance', 'properties_street']
 
-def perform_geocoding(address, limit, verbose):
+# Columns of the local geocoding results: the line number of the address in the input file, then its match and
+# the tier of the match strategy which matched it, an interpolated position has the score of an exact match but
+# is not in the BAN. The score of an unmatched address is the one of its best rejected candidate.
+LOCAL_COLUMNS = ['Row', 'Address', 'Latitude', 'Longitude', 'Score', 'Tier']
+
+# Columns of the reverse geocoding results, the distance between the point and the address in meters
+REVERSE_COLUMNS = ['Point_latitude', 'Point_longitude', 'Address', 'Latitude', 'Longitude', 'Distance']
+
+
+def flatten_feature(feature, prefix=''):
+    """
+    Flatten the nested objects of a GeoJSON feature into a single record, the keys joined by '_'
+    (e.g. 'properties_label'), like pandas.json_normalize.
+    """
+    record = {}
+    for key, value in feature.items():
+        if isinstance(value, dict):
+            record.update(flatten_feature(value, prefix + key + '_'))
+        else:
+            record[prefix + key] = value
+    return record
+
+
+def features_to_records(json_data, limit):
+    """
+    Convert a GeoJSON FeatureCollection returned by the geocoding API into records, without pandas.
+
+    Parameters:
+    - json_data (dict): The decoded response of the API.
+    - limit (int): The index of the last result to keep, 0 keeps the best one.
+
+    Returns:
+    - records (list): The results as dicts, with 'geometry_coordinates' as [lat, lon] pairs, or None
+      if the collection has no feature.
+    """
+    if json_data is None or not json_data.get('features'):
+        return None
+    records = [flatten_feature(feature) for feature in json_data['features'][:max(limit, 0) + 1]]
+    for record in records:
+        coords = record.get('geometry_coordinates')
+        # The API gives [lon, lat] pairs
+        if isinstance(coords, list) and len(coords) == 2:
+            record['geometry_coordinates'] = [coords[1], coords[0]]
+    return records
+
+
+def features_to_dataframe(json_data, limit):
+    """
+    Convert a GeoJSON FeatureCollection returned by the geocoding API into a DataFrame.
+
+    Parameters:
+    - json_data (dict): The decoded response of the API.
+    - limit (int): The index of the last result to keep, 0 keeps the best one.
+
+    Returns:
+    - geocoded (DataFrame): The results, with 'geometry_coordinates' as [lat, lon] pairs, or None
+      if the collection has no feature.
+    """
+    import pandas as pd
+
+    records = features_to_records(json_data, limit)
+    return pd.DataFrame.from_records(records) if records is not None else None
+
+
+def search_records(address, limit, verbose, client=None, cache=None):
+    """
+    Geocode an address with the geocoding API, returning plain records.
+
+    Parameters are the same as perform_geocoding.
+
+    Returns:
+    - records (list): The results as dicts with the columns of perform_geocoding, or None if the address
+      was not found.
+    """
+    if verbose:
+        print("[+] Geocoding address : {}".format(address))
+    namespace = 'search {}'.format(client.base_url if client is not None else API_URL)
+    json_data = cache.get(namespace, address) if cache is not None else None
+    if json_data is None:
+        if client is None:
+            with BanClient(verbose=verbose) as default_client:
+                json_data = default_client.search(address)
+        else:
+            json_data = client.search(address)
+        if cache is not None and json_data is not None:
+            cache.set(namespace, address, json_data)
+    return features_to_records(json_data, limit)
+
+
+def perform_geocoding(address, limit, verbose, client=None, cache=None):
     """
     Perform geocoding for a given address using an external geocoding API.
 
@@ -15,56 +109,174 @@ def perform_geocoding(address, limit, verbose):
     - address (str): The address to geocode.
     - limit (int): The maximum number of results to return.
     - verbose (bool): Flag to enable verbose output.
+    - client (BanClient): The HTTP client to use, a default client on the public API if None.
+    - cache (ResultCache): The cache of the API responses, None to always query the API.
 
     Returns:
     - geocoded (DataFrame): A pandas DataFrame containing geocoded results,
       including coordinates and address labels.
     """
-    if verbose:
-        print("[+] Geocoding address : {}".format(address))
-    address = urllib.parse.quote(address)
-    r = requests.get('https://api-adresse.data.gouv.fr/search/?q=' + address)
-    if len(r.text) != 136 and r.status_code == 200:
-        json_data = json.loads(r.text)
-        df = pd.json_normalize(
-            json_data['features'],
-            sep='_',
-            record_path=None,
-            meta=[
-                'type',
-                ['properties', 'label'],
-                ['properties', 'score'],
-                ['properties', 'housenumber'],
-                ['properties', 'id'],
-                ['properties', 'name'],
-                ['properties', 'postcode'],
-                ['properties', 'citycode'],
-                ['properties', 'x'],
-                ['properties', 'y'],
-                ['properties', 'city'],
-                ['properties', 'context'],
-                ['properties', 'type'],
-                ['properties', 'importance'],
-                ['properties', 'street'],
-                'geometry.type',
-                ['geometry', 'coordinates']
-            ],
-            errors='ignore'
-        )
-
-        # Assuming 'geocoded' is a pandas DataFrame and 'geometry_coordinates' contains pairs like [lon, lat]
-        if 'geometry_coordinates' in df.columns:
-            # Reverse the order of each pair [lon, lat] -> [lat, lon]
-            df['geometry_coordinates'] = df['geometry_coordinates'].apply(
-                lambda coords: [coords[1], coords[0]] if isinstance(coords, list) and len(coords) == 2 else coords)
-
-        geocoded = df.loc[:limit].copy()
-        return geocoded
-    else:
+    import pandas as pd
+
+    records = search_records(address, limit, verbose, client=client, cache=cache)
+    return pd.DataFrame.from_records(records) if records is not None else None
+
+
+def iter_geocoding(input_file, limit, verbose, concurrency=1, api_url=API_URL, timeout=10, retries=3, cache=None):
+    """
+    Geocode the addresses of a file with the external geocoding API, several requests in flight
+    over a shared pool of keep-alive connections.
+
+    Parameters:
+    - input_file (str): The file path of the text file containing addresses to geocode, one per line.
+    - limit (int): The maximum number of results to return for each address.
+    - verbose (bool): Flag to enable verbose output.
+    - concurrency (int): The maximum number of requests in flight.
+    - api_url (str): The root URL of the geocoding API.
+    - timeout (float): The timeout of each request, in seconds.
+    - retries (int): The number of retries of a failed request.
+    - cache (ResultCache): The cache of the API responses, None to always query the API.
+
+    Yields:
+    - record (dict): One geocoded result, with the columns of perform_geocoding, in input order.
+    """
+    namespace = 'search {}'.format(api_url.rstrip('/'))
+
+    def read_addresses():
+        with open(input_file, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    if verbose:
+                        print("[+] Geocoding address : {}".format(line))
+                    # The cache is read here, in the main thread, hits are not sent to the API
+                    yield line, cache.get(namespace, line) if cache is not None else None
+
+    with BanClient(base_url=api_url, concurrency=concurrency, timeout=timeout, retries=retries,
+                   verbose=verbose) as client:
+        def search(item):
+            address, json_data = item
+            return json_data if json_data is not None else client.search(address)
+
+        for (address, cached), json_data in client.map(search, read_addresses()):
+            if cache is not None and cached is None and json_data is not None:
+                cache.set(namespace, address, json_data)
+            records = features_to_records(json_data, limit)
+            if records is not None:
+                yield from records
+
+
+def bulk_row_to_record(row):
+    """
+    Convert a row returned by the /search/csv/ endpoint into a record with the columns of perform_geocoding.
+
+    Returns:
+    - record (dict): The geocoded result, or None if the address was not found.
+    """
+    if not row.get('latitude') or not row.get('longitude'):
         return None
+    return {
+        'type': 'Feature',
+        'geometry_type': 'Point',
+        'geometry_coordinates': [float(row['latitude']), float(row['longitude'])],
+        'properties_label': row.get('result_label'),
+        'properties_score': float(row['result_score']) if row.get('result_score') else None,
+        'properties_housenumber': row.get('result_housenumber') or None,
+        'properties_id': row.get('result_id') or None,
+        'properties_name': row.get('result_name') or None,
+        'properties_postcode': row.get('result_postcode') or None,
+        'properties_citycode': row.get('result_citycode') or None,
+        'properties_city': row.get('result_city') or None,
+        'properties_context': row.get('result_context') or None,
+        'properties_type': row.get('result_type') or None,
+        'properties_street': row.get('result_street') or None,
+    }
 
 
-def local_geocoding(input_file, database, processes, verbose):
+def iter_bulk_geocoding(input_file, verbose, bulk_size=5000, concurrency=1, api_url=API_URL, timeout=10, retries=3):
+    """
+    Geocode the addresses of a file with the /search/csv/ bulk endpoint of the geocoding API.
+
+    The file is split into CSV chunks of at most bulk_size addresses, uploaded (several at once with
+    concurrency) and the results are merged back, in input order, into the schema of perform_geocoding.
+    The bulk endpoint only returns the best result of each address.
+
+    Parameters:
+    - input_file (str): The file path of the text file containing addresses to geocode, one per line.
+    - verbose (bool): Flag to enable verbose output.
+    - bulk_size (int): The maximum number of addresses of each uploaded CSV.
+    - concurrency (int): The maximum number of uploads in flight.
+    - api_url (str): The root URL of the geocoding API.
+    - timeout (float): The timeout of each request, in seconds.
+    - retries (int): The number of retries of a failed upload.
+
+    Yields:
+    - record (dict): One geocoded result, with the columns of perform_geocoding, in input order.
+    """
+    def read_chunks():
+        chunk = io.StringIO()
+        writer = csv.writer(chunk)
+        writer.writerow(['address'])
+        size = 0
+        with open(input_file, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    writer.writerow([line])
+                    size += 1
+                    if size == bulk_size:
+                        yield chunk.getvalue().encode('utf-8')
+                        chunk = io.StringIO()
+                        writer = csv.writer(chunk)
+                        writer.writerow(['address'])
+                        size = 0
+        if size:
+            yield chunk.getvalue().encode('utf-8')
+
+    with BanClient(base_url=api_url, concurrency=concurrency, timeout=timeout, retries=retries,
+                   verbose=verbose) as client:
+        for number, (_, rows) in enumerate(client.map(client.search_csv, read_chunks()), start=1):
+            if rows is None:
+                print(f"[!] Chunk {number} of {input_file} could not be geocoded")
+                continue
+            if verbose:
+                print(f"[+] Chunk {number}: {len(rows)} addresses geocoded")
+            for row in rows:
+                record = bulk_row_to_record(row)
+                if record is not None:
+                    yield record
+
+
+def iter_local_geocoding(input_file, database, processes, verbose, batch=False, chunk_size=64, scorer="rapidfuzz",
+                         cache=None, fts=True, fts_limit=100, index=None, metrics=None, max_tier="wide", min_score=0,
+                         accept_score=None, dedup_size=1000000):
+    """
+    Geocode the addresses of a file with the local BAN database, yielding the results as they are matched.
+
+    Parameters are the same as local_geocoding, and:
+    - metrics (Metrics): The per-stage timers and counters of the matching, None to disable them.
+
+    Yields:
+    - record (dict): The 'Row' of each input address, its line number in the input file, with its matched
+                     'Address', 'Latitude', 'Longitude', 'Score' and 'Tier' ('exact', 'interpolated', 'fuzzy' or
+                     'wide'), in input order. An unmatched address gives a record without address.
+    """
+    from .addresses_matcher import AddressesMatcher
+
+    # Initialize the AddressesMatcher class with the provided database, number of processes, and verbosity
+    matcher = AddressesMatcher(database=database, num_processes=processes, verbose=verbose, batch=batch,
+                               chunk_size=chunk_size, scorer=scorer, cache=cache, fts=fts, fts_limit=fts_limit,
+                               index=index, metrics=metrics, max_tier=max_tier, min_score=min_score,
+                               accept_score=accept_score, dedup_size=dedup_size)
+
+    for row, _, matched_address, score, lat, lon, tier in matcher.iter_geocoded(input_file=input_file):
+        yield {'Row': row, 'Address': matched_address, 'Latitude': lat, 'Longitude': lon, 'Score': score,
+               'Tier': tier}
+
+
+def local_geocoding(input_file, database, processes, verbose, batch=False, chunk_size=64, scorer="rapidfuzz",
+                    cache=None, fts=True, fts_limit=100, index=None, max_tier="wide", min_score=0, accept_score=None,
+                    dedup_size=1000000):
     """
     Perform local geocoding on a set of addresses using a local Base Adresse Nationale (BAN) database.
 
@@ -77,36 +289,84 @@ def local_geocoding(input_file, database, processes, verbose):
     - database (str): The file path of the SQLite database containing the BAN data.
     - processes (int): The number of worker processes to use for multiprocessing.
     - verbose (bool): If set to True, additional information will be printed to the console during execution.
+    - batch (bool): Distribute whole addresses to the worker processes instead of splitting the candidates
+                    of each address across them.
+    - chunk_size (int): The number of addresses sent to a worker at once in batch mode.
+    - scorer (str): The fuzzy scoring backend, 'rapidfuzz' or 'thefuzz'.
+    - cache (ResultCache): The cache of the matches, None to match every address.
+    - fts (bool): Fetch the candidates of the addresses missing a house number or a postal code from the
+                  full-text index of the database, when it has one.
+    - fts_limit (int): The number of candidates fetched from the full-text index, best ranked first.
+    - index (str): The file path of an address index built by buildindex, mapped by every process to look up
+                   the addresses with a postal code, None to query the database only.
+    - max_tier (str): The last tier of the match strategy tried: 'exact', 'interpolated', 'fuzzy' or 'wide'.
+    - min_score (int): The minimum score of a fuzzy match, an address whose best candidate is below it is
+                       unmatched.
+    - accept_score (int): The score at which the candidates of an address stop being scored, None to score
+                          them all.
+    - dedup_size (int): The number of distinct standardized addresses whose match is reused for their
+                        duplicates, 0 to match every address.
 
     Returns:
-    - geocoded (DataFrame): A pandas DataFrame with columns 'Address', 'Latitude', and 'Longitude'.
-                            Each row contains the original address and its geocoded coordinates.
+    - geocoded (DataFrame): A pandas DataFrame with columns 'Row', 'Address', 'Latitude', 'Longitude', 'Score'
+                            and 'Tier'. Each row contains the line number of an input address, its matched
+                            address, its geocoded coordinates and the tier which matched it, empty when it is
+                            unmatched.
     """
-    # Initialize the AddressesMatcher class with the provided database, number of processes, and verbosity
-    matcher = AddressesMatcher(database=database, num_processes=processes, verbose=verbose)
+    import pandas as pd
 
-    # Use the geocode_addresses method to geocode the addresses from the input file
-    addresses_geocoded = matcher.geocode_addresses(input_file=input_file)
+    return pd.DataFrame(list(iter_local_geocoding(input_file=input_file, database=database, processes=processes,
+                                                  verbose=verbose, batch=batch, chunk_size=chunk_size,
+                                                  scorer=scorer, cache=cache, fts=fts, fts_limit=fts_limit,
+                                                  index=index, max_tier=max_tier, min_score=min_score,
+                                                  accept_score=accept_score, dedup_size=dedup_size)),
+                        columns=LOCAL_COLUMNS)
 
-    # Prepare lists to store individual latitude and longitude values
-    latitudes = []
-    longitudes = []
 
-    # Obtain the list of addresses from the geocoded results
-    addresses = list(addresses_geocoded.keys())
+def iter_reverse_geocoding(points, database, radius=200, limit=1, chunk_size=10000, verbose=False):
+    """
+    Find the nearest addresses of points with the spatial index of the local BAN database.
+
+    Parameters:
+    - points (iterable): The (latitude, longitude) of the points, or the file path of a text file with one
+                         "latitude,longitude" per line.
+    - database (str): The file path of the SQLite database containing the BAN data, or a directory of
+                      department databases.
+    - radius (float): The maximum distance in meters between a point and its addresses.
+    - limit (int): The maximum number of addresses of each point, nearest first.
+    - chunk_size (int): The number of points looked up at once.
+    - verbose (bool): Flag to enable verbose output.
+
+    Yields:
+    - record (dict): One address of a point with the columns of REVERSE_COLUMNS, in input order. A point
+                     without address within the radius gives a record without address.
+    """
+    from .reverse import ReverseGeocoder, read_points
+
+    if isinstance(points, str):
+        if verbose:
+            print("[+] Reading file {}".format(points))
+        points = read_points(points, verbose=verbose)
+    with ReverseGeocoder(database=database, radius=radius, limit=limit, verbose=verbose) as reverse_geocoder:
+        for lat, lon, addresses in reverse_geocoder.iter_reversed(points, chunk_size=chunk_size):
+            if not addresses:
+                yield {'Point_latitude': lat, 'Point_longitude': lon, 'Address': None, 'Latitude': None,
+                       'Longitude': None, 'Distance': None}
+            for address, address_lat, address_lon, distance in addresses:
+                yield {'Point_latitude': lat, 'Point_longitude': lon, 'Address': address, 'Latitude': address_lat,
+                       'Longitude': address_lon, 'Distance': round(distance, 1)}
 
-    # Iterate through the geocoded coordinates and split them into latitude and longitude
-    for coords in addresses_geocoded.values():
-        lat, lon = coords.split(', ')
-        latitudes.append(lat)
-        longitudes.append(lon)
 
-    # Create a DataFrame with the addresses and their corresponding latitude and longitude
-    geocoded = pd.DataFrame({
-        'Address': addresses,
-        'Latitude': latitudes,
-        'Longitude': longitudes
-    })
+def reverse_geocoding(points, database, radius=200, limit=1, verbose=False):
+    """
+    Find the nearest addresses of points with the local BAN database.
+
+    Parameters are the same as iter_reverse_geocoding.
+
+    Returns:
+    - geocoded (DataFrame): A pandas DataFrame with the columns of REVERSE_COLUMNS.
+    """
+    import pandas as pd
 
-    # Return the DataFrame containing the geocoded data
-    return geocoded
+    return pd.DataFrame(list(iter_reverse_geocoding(points, database=database, radius=radius, limit=limit,
+                                                    verbose=verbose)), columns=REVERSE_COLUMNS)
@@ -0,0 +1,164 @@
+import bisect
+import json
+import time
+
+# Upper bounds of the buckets of the histogram of the match scores
+SCORE_BUCKETS = (50, 60, 70, 80, 90, 95, 100)
+
+# Prefix of the metrics exported in the Prometheus text format
+PROMETHEUS_PREFIX = "ban_geocoder"
+
+
+class Metrics:
+    """
+    Per-stage timers and counters of the geocoding pipeline.
+
+    A stage is timed by reading clock() before it and calling add_time() after it. The workers of the pool keep
+    their own Metrics and send a snapshot of it with each result, merged into the Metrics of the main process.
+    """
+    enabled = True
+
+    def __init__(self):
+        # Stage -> [calls, seconds]
+        self.timers = {}
+        self.counters = {}
+        # One count per bucket of SCORE_BUCKETS, the last one for the scores above the last bound
+        self.scores = [0] * (len(SCORE_BUCKETS) + 1)
+        # Sum of the observed scores, the _sum of the Prometheus histogram
+        self.score_sum = 0
+        self.started = time.perf_counter()
+
+    clock = staticmethod(time.perf_counter)
+
+    def add_time(self, stage, start, calls=1):
+        """
+        Add the time elapsed since start, a value of clock(), to a stage.
+        """
+        elapsed = time.perf_counter() - start
+        timer = self.timers.get(stage)
+        if timer is None:
+            self.timers[stage] = [calls, elapsed]
+        else:
+            timer[0] += calls
+            timer[1] += elapsed
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_score(self, score):
+        self.scores[bisect.bisect_left(SCORE_BUCKETS, score)] += 1
+        self.score_sum += score
+
+    def snapshot(self):
+        """
+        Return the timers, counters and scores histogram as a picklable dict.
+        """
+        return {"timers": {stage: list(timer) for stage, timer in self.timers.items()},
+                "counters": dict(self.counters), "scores": list(self.scores), "score_sum": self.score_sum}
+
+    def pop(self):
+        """
+        Return the snapshot of the metrics and reset them, e.g. in a worker after each task.
+        """
+        snapshot = {"timers": self.timers, "counters": self.counters, "scores": self.scores,
+                    "score_sum": self.score_sum}
+        self.timers, self.counters, self.scores = {}, {}, [0] * (len(SCORE_BUCKETS) + 1)
+        self.score_sum = 0
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Add the snapshot of other metrics, e.g. of a worker, to these metrics.
+        """
+        for stage, (calls, seconds) in snapshot["timers"].items():
+            timer = self.timers.get(stage)
+            if timer is None:
+                self.timers[stage] = [calls, seconds]
+            else:
+                timer[0] += calls
+                timer[1] += seconds
+        for name, value in snapshot["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for bucket, count in enumerate(snapshot["scores"]):
+            self.scores[bucket] += count
+        self.score_sum += snapshot["score_sum"]
+
+    def summary(self):
+        """
+        Return the metrics as printable lines: the stages by decreasing time, the counters and the scores histogram.
+        """
+        elapsed = time.perf_counter() - self.started
+        lines = [f"[+] Stages ({elapsed:.2f}s of wall time, the times of the workers add up):"]
+        for stage, (calls, seconds) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+            lines.append(f"    {stage:<16} {calls:>10} calls {seconds:>10.3f}s {seconds / calls * 1000:>10.3f} ms/call")
+        if self.counters:
+            lines.append("[+] Counters:")
+            lines.extend(f"    {name:<16} {value:>10}" for name, value in sorted(self.counters.items()))
+        if any(self.scores):
+            bounds = [f"<={bound}" for bound in SCORE_BUCKETS] + [f">{SCORE_BUCKETS[-1]}"]
+            lines.append("[+] Scores: " + ", ".join(f"{bound}: {count}" for bound, count in zip(bounds, self.scores)
+                                                    if count))
+        return lines
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = [f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds_total counter"]
+        lines.extend(f'{PROMETHEUS_PREFIX}_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}'
+                     for stage, (_, seconds) in sorted(self.timers.items()))
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_calls_total counter")
+        lines.extend(f'{PROMETHEUS_PREFIX}_stage_calls_total{{stage="{stage}"}} {calls}'
+                     for stage, (calls, _) in sorted(self.timers.items()))
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}_total {value}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_match_score histogram")
+        cumulative = 0
+        for bound, count in zip(SCORE_BUCKETS, self.scores):
+            cumulative += count
+            lines.append(f'{PROMETHEUS_PREFIX}_match_score_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{PROMETHEUS_PREFIX}_match_score_bucket{{le="+Inf"}} {sum(self.scores)}')
+        lines.append(f"{PROMETHEUS_PREFIX}_match_score_sum {self.score_sum}")
+        lines.append(f"{PROMETHEUS_PREFIX}_match_score_count {sum(self.scores)}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, format="json"):
+        """
+        Save the metrics to a file: one JSON line appended per run, or a Prometheus text file replaced at each run.
+        """
+        if format == "prometheus":
+            with open(path, "w") as f:
+                f.write(self.to_prometheus())
+            return
+        record = {"time": time.time(), "seconds": round(time.perf_counter() - self.started, 6)}
+        record.update(self.snapshot())
+        record["score_buckets"] = list(SCORE_BUCKETS)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class NullMetrics:
+    """
+    Metrics doing nothing, used when the metrics are disabled so the timed stages cost a couple of empty calls.
+    """
+    enabled = False
+
+    @staticmethod
+    def clock():
+        return 0
+
+    def add_time(self, stage, start, calls=1):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def observe_score(self, score):
+        pass
+
+    def merge(self, snapshot):
+        pass
+
+
+NULL_METRICS = NullMetrics()
@@ -0,0 +1,264 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+# Abbreviations of the street types and common words of addresses and their expansion, in the order of the
+# norm. An abbreviation listed several times expands to its last expansion.
+ABBREVIATIONS = [
+    # Norme XP Z 10-011
+    ("ALL", "ALLÉE"),
+    ("AV", "AVENUE"),
+    ("BD", "BOULEVARD"),
+    ("CTRE", "CENTRE"),
+    ("CCAL", "CENTRE COMMERCIAL"),
+    ("CHEM", "CHEMIN"),
+    ("IMM", "IMMEUBLE"),
+    ("IMM", "IMMEUBLES"),
+    ("IMP", "IMPASSE"),
+    ("LD", "LIEU-DIT"),
+    ("LOT", "LOTISSEMENT"),
+    ("PAS", "PASSAGE"),
+    ("PL", "PLACE"),
+    ("RES", "RÉSIDENCE"),
+    ("RPT", "ROND-POINT"),
+    ("RTE", "ROUTE"),
+    ("SENT", "SENTIER"),
+    ("SQ", "SQUARE"),
+    ("VLGE", "VILLAGE"),
+    ("ZA", "ZONE D’ACTIVITÉ"),
+    ("ZAC", "ZONE D’AMÉNAGEMENT CONCERTÉ"),
+    ("ZAD", "ZONE D’AMÉNAGEMENT DIFFÉRÉ"),
+    ("ZI", "ZONE INDUSTRIELLE"),
+
+    # Norme XP Z 10-011
+    ("ADJ", "ADJUDANT"),
+    ("AERD", "AÉRODROME"),
+    ("AERG", "AÉROGARE"),
+    ("AERN", "AÉORONAUTIQUE"),
+    ("AERP", "AÉROPORT"),
+    ("AGCE", "AGENCE"),
+    ("AGRIC", "AGRICOLE"),
+    ("ANC", "ANCIEN"),
+    ("ANC", "ANCIENNEMENT"),
+    ("APP", "APPARTEMENT"),
+    ("APP", "APPARTEMENTS"),
+    ("ARMT", "ARMEMENT"),
+    ("ARR", "ARRONDISSEMENT"),
+    ("ASP", "ASPIRANT"),
+    ("ASSOC", "ASSOCIATION"),
+    ("ASSUR", "ASSURANCE"),
+    ("AT", "ATELIER"),
+    ("BRQ", "BARAQUEMENT"),
+    ("BAS", "BAS"),
+    ("BAS", "BASSE"),
+    ("BAS", "BASSES"),
+    ("BTN", "BATAILLON"),
+    ("BTN", "BATAILLONS"),
+    ("BAT", "BÂTIMENT"),
+    ("BAT", "BÂTIMENTS"),
+    ("B", "BIS"),
+    ("BP", "BOITE POSTALE"),
+    ("CAB", "CABINET"),
+    ("CANT", "CANTON"),
+    ("CDL", "CARDINAL"),
+    ("CP", "CASE POSTALE"),
+    ("CHBR", "CHAMBRE"),
+    ("CTD", "CITADELLE"),
+    ("COLL", "COLLÈGE"),
+    ("CNL", "COLONEL"),
+    ("COLO", "COLONIE"),
+    ("CTE", "COMITÉ"),
+    ("CDT", "COMMANDANT"),
+    ("CIAL", "COMMERCIAL"),
+    ("COM", "COMMUNE"),
+    ("COM", "COMMUNEAL"),
+    ("COM", "COMMUNEAUX"),
+    ("CIE", "COMPAGNIE"),
+    ("COMP", "COMPAGNON"),
+    ("COMP", "COMPAGNONS"),
+    ("COOP", "COOPÉRATIVE"),
+    ("CS", "COURSE SPÉCIALE"),
+    ("CRX", "CROIX"),
+    ("DELEG", "DÉLÉGATION"),
+    ("DEP", "DÉPARTEMENTAL"),
+    ("DEP", "DÉPARTEMENTALAUX"),
+    ("DIR", "DIRECTEUR"),
+    ("DIR", "DIRECTEURCTION"),
+    ("DIV", "DIVISION"),
+    ("DR", "DOCTEUR"),
+    ("ECO", "ECONOMIE"),
+    ("ECO", "ECONOMIEQUE"),
+    ("ECRIV", "ECRIVAIN"),
+    ("ENST", "ENSEIGNEMENT"),
+    ("ENS", "ENSEMBLE"),
+    ("ENT", "ENTRÉE"),
+    ("ENT", "ENTRÉES"),
+    ("ENTR", "ENTREPRISE"),
+    ("EP", "EPOUX"),
+    ("EP", "EPOUSE"),
+    ("ETS", "ETABLISSEMENT"),
+    ("ETG", "ETAGE"),
+    ("EM", "ETAT MAJOR"),
+    ("EVQ", "EVÊQUE"),
+    ("FAC", "FACULTÉ"),
+    ("FOR", "FORÊT"),
+    ("FOR", "FORESTIER"),
+    ("FR", "FRANÇAIS"),
+    ("FR", "FRANÇAISE"),
+    ("FUS", "FUSILIER"),
+    ("GEND", "GENDARMERIE"),
+    ("GAL", "GÉNÉRAL"),
+    ("GOUV", "GOUVERNEMENTAL"),
+    ("GOU", "GOUVERNEUR"),
+    ("GD", "GRAND"),
+    ("GDE", "GRANDE"),
+    ("GDES", "GRANDES"),
+    ("GDS", "GRANDS"),
+    ("HT", "HAUT"),
+    ("HTE", "HAUTE"),
+    ("HTES", "HAUTES"),
+    ("HTS", "HAUTS"),
+    ("HOP", "HÔPITAL"),
+    ("HOP", "HÔPITAUX"),
+    ("HOSP", "HOSPICE"),
+    ("HOSP", "HOSPITALIER"),
+    ("HOT", "HÔTEL"),
+    ("INFANT", "INFANTERIE"),
+    ("INF", "INFÉRIEUR"),
+    ("INF", "INFÉRIEURE"),
+    ("ING", "INGÉNIEUR"),
+    ("INSP", "INSPECTEUR"),
+    ("INST", "INSTITUT"),
+    ("INTERN", "INTERNATIONAL"),
+    ("INTERN", "INTERNATIONALE"),
+    ("LABO", "LABORATOIRE"),
+    ("LT", "LIEUTENANT"),
+    ("LTDV", "LIEUTENANT DE VAISSEAU"),
+    ("MME", "MADAME"),
+    ("MLLE", "MADEMOISELLE"),
+    ("MAG", "MAGASIN"),
+    ("MAIS", "MAISON"),
+    ("ME", "MAÎTRE"),
+    ("MAL", "MARÉCHAL"),
+    ("MAR", "MARITIME"),
+    ("MED", "MÉDECIN"),
+    ("MED", "MÉDICAL"),
+    ("MMES", "MESDAMES"),
+    ("MLLES", "MESDEMOISELLES"),
+    ("MM", "MESSIEURS"),
+    ("MIL", "MILITAIRE"),
+    ("MIN", "MINISTÈRE"),
+    ("MGR", "MONSEIGNEUR"),
+    ("M", "MONSIEUR"),
+    ("MUN", "MUNICIPAL"),
+    ("MUT", "MUTUEL"),
+    ("NAL", "NATIONAL"),
+    ("ND", "NOTRE DAME"),
+    ("NOUV", "NOUVEAU"),
+    ("NOUV", "NOUVELLE"),
+    ("OBS", "OBSERVATOIRE"),
+    ("PAST", "PASTEUR"),
+    ("PT", "PETIT"),
+    ("PTE", "PETITE"),
+    ("PTES", "PETITES"),
+    ("PTS", "PETITS"),
+    ("POL", "POLICE"),
+    ("PREF", "PRÉFET"),
+    ("PREF", "PRÉFÉCTURE"),
+    ("PDT", "PRÉSIDENT"),
+    ("PR", "PROFESSEUR"),
+    ("PROF", "PROFESSIONEL"),
+    ("PROF", "PROFESSIONELE"),
+    ("PROL", "PROLONGÉ"),
+    ("PROL", "PROLONGÉE"),
+    ("PROP", "PROPRIÉTÉ"),
+    ("Q", "QUATER"),
+    ("C", "QUINQUIES"),
+    ("RECT", "RECTEUR"),
+    ("RGT", "RÉGIMENT"),
+    ("REG", "RÉGION"),
+    ("REG", "RÉGIONAL"),
+    ("REP", "RÉPUBLIQUE"),
+    ("REST", "RESTAURANT"),
+    ("ST", "SAINT"),
+    ("STE", "SAINTE"),
+    ("STES", "SAINTES"),
+    ("STS", "SAINTS"),
+    ("SANA", "SANATORIUM"),
+    ("SGT", "SERGENT"),
+    ("SCE", "SERVICE"),
+    ("SOC", "SOCIÉTÉ"),
+    ("SC", "SOUS COUVERT"),
+    ("SPREF", "SOUS-PRÉFET"),
+    ("SUP", "SUPÉRIEUR"),
+    ("SUP", "SUPÉRIEURE"),
+    ("SYND", "SYNDICAT"),
+    ("TECH", "TECHNICIEN"),
+    ("TECH", "TECHNIQUE"),
+    ("T", "TER"),
+    ("TSA", "TRI SERVICE ARRIVÉE"),
+    ("TUN", "TUNNEL"),
+    ("UNVT", "UNIVERSITAIRE"),
+    ("UNIV", "UNIVERSITÉ"),
+    ("VELOD", "VÉLODROME"),
+    ("VVE", "VEUVE"),
+    ("VIEL", "VIEILLE"),
+    ("VIEL", "VIEILLES"),
+    ("VX", "VIEUX"),
+
+    # Added
+    ("R", "RUE"),
+]
+
+# Expansion of each upper case abbreviation, capitalized the way it is written back in the address, built once
+REPLACEMENTS = {abbreviation: expansion.capitalize() for abbreviation, expansion in ABBREVIATIONS}
+
+PATTERN_NOT_AFNOR = re.compile(r'[^A-Z0-9]+')
+
+# Size of the caches of the folded keys, the BAN repeats the same street and city names on many rows
+KEY_CACHE_SIZE = 1 << 16
+
+
+def normalize(address):
+    """
+    Normalize an input address: remove the commas, semicolons and colons, and expand the abbreviated words
+    (e.g. "bd" to "Boulevard") of addresses of more than one word, which are rejoined with single spaces.
+
+    Each word is looked up once in the REPLACEMENTS table, whatever its size.
+    """
+    # str.replace is much faster than str.translate on the non-ASCII addresses
+    address = address.replace(',', '').replace(';', '').replace(':', '').strip()
+    parts = address.split()
+    if len(parts) <= 1:
+        return address
+    get = REPLACEMENTS.get
+    return ' '.join([get(part.upper(), part) for part in parts])
+
+
+def normalize_many(addresses):
+    """
+    Normalize a list of addresses in one call with normalize.
+
+    Returns:
+    - addresses (list): The normalized addresses, in the same order.
+    """
+    return list(map(normalize, addresses))
+
+
+def fold(text):
+    """
+    Fold a text the way the nom_afnor column is written: upper case, no accent, only letters, digits and spaces.
+    """
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').upper()
+    return PATTERN_NOT_AFNOR.sub(' ', text).strip()
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def street_type_key(street):
+    """
+    Return the blocking key of the street type of a street name or keyword: the first word of its folded form,
+    or None if it has none. initdb computes it from the nom_afnor of the BAN rows, the matcher from the street
+    type found in an input address.
+    """
+    words = fold(street).split() if street else None
+    return words[0] if words else None
@@ -0,0 +1,72 @@
+import re
+from collections import namedtuple
+
+from .normalizer import fold, street_type_key
+
+# Street types recognized at the start of a street name, as their blocking key: the first word of the folded type,
+# the way prepare_database computes the type_voie column from nom_afnor
+STREET_TYPES = frozenset(street_type_key(street_type) for street_type in [
+    'Allée', 'Avenue', 'Boulevard', 'Centre', 'Centre commercial', 'Chaussée', 'Chemin', 'Cité', 'Clos', 'Cours',
+    'Esplanade', 'Hameau', 'Immeuble', 'Immeubles', 'Impasse', 'Lieu-dit', 'Lotissement', 'Montée', 'Passage',
+    'Place', 'Promenade', 'Quai', 'Résidence', 'Rond-point', 'Route', 'Rue', 'Ruelle', 'Sentier', 'Square',
+    'Traverse', 'Village', 'Voie', 'Zone d’activité', 'Zone d’aménagement concerté', 'Zone d’aménagement différé',
+    'Zone industrielle'])
+
+# An address in a single match: the house number (up to 4 digits, a leading 5-digit number is a postal code) and
+# its repetition index, the street, the first 5-digit number (the postal code) followed by the city, and a trailing
+# CEDEX with its number
+PATTERN_ADDRESS = re.compile(r"""
+    (?:(?P<numero>\d{1,4})(?!\d)\s*(?:(?P<rep>BIS|TER|QUATER|QUINQUIES|[A-Z])\b)?)?\s*
+    (?P<street>.*?)
+    (?:\s*\b(?P<postal_code>\d{5})\b\s*(?P<commune>.*?))?
+    (?:\s*\bCEDEX\b\s*(?P<cedex>\d*))?
+    \s*$""", re.IGNORECASE | re.VERBOSE | re.DOTALL)
+
+# Components of a standardized address, each None when missing. Without a postal code, the city cannot be told
+# apart from the street and stays at the end of the street.
+# - address: the standardized address
+# - numero, rep: the house number and its repetition index (bis, ter, a, ...) as written
+# - street_type: the blocking key of the street type, e.g. "RUE", when the street starts with a known type
+# - street: the street name as written, with its type
+# - postal_code, commune, cedex: the 5-digit postal code, the city after it and the number of a CEDEX
+ParsedAddress = namedtuple('ParsedAddress', ['address', 'numero', 'rep', 'street_type', 'street', 'postal_code',
+                                             'commune', 'cedex'])
+
+
+def parse(standardized_address):
+    """
+    Split a standardized address into its components in a single match of PATTERN_ADDRESS.
+
+    Parameters:
+    - standardized_address (str): The address, normalized by normalizer.normalize.
+
+    Returns:
+    - parsed (ParsedAddress): The components of the address.
+    """
+    numero, rep, street, postal_code, commune, cedex = PATTERN_ADDRESS.match(standardized_address).groups()
+    street_type = street_type_key(street) if street else None
+    if street_type not in STREET_TYPES:
+        street_type = None
+    return ParsedAddress(standardized_address, numero, rep, street_type, street or None, postal_code,
+                         commune or None, cedex)
+
+
+def parse_many(standardized_addresses):
+    """
+    Parse a list of standardized addresses in one call with parse.
+
+    Returns:
+    - parsed (list): The ParsedAddress of each address, in the same order.
+    """
+    return list(map(parse, standardized_addresses))
+
+
+def street_word(parsed):
+    """
+    Return the last folded word of the street name of a parsed address followed by a postal code, the part of the
+    name most specific to the street, or None.
+    """
+    if parsed.postal_code is None or parsed.street is None or parsed.street_type is None:
+        return None
+    words = fold(parsed.street).split()
+    return words[-1] if len(words) > 1 else None
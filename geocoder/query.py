@@ -0,0 +1,228 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from .normalizer import KEY_CACHE_SIZE, fold
+from .parser import street_word
+
+# Soundex codes of the consonants, adapted to French: vowels, H, W and Y have no code
+PHONETIC_CODES = {letter: code for letters, code in [('BP', '1'), ('CKQ', '2'), ('DT', '3'), ('L', '4'),
+                                                     ('MN', '5'), ('R', '6'), ('GJ', '7'), ('SXZ', '8'),
+                                                     ('FV', '9')] for letter in letters}
+
+# Comparison string of an address with consideration for "rep" values, built from the columns of the
+# {table} alias. prepare_database materializes it in the label column.
+LABEL_EXPRESSION = """CASE WHEN {table}rep IS NOT NULL AND trim({table}rep) != ''
+    THEN {table}numero || ' ' || {table}rep || ' ' || {table}nom_voie ELSE {table}numero || ' ' || {table}nom_voie END
+    || ' ' || {table}code_postal || ' ' || {table}nom_commune"""
+
+# Street type of an address, the first word of its nom_afnor, for the databases without the type_voie column
+# materialized by prepare_database.
+TYPE_VOIE_EXPRESSION = """CASE WHEN instr(nom_afnor, ' ') > 0 THEN substr(nom_afnor, 1, instr(nom_afnor, ' ') - 1)
+    ELSE nom_afnor END"""
+
+# Address query restricted to a rowid range of the table. The predicates are bound parameters, so each
+# shape of query is compiled once and reused from the statement cache of the connection. A selective
+# query always runs on the whole table: its range is written +rowid so the planner does not pick an
+# index for the rowid range over the covering index of the postal code and house number.
+CANDIDATES_QUERY = """SELECT {label} AS address, lat, lon FROM addresses WHERE {where_clause}
+    AND {rowid} BETWEEN ? AND ?"""
+
+# Top-N candidates ranked by BM25 on the full-text index built by initdb
+FTS_CANDIDATES_QUERY = """SELECT {label} AS address, a.lat, a.lon FROM addresses_fts
+    JOIN addresses a ON a.rowid = addresses_fts.rowid WHERE addresses_fts MATCH ?
+    AND addresses_fts.rowid BETWEEN ? AND ? ORDER BY addresses_fts.rank LIMIT {limit}"""
+
+# Columns materialized by prepare_database: the label and the blocking keys
+PRECOMPUTED_COLUMNS = ['label', 'type_voie', 'commune_phonetic']
+
+# Rowid range covering a whole table
+WHOLE_TABLE = (-2 ** 63, 2 ** 63 - 1)
+
+# Largest number of words of a city name looked up at the end of an address without postal code
+COMMUNE_MAX_WORDS = 4
+
+# Words too frequent to help the full-text ranking
+FTS_STOPWORDS = {'A', 'AU', 'AUX', 'D', 'DE', 'DES', 'DU', 'EN', 'ET', 'L', 'LA', 'LE', 'LES', 'SOUS', 'SUR'}
+
+# A candidates query: SQL ending with the two placeholders of the rowid range, its parameters without the
+# rowid range, whether it only reads a handful of rows, and an optional CandidateQuery run when it finds nothing
+CandidateQuery = namedtuple('CandidateQuery', ['sql', 'params', 'selective', 'fallback'])
+
+
+def extract_query_keys(parsed):
+    """
+    Extract the keys of the candidates query of a parsed address.
+
+    Returns:
+    - keys (tuple): The house number, the 5-digit postal code, the blocking key of the street type and the
+      folded last word of the street name, each None when missing.
+    """
+    return parsed.numero, parsed.postal_code, parsed.street_type, street_word(parsed)
+
+
+def commune_keys(parsed):
+    """
+    Return the phonetic keys of the last words of the street of a parsed address without postal code, one of
+    which is the key of its city when the city is written after the street.
+    """
+    words = fold(parsed.street).split()[1:] if parsed.street else []
+    return list(dict.fromkeys(phonetic_key(' '.join(words[-count:]))
+                              for count in range(1, min(len(words), COMMUNE_MAX_WORDS) + 1)))
+
+
+def build_candidates_query(parsed, fts_limit=0, precomputed=False):
+    """
+    Build the parameterized query selecting the candidate addresses of a parsed address.
+
+    With fts_limit, an address missing its house number or postal code is looked up in the full-text
+    index instead: the fts_limit best candidates by BM25 matching all its words, or any of them if none
+    matches all of them.
+
+    Predicates are ordered by selectivity (postal code, street, house number). With a postal code, the
+    street type and name are residual filters over the postal code index rows; without it, the street
+    type becomes a prefix range on nom_afnor which can use its index, unlike a LIKE '%...%'. The query
+    narrowed by the last word of the street name falls back to the same query without it, for a misspelled
+    name.
+
+    With precomputed, the database has the columns of prepare_database: the label is read instead of
+    built, and the street type is an equality on its blocking key, so the postal code and house number
+    lookups are answered by a covering index. An address with a house number and a street type but no
+    postal code is then looked up by the phonetic key of its city, falling back to the full-text query or
+    the scan of its street type when the city is not found.
+
+    Returns:
+    - query (CandidateQuery): The query, selective when the house number and the postal code or the city
+      restrict the candidates.
+    """
+    predicates = []
+    params = []
+
+    starting_number, postal_code, street_type, street_name = extract_query_keys(parsed)
+    selective = bool(starting_number and postal_code)
+    label = "label" if precomputed else LABEL_EXPRESSION.format(table="")
+
+    query = None
+    if fts_limit and not selective:
+        words = [word for word in fold(parsed.address).split() if word not in FTS_STOPWORDS]
+        if words:
+            sql = FTS_CANDIDATES_QUERY.format(label="a.label" if precomputed else LABEL_EXPRESSION.format(table="a."),
+                                              limit=int(fts_limit))
+            query = CandidateQuery(sql, (' '.join(f'"{word}"' for word in words),), False,
+                                   CandidateQuery(sql, (' OR '.join(f'"{word}"' for word in words),), False, None))
+
+    if query is None:
+        if postal_code:
+            predicates.append("code_postal = ?")
+            params.append(postal_code)
+
+        if street_type:
+            if precomputed:
+                predicates.append("type_voie = ?")
+                params.append(street_type)
+            elif postal_code:
+                predicates.append("instr(nom_afnor, ?) > 0")
+                params.append(street_type)
+            else:
+                predicates.append("nom_afnor >= ? AND nom_afnor < ?")
+                params.extend([street_type, street_type + '\uffff'])
+
+        if starting_number:
+            predicates.append("numero = ?")
+            params.append(int(starting_number))
+
+        where_clause = " AND ".join(predicates) if predicates else "1=1"
+        query = CandidateQuery(CANDIDATES_QUERY.format(label=label, where_clause=where_clause,
+                                                       rowid="+rowid" if selective else "rowid"),
+                               tuple(params), selective, None)
+        if street_name:
+            query = CandidateQuery(CANDIDATES_QUERY.format(label=label, where_clause=where_clause
+                                                           + " AND instr(nom_afnor, ?) > 0",
+                                                           rowid="+rowid" if selective else "rowid"),
+                                   query.params + (street_name,), selective, query)
+
+    if precomputed and starting_number and street_type and not postal_code:
+        keys = commune_keys(parsed)
+        if keys:
+            where_clause = "commune_phonetic IN ({}) AND type_voie = ? AND numero = ?".format(
+                ", ".join("?" * len(keys)))
+            query = CandidateQuery(CANDIDATES_QUERY.format(label=label, where_clause=where_clause, rowid="+rowid"),
+                                   tuple(keys) + (street_type, int(starting_number)), True, query)
+    return query
+
+
+def build_street_query(parsed, precomputed=False):
+    """
+    Build the query selecting every house number of the street of a parsed address, the neighbours of a house
+    number missing from the BAN.
+
+    Returns:
+    - query (CandidateQuery): The query, or None if the postal code, street type or street name is missing.
+    """
+    postal_code, street_type, street_name = parsed.postal_code, parsed.street_type, street_word(parsed)
+    if not (postal_code and street_type and street_name):
+        return None
+    where_clause = "code_postal = ? AND {} AND instr(nom_afnor, ?) > 0".format(
+        "type_voie = ?" if precomputed else "instr(nom_afnor, ?) > 0")
+    sql = CANDIDATES_QUERY.format(label="label" if precomputed else LABEL_EXPRESSION.format(table=""),
+                                  where_clause=where_clause, rowid="+rowid")
+    return CandidateQuery(sql, (postal_code, street_type, street_name), True, None)
+
+
+def fetch_candidates(conn, query, first_rowid, last_rowid, fallback=True):
+    """
+    Run a candidates query on a rowid range, and with fallback its fallbacks in turn while they find nothing.
+
+    Returns:
+    - rows (list): The (address, lat, lon) of the candidates.
+    """
+    rows = conn.execute(query.sql, query.params + (first_rowid, last_rowid)).fetchall()
+    if not rows and fallback and query.fallback is not None:
+        return fetch_candidates(conn, query.fallback, first_rowid, last_rowid)
+    return rows
+
+
+def has_precomputed_columns(conn):
+    """
+    Return True if prepare_database materialized the label and blocking keys of the addresses.
+    """
+    columns = {row[1] for row in conn.execute('PRAGMA table_info("addresses")')}
+    if not columns.issuperset(PRECOMPUTED_COLUMNS):
+        return False
+    # Rows added since the last prepare_database have no label yet
+    return conn.execute("""SELECT 1 FROM addresses WHERE label IS NULL LIMIT 1""").fetchone() is None
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def phonetic_key(text):
+    """
+    Return a phonetic key of a text (e.g. a city name), a French variant of Soundex applied to each word:
+    the first letter followed by the codes of the next consonants, similar sounding consonants sharing a code.
+
+    'Châtillon-sur-Seine' and 'CHATILLON SUR SEINE' give 'C345 S6 S5'.
+    """
+    words = []
+    for word in fold(text).split():
+        key = [word[0]]
+        previous = PHONETIC_CODES.get(word[0])
+        for letter in word[1:]:
+            code = PHONETIC_CODES.get(letter)
+            if code is not None and code != previous:
+                key.append(code)
+            previous = code
+        words.append(''.join(key))
+    return ' '.join(words)
+
+
+def has_fts_index(conn):
+    """
+    Return True if the database has the full-text index of the addresses.
+    """
+    return conn.execute("""SELECT 1 FROM sqlite_master WHERE name = 'addresses_fts'""").fetchone() is not None
+
+
+def explain_query(conn, query):
+    """
+    Return the EXPLAIN QUERY PLAN of a candidates query as printable lines.
+    """
+    plan = conn.execute("EXPLAIN QUERY PLAN " + query.sql, query.params + (0, 0)).fetchall()
+    return ["    " + row[-1] for row in plan]
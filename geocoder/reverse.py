@@ -0,0 +1,225 @@
+import math
+import re
+
+import numpy as np
+
+from .addresses_matcher import open_database
+from .departments import list_shards
+from .query import LABEL_EXPRESSION, has_precomputed_columns
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Half side in meters of the first box searched around a point, multiplied by SEARCH_GROWTH until the box
+# holds enough addresses or reaches the radius
+START_RADIUS = 50
+SEARCH_GROWTH = 4
+
+# Addresses within the bounding box of a point, with their exact coordinates (the box is stored as 32-bit floats)
+SPATIAL_QUERY = """SELECT id, lat, lon FROM addresses_rtree WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ?
+    AND max_lon >= ?"""
+
+# Maximum number of rowids bound to a single query of labels
+MAX_VARIABLES = 900
+
+# Latitude and longitude of a line of points file, separated by a comma, a semicolon, a tab or spaces
+PATTERN_POINT = re.compile(r'^\s*(-?\d+(?:\.\d*)?)\s*[,;\s]\s*(-?\d+(?:\.\d*)?)\s*$')
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters between arrays of points given in degrees.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def has_spatial_index(conn):
+    """
+    Return True if the database has the spatial index of the addresses.
+    """
+    return conn.execute("""SELECT 1 FROM sqlite_master WHERE name = 'addresses_rtree'""").fetchone() is not None
+
+
+def read_points(input_file, verbose=False):
+    """
+    Read the points of a file, one "latitude,longitude" per line.
+
+    Yields:
+    - point (tuple): The latitude and longitude of a valid line, in file order.
+    """
+    with open(input_file, "r") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            m = PATTERN_POINT.match(line)
+            if m is None:
+                if verbose:
+                    print(f"[!] Line {number} is not a latitude and longitude : {line.strip()}")
+                continue
+            yield float(m.group(1)), float(m.group(2))
+
+
+class ReverseGeocoder:
+    """
+    Find the nearest BAN addresses of points with the spatial index of the local database.
+
+    Points are looked up by chunks: each round queries the R*Tree with a box around the points still missing
+    addresses, the distances of all the candidates of the chunk are computed at once, and the box grows until
+    every point has its addresses or the box reaches the radius.
+
+    Parameters:
+    - database (str): The file path of the SQLite database, or a directory of department databases.
+    - radius (float): The maximum distance in meters between a point and its addresses.
+    - limit (int): The maximum number of addresses of each point, nearest first.
+    - verbose (bool): Flag to enable verbose output.
+    """
+
+    def __init__(self, database, radius=200, limit=1, verbose=False):
+        self.radius = float(radius)
+        self.limit = limit
+        self.verbose = verbose
+        shards = list_shards(database)
+        if shards == {}:
+            raise ValueError("No department database in {}".format(database))
+        databases = list(shards.values()) if shards else [database]
+        self.connections = []
+        self.labels = []
+        try:
+            for path in databases:
+                conn = open_database(path)
+                self.connections.append(conn)
+                if not has_spatial_index(conn):
+                    raise ValueError("No spatial index in {}, run initdb again to build it".format(path))
+                self.labels.append("label" if has_precomputed_columns(conn) else LABEL_EXPRESSION.format(table=""))
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fetch_candidates(self, lats, lons, points, radius):
+        """
+        Query the spatial index with a box of half side radius around each point.
+
+        Returns:
+        - candidates (tuple): Arrays of the point index, database index, rowid, latitude and longitude
+          of each address found.
+        """
+        found = []
+        owners = []
+        databases = []
+        half_lats = radius / METERS_PER_DEGREE
+        half_lons = half_lats / np.maximum(np.cos(np.radians(lats)), 0.01)
+        for point, lat, lon, half_lon in zip(points.tolist(), lats.tolist(), lons.tolist(), half_lons.tolist()):
+            bounds = (lat + half_lats, lat - half_lats, lon + half_lon, lon - half_lon)
+            for index, conn in enumerate(self.connections):
+                rows = conn.execute(SPATIAL_QUERY, bounds).fetchall()
+                if rows:
+                    found.extend(rows)
+                    owners.extend([point] * len(rows))
+                    databases.extend([index] * len(rows))
+        rows = np.array(found, dtype=np.float64).reshape(-1, 3)
+        return (np.array(owners, dtype=np.int64), np.array(databases, dtype=np.int64), rows[:, 0].astype(np.int64),
+                rows[:, 1], rows[:, 2])
+
+    def fetch_labels(self, databases, rowids):
+        """
+        Return the labels of addresses given by their database index and rowid.
+        """
+        labels = {}
+        for index in np.unique(databases).tolist():
+            selected = rowids[databases == index].tolist()
+            for start in range(0, len(selected), MAX_VARIABLES):
+                batch = selected[start:start + MAX_VARIABLES]
+                sql = "SELECT rowid, {} FROM addresses WHERE rowid IN ({})".format(self.labels[index],
+                                                                                    ", ".join("?" * len(batch)))
+                labels.update(((index, rowid), label) for rowid, label in self.connections[index].execute(sql, batch))
+        return [labels.get((index, rowid)) for index, rowid in zip(databases.tolist(), rowids.tolist())]
+
+    def reverse(self, lats, lons):
+        """
+        Find the nearest addresses of a chunk of points.
+
+        Parameters:
+        - lats (array): The latitudes of the points.
+        - lons (array): The longitudes of the points.
+
+        Returns:
+        - results (list): For each point, a list of (address, lat, lon, distance) tuples, nearest first,
+          empty if no address is within the radius.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if not len(lats):
+            return []
+        kept = []
+        pending = np.arange(len(lats))
+        radius = min(START_RADIUS, self.radius)
+        while pending.size:
+            owners, databases, rowids, address_lats, address_lons = self.fetch_candidates(
+                lats[pending], lons[pending], pending, radius)
+            distances = haversine(lats[owners], lons[owners], address_lats, address_lons)
+            # Only the addresses within the circle are certainly the nearest ones, those in the corners of the
+            # box may be further than addresses just outside of it
+            inside = distances <= radius
+            counts = np.bincount(owners[inside], minlength=len(lats))
+            done = (counts >= self.limit) | (radius >= self.radius)
+            keep = inside & done[owners]
+            kept.append((owners[keep], databases[keep], rowids[keep], address_lats[keep], address_lons[keep],
+                         distances[keep]))
+            pending = pending[~done[pending]]
+            radius = min(radius * SEARCH_GROWTH, self.radius)
+
+        owners, databases, rowids, address_lats, address_lons, distances = (np.concatenate(column)
+                                                                            for column in zip(*kept))
+        # The limit nearest addresses of each point, in point order
+        order = np.lexsort((distances, owners))
+        owners = owners[order]
+        rank = np.arange(len(owners)) - np.searchsorted(owners, owners, side='left')
+        selected = order[rank < self.limit]
+        labels = self.fetch_labels(databases[selected], rowids[selected])
+
+        results = [[] for _ in range(len(lats))]
+        for owner, label, lat, lon, distance in zip(owners[rank < self.limit].tolist(), labels,
+                                                    address_lats[selected].tolist(), address_lons[selected].tolist(),
+                                                    distances[selected].tolist()):
+            results[owner].append((label, lat, lon, distance))
+        return results
+
+    def iter_reversed(self, points, chunk_size=10000):
+        """
+        Find the nearest addresses of a stream of points, chunk by chunk.
+
+        Parameters:
+        - points (iterable): The (latitude, longitude) of the points.
+        - chunk_size (int): The number of points looked up at once.
+
+        Yields:
+        - result (tuple): (lat, lon, addresses) for each point in input order, addresses being the
+          (address, lat, lon, distance) tuples of reverse.
+        """
+        chunk = []
+        for point in points:
+            chunk.append(point)
+            if len(chunk) == chunk_size:
+                yield from self.reverse_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self.reverse_chunk(chunk)
+
+    def reverse_chunk(self, chunk):
+        lats, lons = zip(*chunk)
+        for lat, lon, addresses in zip(lats, lons, self.reverse(lats, lons)):
+            yield lat, lon, addresses
@@ -0,0 +1,150 @@
+from rapidfuzz import fuzz, process as rapidfuzz_process, utils as rapidfuzz_utils
+from thefuzz import process as thefuzz_process
+
+# Number of candidates of the first block scored by the scorers with an accept score, each next block is twice
+# as large, the queries reaching the accept score are not scored against the next blocks
+ACCEPT_BLOCK_SIZE = 32
+
+# Maximum number of scores computed by a single cdist call, 16 MB of float32. The queries of an unselective
+# candidates query share a block as large as the whole table, which is then scored by slices.
+MAX_SCORES = 1 << 22
+
+
+def iter_blocks(choices):
+    """
+    Yield the consecutive blocks of choices scored with an accept score, of growing size from ACCEPT_BLOCK_SIZE.
+    """
+    offset, size = 0, ACCEPT_BLOCK_SIZE
+    while offset < len(choices):
+        yield choices[offset:offset + size]
+        offset, size = offset + size, size * 2
+
+
+class TheFuzzScorer:
+    """
+    Score addresses one query at a time with thefuzz.
+    """
+    name = "thefuzz"
+
+    @staticmethod
+    def extract_one(query, choices, score_cutoff=0, accept_score=None):
+        """
+        Return the best (choice, score) for the query, or None if no choice reaches score_cutoff. With
+        accept_score, the choices are scored by blocks and the best choice of the first block reaching it is
+        returned.
+        """
+        if accept_score is None:
+            return thefuzz_process.extractOne(query, choices, score_cutoff=score_cutoff)
+        best_match = None
+        for block in iter_blocks(choices):
+            block_match = thefuzz_process.extractOne(query, block, score_cutoff=score_cutoff)
+            if block_match is not None and (best_match is None or block_match[1] > best_match[1]):
+                best_match = block_match
+                if best_match[1] >= accept_score:
+                    break
+        return best_match
+
+    def extract_best(self, queries, choices, score_cutoff=0, accept_score=None):
+        """
+        Return the best (choice, score) or None for each query against a shared list of choices.
+        """
+        return [self.extract_one(query, choices, score_cutoff, accept_score) for query in queries]
+
+
+class RapidFuzzScorer:
+    """
+    Score addresses with rapidfuzz, several queries against a shared candidate block are scored
+    in a single multi-threaded C call that releases the GIL.
+    """
+    name = "rapidfuzz"
+
+    def __init__(self, workers=-1):
+        self.workers = workers
+
+    @staticmethod
+    def extract_one(query, choices, score_cutoff=0, accept_score=None):
+        """
+        Return the best (choice, score) for the query, or None if no choice reaches score_cutoff. With
+        accept_score, the choices are scored by blocks and the best choice of the first block reaching it is
+        returned.
+        """
+        best_match = None
+        for block in (iter_blocks(choices) if accept_score is not None else [choices]):
+            block_match = rapidfuzz_process.extractOne(query, block, scorer=fuzz.WRatio,
+                                                       processor=rapidfuzz_utils.default_process,
+                                                       score_cutoff=score_cutoff)
+            if block_match is not None and (best_match is None or block_match[1] > best_match[1]):
+                best_match = block_match
+                if accept_score is not None and round(best_match[1]) >= accept_score:
+                    break
+        if best_match is None:
+            return None
+        return best_match[0], round(best_match[1])
+
+    def extract_best(self, queries, choices, score_cutoff=0, accept_score=None):
+        """
+        Return the best (choice, score) or None for each query against a shared list of choices.
+
+        With accept_score, the choices are scored by blocks of growing size from ACCEPT_BLOCK_SIZE and a query
+        reaching it stops being scored, its best choice so far is returned.
+        """
+        if not choices:
+            return [None] * len(queries)
+        if accept_score is not None and len(choices) > ACCEPT_BLOCK_SIZE:
+            return self.extract_best_by_blocks(queries, choices, score_cutoff, accept_score)
+        return [(choices[column], round(score)) if score >= score_cutoff else None
+                for column, score in self.best_columns(queries, choices, score_cutoff)]
+
+    def best_columns(self, queries, choices, score_cutoff):
+        """
+        Return the (position, unrounded score) of the best choice of each query, the first one on ties.
+
+        The choices are scored by slices, so that a single cdist call never computes more than MAX_SCORES scores.
+        """
+        size = max(1, MAX_SCORES // len(queries))
+        best = [(0, -1.0)] * len(queries)
+        for offset in range(0, len(choices), size):
+            scores = rapidfuzz_process.cdist(queries, choices[offset:offset + size], scorer=fuzz.WRatio,
+                                             processor=rapidfuzz_utils.default_process,
+                                             score_cutoff=score_cutoff, workers=self.workers)
+            for position, (row, column) in enumerate(zip(scores, scores.argmax(axis=1))):
+                score = float(row[column])
+                if score > best[position][1]:
+                    best[position] = offset + int(column), score
+        return best
+
+    def extract_best_by_blocks(self, queries, choices, score_cutoff, accept_score):
+        """
+        Run extract_best by blocks of choices, only the queries below accept_score are scored against the next
+        block. A query never reaching it gets the same best choice as in a single call.
+        """
+        # Query position -> (choice, unrounded score) of its best choice so far
+        best = {}
+        pending = list(range(len(queries)))
+        for block in iter_blocks(choices):
+            block_best = self.best_columns([queries[position] for position in pending], block, score_cutoff)
+            for position, (column, score) in zip(pending, block_best):
+                if score >= score_cutoff and (position not in best or score > best[position][1]):
+                    best[position] = block[column], score
+            pending = [position for position in pending
+                       if position not in best or round(best[position][1]) < accept_score]
+            if not pending:
+                break
+        return [(best[position][0], round(best[position][1])) if position in best else None
+                for position in range(len(queries))]
+
+
+SCORERS = {
+    TheFuzzScorer.name: TheFuzzScorer,
+    RapidFuzzScorer.name: RapidFuzzScorer,
+}
+
+
+def get_scorer(name):
+    """
+    Return a scorer instance from its name ('rapidfuzz' or 'thefuzz').
+    """
+    try:
+        return SCORERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown scorer {name}, expected one of {', '.join(SCORERS)}")
@@ -0,0 +1,360 @@
+import csv
+import email.parser
+import email.policy
+import io
+import json
+import queue
+import re
+import signal
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .addresses_matcher import AddressesMatcher
+
+# Postal code of a BAN label
+PATTERN_POSTAL_CODE = re.compile(r'\b\d{5}\b')
+
+# House number of a BAN label, with its repetition index (bis, ter, a, ...), and the street name after it
+PATTERN_HOUSENUMBER = re.compile(r'^(\d+(?: (?:bis|ter|quater|quinquies|[a-z]))?) (.+)$', re.IGNORECASE)
+
+# Columns added to each row by the /search/csv/ endpoint, a subset of those of the geocoding API
+CSV_RESULT_COLUMNS = ['latitude', 'longitude', 'result_label', 'result_score', 'result_type', 'result_housenumber',
+                      'result_name', 'result_postcode', 'result_city', 'result_status']
+
+
+def label_properties(label):
+    """
+    Split a BAN label, e.g. "12 bis Route Thiers 21000 Dijon", into the properties of the geocoding API.
+    """
+    postal_code_match = PATTERN_POSTAL_CODE.search(label)
+    if postal_code_match is None:
+        return {'label': label, 'name': label, 'type': 'street'}
+    street = label[:postal_code_match.start()].strip()
+    properties = {'label': label, 'postcode': postal_code_match.group(0),
+                  'city': label[postal_code_match.end():].strip(), 'name': street, 'type': 'street'}
+    housenumber_match = PATTERN_HOUSENUMBER.match(street)
+    if housenumber_match is not None:
+        properties.update(housenumber=housenumber_match.group(1), street=housenumber_match.group(2),
+                          type='housenumber')
+    return properties
+
+
+def to_feature_collection(query, best_match):
+    """
+    Build the GeoJSON FeatureCollection of the /search/ endpoint of the geocoding API from a best match.
+
+    Parameters:
+    - query (str): The searched address.
+    - best_match (tuple): (address, score, lat, lon, tier) as returned by AddressesMatcher, or None.
+
+    Returns:
+    - json_data (dict): The FeatureCollection, with a single feature when the address was matched, none when
+                        its best candidate was rejected.
+    """
+    features = []
+    if best_match is not None and best_match[4] is not None and best_match[2] is not None and best_match[3] is not None:
+        matched_address, match_score, lat, lon, _ = best_match
+        properties = label_properties(matched_address)
+        # The fuzzy scores range from 0 to 100, those of the API from 0 to 1
+        properties['score'] = match_score / 100
+        features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                         'properties': properties})
+    return {'type': 'FeatureCollection', 'version': 'draft', 'features': features, 'attribution': 'BAN',
+            'licence': 'ETALAB-2.0', 'query': query, 'limit': 1}
+
+
+class MatchBatcher:
+    """
+    Gather the addresses of concurrent requests into micro-batches matched together by the worker pool.
+
+    A single dispatcher thread takes the pending addresses, waits at most max_wait seconds for more of them
+    up to batch_size, and streams the batch through the matcher. Each request waits on the futures of its
+    own addresses.
+
+    Parameters:
+    - matcher (AddressesMatcher): The matcher, in batch mode.
+    - pool (Pool): The worker pool kept for the lifetime of the batcher, None to match in the dispatcher thread.
+    - batch_size (int): The maximum number of addresses of a micro-batch.
+    - max_wait (float): The maximum time in seconds an address waits for others before its batch starts.
+    """
+
+    def __init__(self, matcher, pool, batch_size=256, max_wait=0.005):
+        self.matcher = matcher
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.matched = 0
+        self.thread = threading.Thread(target=self.dispatch, name="match-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, addresses):
+        """
+        Queue addresses to match.
+
+        Returns:
+        - futures (list): For each address, a Future of (standardized_address, best_match).
+        """
+        futures = []
+        for address in addresses:
+            future = Future()
+            self.pending.put((address, future))
+            futures.append(future)
+        return futures
+
+    def match(self, addresses, timeout=None):
+        """
+        Match addresses and wait for their results, an empty address has no match.
+
+        Returns:
+        - results (list): (standardized_address, best_match) for each address, in input order.
+        """
+        futures = iter(self.submit([address for address in addresses if address]))
+        return [next(futures).result(timeout) if address else (address, None) for address in addresses]
+
+    def next_batch(self):
+        """
+        Block until an address is pending, then gather a batch, or return None when the batcher is closed.
+
+        A lone address is matched right away, the batcher only waits for more addresses when several are
+        already pending, i.e. under concurrent load.
+        """
+        item = self.pending.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                if len(batch) == 1:
+                    item = self.pending.get_nowait()
+                else:
+                    item = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Match what was gathered, the next call returns None
+                self.pending.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def dispatch(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                # The duplicates of a batch, e.g. the rows of a CSV file, are matched once
+                results = self.matcher.iter_unique_matches((address for address, _ in batch), self.pool)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.batches += 1
+            self.matched += len(batch)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+
+
+class GeocodingRequestHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints of the local geocoding service, compatible with the geocoding API:
+
+    - GET /search/?q=<address>: the GeoJSON FeatureCollection of the best match of an address.
+    - POST /search/: a JSON list of addresses (or {"addresses": [...]}), answered with {"results": [...]},
+      a FeatureCollection per address in input order.
+    - POST /search/csv/: a CSV file, as the 'data' field of a multipart form or as the body, whose 'columns'
+      fields (all the columns by default) make the address, answered with the CSV and the result columns.
+    - GET /health: the state of the service.
+    """
+    server_version = "BANGeocoder"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, Nagle's algorithm would hold the body until the client acknowledges
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, json_data):
+        self.send_body(status, json.dumps(json_data, ensure_ascii=False).encode('utf-8'),
+                       'application/json; charset=utf-8')
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {'code': status, 'message': message})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        try:
+            self.route_get()
+        except Exception as e:
+            self.send_error_json(500, str(e))
+
+    def do_POST(self):
+        try:
+            self.route_post()
+        except Exception as e:
+            self.send_error_json(500, str(e))
+
+    def route_get(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/health':
+            batcher = self.server.batcher
+            self.send_json(200, {'status': 'ok', 'batches': batcher.batches, 'matched': batcher.matched})
+        elif url.path.rstrip('/') == '/search':
+            query = urllib.parse.parse_qs(url.query).get('q', [''])[0].strip()
+            if not query:
+                self.send_error_json(400, 'q: the address to search is required')
+                return
+            _, best_match = self.server.batcher.match([query])[0]
+            self.send_json(200, to_feature_collection(query, best_match))
+        else:
+            self.send_error_json(404, 'Not found')
+
+    def route_post(self):
+        path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+        if path == '/search':
+            self.search_json()
+        elif path == '/search/csv':
+            self.search_csv()
+        else:
+            self.send_error_json(404, 'Not found')
+
+    def search_json(self):
+        try:
+            json_data = json.loads(self.read_body() or b'null')
+        except ValueError:
+            self.send_error_json(400, 'The body is not valid JSON')
+            return
+        addresses = json_data.get('addresses') if isinstance(json_data, dict) else json_data
+        if not isinstance(addresses, list) or not all(isinstance(address, str) for address in addresses):
+            self.send_error_json(400, 'Expected a list of addresses')
+            return
+        results = self.server.batcher.match([address.strip() for address in addresses])
+        self.send_json(200, {'results': [to_feature_collection(address, best_match)
+                                         for address, (_, best_match) in zip(addresses, results)]})
+
+    def read_form(self):
+        """
+        Return the CSV text and the address columns of a /search/csv/ request.
+        """
+        body = self.read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return body.decode('utf-8-sig'), []
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        data, columns = None, []
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'data':
+                data = part.get_payload(decode=True).decode('utf-8-sig')
+            elif name == 'columns':
+                columns.append(part.get_payload(decode=True).decode('utf-8'))
+        return data, columns
+
+    def search_csv(self):
+        data, columns = self.read_form()
+        if data is None:
+            self.send_error_json(400, 'data: the CSV file is required')
+            return
+        reader = csv.DictReader(io.StringIO(data, newline=''))
+        rows = list(reader)
+        # The header of a file without data rows still names its columns
+        fieldnames = list(reader.fieldnames or [])
+        if any(column not in fieldnames for column in columns):
+            self.send_error_json(400, 'columns: unknown column')
+            return
+        columns = columns or fieldnames
+        addresses = [' '.join((row.get(column) or '').strip() for column in columns).strip() for row in rows]
+        results = self.server.batcher.match(addresses)
+
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=fieldnames + CSV_RESULT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for row, address, (_, best_match) in zip(rows, addresses, results):
+            features = to_feature_collection(address, best_match)['features']
+            if features:
+                properties = features[0]['properties']
+                lon, lat = features[0]['geometry']['coordinates']
+                row.update(latitude=lat, longitude=lon, result_status='ok',
+                           **{'result_' + key: properties.get(key) for key in
+                              ('label', 'score', 'type', 'housenumber', 'name', 'postcode', 'city')})
+            else:
+                # The score of the best rejected candidate, if any
+                row.update(result_status='not-found', result_score=best_match[1] / 100 if best_match else None)
+            writer.writerow(row)
+        self.send_body(200, output.getvalue().encode('utf-8'), 'text/csv; charset=utf-8')
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(database, host='127.0.0.1', port=7878, processes=4, chunk_size=16, scorer="rapidfuzz", fts=True,
+          fts_limit=100, index=None, max_tier="wide", min_score=0, accept_score=None, batch_size=256, max_wait=0.005,
+          verbose=False):
+    """
+    Serve the local geocoding over HTTP until interrupted, with a worker pool started once.
+
+    Parameters:
+    - database (str): The file path of the SQLite database, or a directory of department databases.
+    - host (str): The address the server listens on.
+    - port (int): The port the server listens on.
+    - processes (int): The number of worker processes matching the addresses.
+    - chunk_size (int): The number of addresses sent to a worker at once.
+    - scorer (str): The fuzzy scoring backend, 'rapidfuzz' or 'thefuzz'.
+    - fts (bool): Fetch the candidates of the addresses missing a house number or a postal code from the
+                  full-text index of the database, when it has one.
+    - fts_limit (int): The number of candidates fetched from the full-text index, best ranked first.
+    - index (str): The file path of an address index built by buildindex, None to query the database only.
+    - max_tier (str): The last tier of the match strategy tried, see tiers.TIERS.
+    - min_score (int): The minimum score of a fuzzy match.
+    - accept_score (int): The score at which the candidates of an address stop being scored, None to score them
+                          all.
+    - batch_size (int): The maximum number of addresses matched together.
+    - max_wait (float): The maximum time in seconds an address waits for others before being matched.
+    - verbose (bool): Flag to enable verbose output.
+    """
+    matcher = AddressesMatcher(database=database, num_processes=max(1, processes), verbose=False, batch=True,
+                               chunk_size=chunk_size, scorer=scorer, fts=fts, fts_limit=fts_limit, index=index,
+                               max_tier=max_tier, min_score=min_score, accept_score=accept_score)
+    pool = matcher.start_pool()
+    batcher = MatchBatcher(matcher, pool, batch_size=batch_size, max_wait=max_wait)
+    server = ThreadingHTTPServer((host, port), GeocodingRequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.verbose = verbose
+    # A service manager stops the server with SIGTERM, shut it down like on Ctrl-C
+    signal.signal(signal.SIGTERM, interrupt)
+    print(f"[+] Serving {database} on http://{host}:{server.server_port}/search/ with {processes} processes")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        pool.terminate()
+        pool.join()
+        if verbose:
+            print(f"[+] {batcher.matched} addresses matched in {batcher.batches} batches")
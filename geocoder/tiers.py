@@ -0,0 +1,233 @@
+from collections import namedtuple
+
+from .metrics import NULL_METRICS
+from .normalizer import fold
+from .parser import street_word
+from .query import WHOLE_TABLE, build_street_query, extract_query_keys, fetch_candidates
+
+# Tiers of the match strategy, in the order they are tried:
+# - exact: a candidate is the address itself, once both are folded
+# - interpolated: the house number is missing from its street, its position is interpolated between its neighbours
+# - fuzzy: the best scored candidate of the narrowed query
+# - wide: the best scored candidate of the fallbacks of the query, when the narrowed query finds nothing
+TIERS = ['exact', 'interpolated', 'fuzzy', 'wide']
+
+# Score of the exact and interpolated matches, which are not scored
+EXACT_SCORE = 100
+
+# Settings of the match strategy:
+# - max_tier: the number of tiers tried, 1 for exact only up to len(TIERS) for every tier
+# - min_score: the minimum score of a fuzzy match, the best candidate of an address below it is rejected
+# - accept_score: the score at which the scorer stops scoring the candidates of an address, None to score them all
+Strategy = namedtuple('Strategy', ['max_tier', 'min_score', 'accept_score'])
+
+DEFAULT_STRATEGY = Strategy(len(TIERS), 0, None)
+
+
+class CandidateSource:
+    """
+    Candidates of the addresses in a set of databases, or in the address index for the addresses it answers.
+
+    Parameters:
+    - connections (list): The connections to the databases the addresses are routed to.
+    - index (AddressIndex): The address index, or None.
+    - fts_limit (int): The number of candidates from the full-text index, 0 without it.
+    - precomputed (bool): Whether the databases have the columns of prepare_database.
+    - rowid_range (tuple): The first and last rowids of the candidates in each database.
+    - metrics (Metrics): The metrics timing the lookups.
+    """
+
+    def __init__(self, connections, index=None, fts_limit=0, precomputed=False, rowid_range=WHOLE_TABLE,
+                 metrics=NULL_METRICS):
+        self.connections = connections
+        self.index = index
+        self.fts_limit = fts_limit
+        self.precomputed = precomputed
+        self.rowid_range = rowid_range
+        self.metrics = metrics
+
+    def fetch(self, parsed, query, wide=False):
+        """
+        Return the candidates of the narrowed query of a parsed address, or with wide those of its fallbacks.
+
+        Returns:
+        - rows (list): The (address, lat, lon) of the candidates.
+        """
+        if self.index is not None and self.index.answers(parsed, self.fts_limit):
+            start = self.metrics.clock()
+            if not wide:
+                rows = self.index.lookup(parsed, self.fts_limit, fallback=False)
+            else:
+                # The fallback of a query narrowed by the street name is the same query without it
+                numero, postal_code, street_type, name = extract_query_keys(parsed)
+                rows = self.index.lookup_keys(numero, postal_code, street_type, None) if name is not None else []
+            self.metrics.add_time("index_lookup", start)
+        else:
+            if wide:
+                query = query.fallback
+                if query is None:
+                    return []
+            start = self.metrics.clock()
+            rows = []
+            for conn in self.connections:
+                rows.extend(fetch_candidates(conn, query, *self.rowid_range, fallback=wide))
+            self.metrics.add_time("sql", start, calls=len(self.connections))
+        self.metrics.count("candidates", len(rows))
+        return rows
+
+    def fetch_street(self, parsed):
+        """
+        Return every house number of the street of a parsed address, an empty list when it has no postal code,
+        street type or street name.
+        """
+        if self.index is not None:
+            keys = parsed.postal_code, parsed.street_type, street_word(parsed)
+            if not all(keys):
+                return []
+            start = self.metrics.clock()
+            rows = self.index.lookup_keys(None, *keys, fallback=False)
+            self.metrics.add_time("index_lookup", start)
+            return rows
+        query = build_street_query(parsed, self.precomputed)
+        if query is None:
+            return []
+        start = self.metrics.clock()
+        rows = []
+        for conn in self.connections:
+            rows.extend(fetch_candidates(conn, query, *self.rowid_range))
+        self.metrics.add_time("sql", start, calls=len(self.connections))
+        return rows
+
+
+def interpolate(parsed, rows):
+    """
+    Interpolate the position of the house number of a parsed address between the nearest house numbers of its
+    street, on the same side of the street when it has numbers on both sides of it.
+
+    Parameters:
+    - parsed (ParsedAddress): The address, with a house number missing from the BAN.
+    - rows (list): The (address, lat, lon) of the house numbers of its street.
+
+    Returns:
+    - best_match (tuple): (address, score, lat, lon) of the interpolated house number, or None.
+    """
+    if parsed.numero is None or parsed.rep is not None:
+        return None
+    numero = int(parsed.numero)
+    # The labels of the street are "<number> <street> <postal code> <city>", the rows with a repetition index or
+    # of another street with the same last word have another key
+    key = fold(' '.join(part for part in (parsed.street, parsed.postal_code, parsed.commune) if part))
+    keys = {}
+    numbers = {}
+    for label, lat, lon in rows:
+        number, _, rest = (label or '').partition(' ')
+        if not number.isdigit() or lat is None or lon is None:
+            continue
+        if rest not in keys:
+            keys[rest] = fold(rest) == key
+        if keys[rest]:
+            numbers[int(number)] = rest, lat, lon
+    for same_side in (True, False):
+        below = [number for number in numbers if number < numero and (not same_side or number % 2 == numero % 2)]
+        above = [number for number in numbers if number > numero and (not same_side or number % 2 == numero % 2)]
+        if below and above:
+            low, high = max(below), min(above)
+            rest, low_lat, low_lon = numbers[low]
+            _, high_lat, high_lon = numbers[high]
+            ratio = (numero - low) / (high - low)
+            return (f"{numero} {rest}", EXACT_SCORE, round(low_lat + ratio * (high_lat - low_lat), 6),
+                    round(low_lon + ratio * (high_lon - low_lon), 6))
+    return None
+
+
+def score_candidates(parsed_addresses, rows, scorer, accept_score=None, metrics=NULL_METRICS):
+    """
+    Score the (address, lat, lon) candidates against each parsed address in a single call of the scorer, an
+    address stops being scored once a candidate reaches accept_score.
+
+    Returns:
+    - best_matches (list): (address, score, lat, lon) of the best candidate of each address, or None.
+    """
+    start = metrics.clock()
+    address_lat_lon_map = {row[0]: (row[1], row[2]) for row in rows}
+    scored = scorer.extract_best([parsed.address for parsed in parsed_addresses], list(address_lat_lon_map),
+                                 accept_score=accept_score)
+    metrics.add_time("score", start, calls=len(parsed_addresses))
+    best_matches = []
+    for best_match in scored:
+        if best_match is None:
+            best_matches.append(None)
+        else:
+            matched_address, match_score = best_match
+            best_matches.append((matched_address, match_score) + address_lat_lon_map[matched_address])
+    return best_matches
+
+
+def match_tiered(parsed_addresses, query, source, scorer, strategy=DEFAULT_STRATEGY, metrics=NULL_METRICS):
+    """
+    Match parsed addresses sharing a candidates query tier by tier, up to the max_tier of the strategy, see TIERS.
+
+    The exact and interpolated tiers only apply to the addresses with a house number and a postal code, whose
+    query only reads a handful of rows. The street of the interpolated tier is only read when the narrowed
+    query finds nothing, i.e. when the house number is missing from the street. The wide tier is tried when the
+    narrowed query finds nothing, or when its best candidate is below the min_score of the strategy.
+
+    Parameters:
+    - parsed_addresses (list): The parsed addresses.
+    - query (CandidateQuery): Their candidates query.
+    - source (CandidateSource): The databases or address index the candidates are read from.
+    - scorer: The fuzzy scorer of the fuzzy and wide tiers.
+    - strategy (Strategy): The last tier tried and the scores of the fuzzy tiers.
+    - metrics (Metrics): The metrics timing the tiers.
+
+    Returns:
+    - best_matches (list): (address, score, lat, lon, tier) of each address, with a None tier when its best
+                           candidate was rejected, or None if it has no candidate.
+    """
+    max_tier, min_score, accept_score = strategy
+    best_matches = [None] * len(parsed_addresses)
+    pending = list(range(len(parsed_addresses)))
+    rows = source.fetch(parsed_addresses[0], query)
+    keyed = query.selective and parsed_addresses[0].postal_code is not None
+
+    def score(tier, rows):
+        # Keep the best rejected candidate of an address when no tier matches it
+        scored = score_candidates([parsed_addresses[position] for position in pending], rows, scorer,
+                                  accept_score, metrics)
+        for position, best_match in zip(pending, scored):
+            if best_match is None:
+                continue
+            if best_match[1] >= min_score:
+                best_matches[position] = best_match + (tier,)
+            elif best_matches[position] is None or best_match[1] > best_matches[position][1]:
+                best_matches[position] = best_match + (None,)
+        return [position for position in pending if best_matches[position] is None or best_matches[position][4] is None]
+
+    if rows:
+        if keyed:
+            start = metrics.clock()
+            labels = {fold(row[0]): row for row in rows if row[0]}
+            for position in pending:
+                row = labels.get(fold(parsed_addresses[position].address))
+                if row is not None:
+                    best_matches[position] = row[0], EXACT_SCORE, row[1], row[2], TIERS[0]
+            pending = [position for position in pending if best_matches[position] is None]
+            metrics.add_time("exact", start, calls=len(parsed_addresses))
+        if not pending or max_tier < 3:
+            return best_matches
+        pending = score(TIERS[2], rows)
+    elif keyed and max_tier >= 2:
+        street_rows = source.fetch_street(parsed_addresses[0])
+        start = metrics.clock()
+        for position in pending:
+            best_match = interpolate(parsed_addresses[position], street_rows)
+            if best_match is not None:
+                best_matches[position] = best_match + (TIERS[1],)
+        pending = [position for position in pending if best_matches[position] is None]
+        metrics.add_time("interpolate", start, calls=len(parsed_addresses))
+
+    if pending and max_tier >= 4:
+        rows = source.fetch(parsed_addresses[0], query, wide=True)
+        if rows:
+            score(TIERS[3], rows)
+    return best_matches
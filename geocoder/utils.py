@@ -1,43 +1,236 @@
-import gzip
-import shutil
+import io
+import os
+import time
+import zlib
 
-import requests
+# Directory of the latest BAN datasheets, one adresses-<department>.csv.gz per department and for France
+BAN_URL = 'https://adresse.data.gouv.fr/data/ban/adresses/latest/csv'
 
+# Size of the chunks read from the network and from the retained file
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
-def uncompress_gz_to_csv(gz_file_path, csv_file_path, verbose):
+# Seconds between two progress reports of a download
+PROGRESS_INTERVAL = 5
+
+
+class ChunksReader(io.RawIOBase):
     """
-    Uncompress a .gz file and write the contents to a .csv file.
+    Read-only binary stream over an iterator of bytes chunks, closing the iterator when closed.
 
     Parameters:
-    - gz_file_path (str): The file path of the .gz file to uncompress.
-    - csv_file_path (str): The file path where the .csv will be saved.
+    - chunks (iterator): The bytes chunks of the stream.
+    - name (str): The name of the stream, e.g. its URL.
     """
-    if verbose:
-        print(f"[+] Uncompressing {gz_file_path} to {csv_file_path}")
-    with gzip.open(gz_file_path, 'rb') as f_in:
-        with open(csv_file_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
 
+    def __init__(self, chunks, name=None):
+        super().__init__()
+        self.chunks = chunks
+        self.name = name
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        super().close()
 
-def download_csv(url, output_path, verbose):
+
+def iter_download(url, output_path=None, verbose=False, retries=3, timeout=30):
     """
-    Download a CSV file from a given URL and save it to the specified path.
+    Download a file by chunks, resuming with Range requests when the connection drops.
+
+    With output_path, the chunks are also written to output_path + '.part', renamed to output_path once
+    complete. A '.part' file left by an interrupted download is read first and the download resumes
+    after its last byte.
 
     Parameters:
-    - url (str): The URL of the CSV file to download.
-    - output_path (str): The file path where the CSV will be saved.
+    - url (str): The URL of the file to download.
+    - output_path (str): The file path where the file is retained, None to keep nothing on disk.
+    - verbose (bool): Flag to enable verbose output.
+    - retries (int): The number of times the download is resumed after a network error.
+    - timeout (float): The connect and read timeout in seconds.
+
+    Yields:
+    - chunk (bytes): The content of the file, chunk by chunk.
     """
+    import requests
+
     if verbose:
         print(f"[+] Downloading BAN datasheet from {url}")
+    received = 0
+    part_path = output_path + '.part' if output_path else None
+    if part_path and os.path.exists(part_path):
+        with open(part_path, 'rb') as part_file:
+            for chunk in iter(lambda: part_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                received += len(chunk)
+                yield chunk
+        if verbose:
+            print(f"[+] Resuming the download of {url} after {received / 1e6:.1f} MB")
+    part_file = open(part_path, 'ab') if part_path else None
 
-    response = requests.get(url)
+    start = last_report = time.perf_counter()
+    downloaded = 0
+    failures = 0
+    try:
+        while True:
+            headers = {'Range': f'bytes={received}-'} if received else {}
+            try:
+                with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code == 416 and received:
+                        # Nothing left after the bytes already received
+                        break
+                    if response.status_code not in (200, 206):
+                        # Raise rather than end the stream, the bytes already yielded are not the whole file
+                        raise requests.HTTPError(f"Failed to download {url}, HTTP Status Code: "
+                                                 f"{response.status_code}", response=response)
+                    # A server ignoring the Range header sends the whole file again
+                    skip = received if response.status_code == 200 else 0
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2] \
+                        if response.status_code == 206 else response.headers.get('Content-Length')
+                    total = int(total) if total and total.isdigit() else None
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk, skip = chunk[dropped:], skip - dropped
+                            if not chunk:
+                                continue
+                        received += len(chunk)
+                        downloaded += len(chunk)
+                        if part_file is not None:
+                            part_file.write(chunk)
+                        yield chunk
+                        now = time.perf_counter()
+                        if verbose and now - last_report >= PROGRESS_INTERVAL:
+                            last_report = now
+                            size = f" / {total / 1e6:.1f}" if total else ""
+                            print(f"[+] Downloaded {received / 1e6:.1f}{size} MB "
+                                  f"({downloaded / 1e6 / (now - start):.1f} MB/s)")
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                if verbose:
+                    print(f"[!] Download of {url} interrupted, resuming after {received / 1e6:.1f} MB : {e}")
+                time.sleep(min(2 ** failures, 30))
+    finally:
+        if part_file is not None:
+            part_file.close()
 
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Write the content of the response to a file
-        with open(output_path, 'wb') as file:
-            file.write(response.content)
-        if verbose:
-            print(f"[+] File downloaded successfully: {output_path}")
-    else:
-        print(f"[!] Failed to download CSV file. HTTP Status Code: {response.status_code}")
+    if part_path:
+        os.replace(part_path, output_path)
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f"[+] File downloaded successfully: {received / 1e6:.1f} MB "
+              f"({downloaded / 1e6 / elapsed if elapsed else 0:.1f} MB/s)")
+
+
+def iter_gunzip(chunks):
+    """
+    Decompress a stream of gzip chunks incrementally, including files made of several gzip members.
+
+    Yields:
+    - data (bytes): The decompressed content.
+
+    Raises:
+    - ValueError: The stream ends in the middle of a gzip member.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # Whether the current member received any bytes, an empty stream is not truncated
+    started = False
+    for chunk in chunks:
+        while chunk:
+            started = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                started = False
+            else:
+                chunk = b''
+    data = decompressor.flush()
+    if data:
+        yield data
+    if started and not decompressor.eof:
+        raise ValueError("truncated gzip stream")
+
+
+def open_ban_csv(url, output_path=None, verbose=False):
+    """
+    Open a BAN .csv.gz URL as a text stream, downloaded and decompressed as it is read.
+
+    Nothing but the optional retained .csv.gz is written to disk, and only a few chunks are held in memory.
+
+    Parameters:
+    - url (str): The URL of the BAN .csv.gz datasheet.
+    - output_path (str): The file path where the .csv.gz is retained, None to keep nothing on disk.
+    - verbose (bool): Flag to enable verbose output.
+
+    Returns:
+    - csv_file (TextIOWrapper): The CSV text stream, to be closed by the caller.
+    """
+    raw = ChunksReader(iter_gunzip(iter_download(url, output_path=output_path, verbose=verbose)), name=url)
+    return io.TextIOWrapper(io.BufferedReader(raw, DOWNLOAD_CHUNK_SIZE), encoding='utf-8', newline='')
+
+
+def process_memory(pid):
+    """
+    Return the resident memory of a process, read from /proc on Linux.
+
+    Returns:
+    - memory (dict): The resident set size 'rss', its part 'file' mapped from files and its peak 'peak', in bytes,
+      or None if it cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return {"rss": int(fields["VmRSS"].split()[0]) * 1024, "file": int(fields["RssFile"].split()[0]) * 1024,
+                "peak": int(fields["VmHWM"].split()[0]) * 1024}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_memory(pid):
+    """
+    Reset the peak resident memory of a process to its current resident memory, on Linux.
+
+    Returns:
+    - reset (bool): True if the peak was reset.
+    """
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def records_to_string(records, columns):
+    """
+    Format records as a plain text table, the way DataFrame.to_string(index=False) prints them, without pandas.
+
+    Parameters:
+    - records (list): The records (dicts) to print.
+    - columns (list): The columns printed, in order.
+
+    Returns:
+    - table (str): The header and one line per record, each column right-aligned.
+    """
+    cells = [columns] + [[str(record.get(column)) for column in columns] for record in records]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    return '\n'.join(' '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in cells)
@@ -0,0 +1,57 @@
+import csv
+import email.parser
+import email.policy
+import io
+import time
+
+from conftest import StubHandler
+from geocoder.geocoder import iter_bulk_geocoding
+
+RESULT_COLUMNS = ['latitude', 'longitude', 'result_label', 'result_score', 'result_housenumber', 'result_city']
+
+
+class BulkHandler(StubHandler):
+    """
+    Answer /search/csv/ with the house number of each address as its latitude, the first chunks of the file
+    being answered last, and "unknown" addresses not found. The city is a quoted field holding a newline.
+    """
+    uploads = []
+
+    def do_POST(self):
+        content_type = self.headers['Content-Type']
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + self.read_body())
+        parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True).decode('utf-8')
+                 for part in message.iter_parts()}
+        rows = list(csv.DictReader(io.StringIO(parts['data'], newline='')))
+        self.uploads.append((parts['columns'], len(rows)))
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=['address'] + RESULT_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            number = row['address'].split()[0]
+            if 'unknown' in row['address']:
+                writer.writerow({'address': row['address']})
+            else:
+                writer.writerow({'address': row['address'], 'latitude': number, 'longitude': '2.0',
+                                 'result_label': row['address'].title(), 'result_score': '0.9',
+                                 'result_housenumber': number, 'result_city': 'Paris\n1er'})
+        # The earlier chunks are slower, so the responses arrive out of order
+        time.sleep(0.05 * (10 - int(rows[0]['address'].split()[0])) / 10)
+        self.send_body(200, output.getvalue(), content_type='text/csv; charset=utf-8')
+
+
+def test_bulk_results_are_merged_in_input_order(http_server, tmp_path):
+    BulkHandler.uploads = []
+    input_file = tmp_path / 'addresses.txt'
+    input_file.write_text(''.join('{} rue de la paix paris\n{}'.format(number, '\n' if number == 3 else '')
+                                  for number in range(1, 10)) + '9 unknown street\n')
+    records = list(iter_bulk_geocoding(str(input_file), verbose=False, bulk_size=2, concurrency=4,
+                                       api_url=http_server(BulkHandler), retries=0))
+    assert [record['properties_label'] for record in records] == [
+        '{} Rue De La Paix Paris'.format(number) for number in range(1, 10)]
+    assert [record['geometry_coordinates'] for record in records] == [[float(number), 2.0] for number in range(1, 10)]
+    assert records[0]['properties_score'] == 0.9
+    assert records[0]['properties_housenumber'] == '1'
+    assert all(record['properties_city'] == 'Paris\n1er' for record in records)
+    assert BulkHandler.uploads == [('address', 2)] * 5
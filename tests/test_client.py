@@ -0,0 +1,81 @@
+import socket
+import time
+
+from conftest import StubHandler
+from geocoder.client import BanClient
+
+FEATURES = {'type': 'FeatureCollection', 'features': []}
+
+
+def make_handler(responses):
+    """
+    Return a handler answering the requests with the (status, body, headers) of responses in turn, the last one
+    repeated, and recording the path of each request.
+    """
+    class Handler(StubHandler):
+        paths = []
+
+        def do_GET(self):
+            self.paths.append(self.path)
+            status, body, headers = responses[min(len(self.paths), len(responses)) - 1]
+            self.send_body(status, body, headers=headers)
+
+    return Handler
+
+
+def test_search_retries_retryable_statuses(http_server):
+    handler = make_handler([(503, {}, None), (502, {}, None), (200, FEATURES, None)])
+    with BanClient(base_url=http_server(handler), retries=3, backoff=0.01) as client:
+        assert client.search('1 rue de la Paix 75002 Paris') == FEATURES
+    assert len(handler.paths) == 3
+    assert handler.paths[0] == '/search/?q=1%20rue%20de%20la%20Paix%2075002%20Paris'
+
+
+def test_search_gives_up_after_retries(http_server):
+    handler = make_handler([(503, {}, None)])
+    with BanClient(base_url=http_server(handler), retries=2, backoff=0.01) as client:
+        assert client.search('1 rue de la Paix') is None
+    assert len(handler.paths) == 3
+
+
+def test_search_does_not_retry_client_errors(http_server):
+    handler = make_handler([(400, {}, None)])
+    with BanClient(base_url=http_server(handler), retries=3, backoff=0.01) as client:
+        assert client.search('1 rue de la Paix') is None
+    assert len(handler.paths) == 1
+
+
+def test_search_honors_retry_after(http_server):
+    handler = make_handler([(429, {}, {'Retry-After': '0.3'}), (200, FEATURES, None)])
+    with BanClient(base_url=http_server(handler), retries=3, backoff=0.01) as client:
+        start = time.monotonic()
+        assert client.search('1 rue de la Paix') == FEATURES
+        assert time.monotonic() - start >= 0.3
+    assert len(handler.paths) == 2
+
+
+def test_rate_limit_pauses_every_thread(http_server):
+    handler = make_handler([(429, {}, {'Retry-After': '0.3'}), (200, FEATURES, None)])
+    with BanClient(base_url=http_server(handler), concurrency=4, retries=3, backoff=0.01) as client:
+        start = time.monotonic()
+        results = list(client.search_many(['{} rue de la Paix'.format(number) for number in range(8)]))
+        elapsed = time.monotonic() - start
+    assert [json_data for _, json_data in results] == [FEATURES] * 8
+    assert elapsed >= 0.3
+
+
+def test_search_returns_none_on_network_error():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    with BanClient(base_url='http://127.0.0.1:{}'.format(port), retries=1, backoff=0.01, timeout=1) as client:
+        assert client.search('1 rue de la Paix') is None
+
+
+def test_search_returns_none_on_invalid_json(http_server):
+    class Handler(StubHandler):
+        def do_GET(self):
+            self.send_body(200, '<html>Bad gateway</html>', content_type='text/html')
+
+    with BanClient(base_url=http_server(Handler), retries=0) as client:
+        assert client.search('1 rue de la Paix') is None
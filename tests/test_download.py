@@ -0,0 +1,78 @@
+import gzip
+import re
+
+import pytest
+import requests
+
+from conftest import StubHandler
+from geocoder.utils import iter_download, iter_gunzip, open_ban_csv
+
+CSV = ''.join('id;numero;nom_voie\n' if number == 0 else '{0};{0};Rue {0}\n'.format(number)
+              for number in range(5000)).encode('utf-8')
+GZIP = gzip.compress(CSV)
+
+
+def make_handler(body, honor_range, status=200):
+    """
+    Return a handler serving body, with a 206 partial response to a Range request when honor_range is set and
+    the whole body otherwise, recording the Range header of each request.
+    """
+    class Handler(StubHandler):
+        ranges = []
+
+        def do_GET(self):
+            requested = self.headers.get('Range')
+            self.ranges.append(requested)
+            if status != 200:
+                self.send_body(status, b'', content_type='text/plain')
+                return
+            match = re.match(r'bytes=(\d+)-$', requested or '')
+            if honor_range and match:
+                start = int(match.group(1))
+                self.send_body(206, body[start:], content_type='application/gzip',
+                               headers={'Content-Range': 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))})
+            else:
+                self.send_body(200, body, content_type='application/gzip')
+
+    return Handler
+
+
+@pytest.mark.parametrize('honor_range', [True, False])
+def test_download_resumes_after_part_file(http_server, tmp_path, honor_range):
+    handler = make_handler(GZIP, honor_range)
+    output_path = tmp_path / 'adresses-21.csv.gz'
+    (tmp_path / 'adresses-21.csv.gz.part').write_bytes(GZIP[:1000])
+    url = http_server(handler) + '/adresses-21.csv.gz'
+    assert b''.join(iter_download(url, output_path=str(output_path))) == GZIP
+    assert handler.ranges == ['bytes=1000-']
+    assert output_path.read_bytes() == GZIP
+    assert not (tmp_path / 'adresses-21.csv.gz.part').exists()
+
+
+def test_download_streams_the_csv(http_server):
+    url = http_server(make_handler(GZIP, honor_range=True)) + '/adresses-21.csv.gz'
+    with open_ban_csv(url) as csv_file:
+        assert csv_file.read() == CSV.decode('utf-8')
+
+
+def test_download_error_status_raises(http_server, tmp_path):
+    output_path = tmp_path / 'adresses-21.csv.gz'
+    (tmp_path / 'adresses-21.csv.gz.part').write_bytes(GZIP[:1000])
+    url = http_server(make_handler(GZIP, honor_range=True, status=404)) + '/adresses-21.csv.gz'
+    with pytest.raises(requests.HTTPError):
+        list(iter_download(url, output_path=str(output_path)))
+    assert not output_path.exists()
+
+
+def test_gunzip_several_members():
+    assert b''.join(iter_gunzip([gzip.compress(b'abc') + gzip.compress(b'def')[:5], gzip.compress(b'def')[5:]])) \
+        == b'abcdef'
+
+
+def test_gunzip_truncated_stream_raises():
+    with pytest.raises(ValueError, match='truncated'):
+        list(iter_gunzip([GZIP[:len(GZIP) // 2]]))
+
+
+def test_gunzip_empty_stream():
+    assert list(iter_gunzip([])) == []
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+from click.testing import CliRunner
+
+from geocoder.addresses_matcher import open_database
+from geocoder.benchmark import add_noise, build_synthetic_database
+from geocoder.cli import cli
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    """
+    A synthetic BAN database and a file of noisy addresses sampled from it.
+    """
+    directory = tmp_path_factory.mktemp('local')
+    database, _ = build_synthetic_database(str(directory), 2000)
+    conn = open_database(database)
+    try:
+        labels = [row[0] for row in conn.execute("SELECT label FROM addresses ORDER BY rowid")]
+    finally:
+        conn.close()
+    rng = random.Random(0)
+    input_file = directory / 'addresses.txt'
+    input_file.write_text(''.join(add_noise(label, rng) + '\n' for label in rng.sample(labels, 200)) +
+                          '\n1 unknown street 99999 nowhere\n', encoding='utf-8')
+    return database, str(input_file)
+
+
+def run_local(synthetic, tmp_path, *options):
+    database, input_file = synthetic
+    output_csv = tmp_path / 'output-{}.csv'.format('_'.join(options).replace('-', ''))
+    result = CliRunner().invoke(cli, ['local', '-i', input_file, '-ban', database, '-csv', str(output_csv), '-hdr',
+                                      *options])
+    assert result.exit_code == 0, result.output
+    return output_csv.read_text(encoding='utf-8')
+
+
+def test_local_output_does_not_depend_on_processes(synthetic, tmp_path):
+    expected = run_local(synthetic, tmp_path, '-p', '1')
+    lines = expected.splitlines()
+    assert lines[0] == 'Row,Address,Latitude,Longitude,Score,Tier'
+    assert len(lines) == 1 + 201
+    assert sum(line.endswith(',exact') for line in lines) > 100
+    assert run_local(synthetic, tmp_path, '-p', '2') == expected
+    assert run_local(synthetic, tmp_path, '-p', '2', '-b') == expected
+
+
+@pytest.mark.parametrize('options', [['--chunk-size', '0', '-b'], ['--flush-size', '0']])
+def test_local_rejects_empty_chunks(synthetic, options):
+    database, input_file = synthetic
+    result = CliRunner().invoke(cli, ['local', '-i', input_file, '-ban', database, *options])
+    assert result.exit_code == 2
+    assert 'x>=1' in result.output
+
+
+@pytest.mark.parametrize('command', ['local', 'buildindex'])
+def test_bad_database_is_reported(synthetic, tmp_path, command):
+    _, input_file = synthetic
+    options = ['-i', input_file] if command == 'local' else ['-o', str(tmp_path / 'ban.idx')]
+    result = CliRunner().invoke(cli, [command, '-ban', str(tmp_path), *options])
+    assert result.exit_code == 1
+    assert result.output == 'Error: No department database in {}\n'.format(tmp_path)
+    if command == 'local':
+        result = CliRunner().invoke(cli, [command, '-ban', str(tmp_path / 'missing.db'), *options])
+        assert result.exit_code == 1
+        assert 'unable to open database file' in result.output
@@ -0,0 +1,17 @@
+from geocoder.metrics import Metrics
+
+
+def test_prometheus_score_histogram():
+    metrics = Metrics()
+    worker = Metrics()
+    for score in (45, 90, 100):
+        worker.observe_score(score)
+    metrics.observe_score(72)
+    metrics.merge(worker.pop())
+    lines = metrics.to_prometheus().splitlines()
+    assert 'ban_geocoder_match_score_bucket{le="50"} 1' in lines
+    assert 'ban_geocoder_match_score_bucket{le="80"} 2' in lines
+    assert 'ban_geocoder_match_score_bucket{le="+Inf"} 4' in lines
+    assert 'ban_geocoder_match_score_sum 307' in lines
+    assert 'ban_geocoder_match_score_count 4' in lines
+    assert worker.score_sum == 0
@@ -0,0 +1,34 @@
+import random
+
+import pytest
+
+from geocoder import scorers
+
+WORDS = ['rue', 'avenue', 'paix', 'dijon', 'lyon', 'grande', 'petit', 'saint', 'jean', 'marie', 'chemin', 'route']
+
+
+def random_addresses(rng, count, words):
+    return ['{} {}'.format(' '.join(rng.choice(WORDS) for _ in range(words)), rng.randrange(100)) for _ in range(count)]
+
+
+@pytest.mark.parametrize('max_scores', [1, 7, 1000])
+def test_sliced_scoring_matches_a_single_call(monkeypatch, max_scores):
+    rng = random.Random(0)
+    choices = random_addresses(rng, 2000, 4)
+    queries = random_addresses(rng, 40, 3)
+    scorer = scorers.RapidFuzzScorer()
+    expected = [scorer.extract_best(queries, choices, score_cutoff) for score_cutoff in (0, 50, 90)]
+    expected_accept = scorer.extract_best(queries, choices, 50, accept_score=95)
+
+    calls = []
+    cdist = scorers.rapidfuzz_process.cdist
+
+    def bounded_cdist(queries, choices, **kwargs):
+        calls.append(len(queries) * len(choices))
+        return cdist(queries, choices, **kwargs)
+
+    monkeypatch.setattr(scorers, 'MAX_SCORES', max_scores)
+    monkeypatch.setattr(scorers.rapidfuzz_process, 'cdist', bounded_cdist)
+    assert [scorer.extract_best(queries, choices, score_cutoff) for score_cutoff in (0, 50, 90)] == expected
+    assert scorer.extract_best(queries, choices, 50, accept_score=95) == expected_accept
+    assert max(calls) <= max(max_scores, len(queries))